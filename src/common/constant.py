@@ -21,6 +21,7 @@ NAME_TRAININGDATA_RELPATH = 'TrainingData/'
 NAME_VALIDATIONDATA_RELPATH = 'ValidationData/'
 NAME_TESTINGDATA_RELPATH = 'TestingData/'
 NAME_MODELSRUN_RELPATH = 'Models/'
+NAME_VALIDPATCHESCACHE_RELPATH = 'ValidPatchesCache/'
 NAME_LOSSHISTORY_FILE = 'losshistory.csv'
 NAME_CONFIG_PARAMS_FILE = 'configparams.txt'
 NAME_TRAINDATA_LOGFILE = 'traindatafiles.txt'
@@ -33,6 +34,12 @@ NAME_REFERENCE_KEYS_POSTERIORS_FILE = 'Predictions/referenceKeys_posteriors.npy'
 NAME_PRED_RESULT_METRICS_FILE = 'Predictions/result_metrics.csv'
 
 
+# WRITE IMAGE FILES
+COMPRESS_LEVEL_NIFTI_FILES = None    # None: default in nibabel, 0: store data uncompressed (still as valid gzip)
+NUM_THREADS_COMPRESS_NIFTI_FILES = 1
+MAX_SIZE_CACHE_IMAGES_MB = 0    # cache of images read from file, in this process. 0: no cache
+
+
 # PREPROCESSING
 IS_BINARY_TRAIN_MASKS = True
 IS_NORMALIZE_DATA = False
@@ -74,7 +81,14 @@ IS_VALID_CONVOLUTIONS = True
 FREQ_SAVE_CHECK_MODELS = 2
 FREQ_VALIDATE_MODELS = 2
 IS_USE_VALIDATION_DATA = True
+IS_CACHE_VALIDATION_DATA = False     # generate the patches for validation only once, and store them in disk
 IS_SHUFFLE_TRAINDATA = True
+IS_MEMMAP_TRAINDATA = False
+IS_CHUNKED_TRAINDATA = False
+NUM_WORKERS_LOAD_TRAINDATA = 1
+NUM_WORKERS_TRAINDATA = 0
+NUM_FILES_WORKING_SET_TRAINDATA = None    # if not None, only this num. volumes in memory (read on demand)
+MAX_SIZE_WORKING_SET_TRAINDATA_GB = 8.0
 MANUAL_SEED_TRAIN = None
 
 
@@ -83,13 +97,16 @@ IS_GENERATE_PATCHES = True
 TYPE_GENERATE_PATCHES = 'random_window'
 PROP_OVERLAP_SLIDE_WINDOW = (0.25, 0.0, 0.0)
 NUM_RANDOM_PATCHES_EPOCH = 4
+PROB_FOREGROUND_WINDOW = 0.5                    # for 'foreground_window' patches
 IS_TRANSFORM_IMAGES = True
 TYPE_TRANSFORM_IMAGES = 'rigid_trans'
+TYPE_TRANSFORM_BATCH_IMAGES = 'rigid_trans_batch'  # rigid transforms of batches in the model device (Pytorch)
 TRANS_RIGID_ROTATION_RANGE = (10.0, 7.0, 7.0)   # (plane_XY, plane_XZ, plane_YZ)
 TRANS_RIGID_SHIFT_RANGE = (0.0, 0.0, 0.0)       # (width, height, depth)
 TRANS_RIGID_FLIP_DIRS = (True, True, True)      # (horizontal, vertical, axialdir)
 TRANS_RIGID_ZOOM_RANGE = 0.25                   # scale between (1 - val, 1 + val)
 TRANS_RIGID_FILL_MODE = 'reflect'
+TRANS_RIGID_ORDER_INTERP_IMAGE = 0    # order of spline interpolation of images (3: cubic, slower)
 
 
 # NOT USED - TRAINING MODELS
@@ -10,6 +10,7 @@ import re
 import shutil
 import datetime
 import time
+import mmap
 
 from common.exceptionmanager import catch_error_exception
 
@@ -22,7 +23,11 @@ def currentdir() -> str:
 def makedir(dirname: str) -> bool:
     dirname = dirname.strip().rstrip("\\")
     if not is_exist_dir(dirname):
-        os.makedirs(dirname)
+        try:
+            os.makedirs(dirname)
+        except FileExistsError:
+            # created meanwhile by another thread / process
+            return False
         return True
     else:
         return False
@@ -131,6 +136,14 @@ def is_exists_hexec(execname: str) -> bool:
     return shutil.which(execname) is not None
 
 
+def get_modiftime_file(filename: str) -> float:
+    return os.path.getmtime(filename)
+
+
+def get_size_file(filename: str) -> int:
+    return os.path.getsize(filename)
+
+
 def join_path_names(pathname_1: str, pathname_2: str) -> str:
     return os.path.join(pathname_1, pathname_2)
 
@@ -566,6 +579,36 @@ class ImagesUtil:
         axis_val = 0 if is_input_sample else 1
         return np.rollaxis(in_image, axis_val, ndim)
 
+    @staticmethod
+    def is_image_file_backed(in_image: np.ndarray) -> bool:
+        # memory-mapped image (memmap / shard files), or a view of one
+        while in_image is not None:
+            if isinstance(in_image, (np.memmap, mmap.mmap)):
+                return True
+            in_image = getattr(in_image, 'base', None)
+        return False
+
+    @staticmethod
+    def get_image_compact_dtype(in_image: np.ndarray) -> np.ndarray:
+        # lossless conversion to the smallest of (int8, uint8, int16) that holds the values of the image, e.g. for
+        # labels in {-1, 0, 1} or CT intensities in HU stored as float. Otherwise, return the same image
+        if not (np.issubdtype(in_image.dtype, np.integer) or np.issubdtype(in_image.dtype, np.floating)) \
+                or in_image.size == 0:
+            return in_image
+
+        min_value = in_image.min()
+        max_value = in_image.max()
+        for out_dtype in [np.int8, np.uint8, np.int16]:
+            if np.dtype(out_dtype).itemsize >= in_image.dtype.itemsize:
+                return in_image
+            if np.iinfo(out_dtype).min <= min_value and max_value <= np.iinfo(out_dtype).max:
+                out_image = in_image.astype(out_dtype)
+                if np.issubdtype(in_image.dtype, np.floating) and not np.array_equal(out_image, in_image):
+                    # non-integer values
+                    return in_image
+                return out_image
+        return in_image
+
 
 class NetworksUtil:
     # size_input: dims (dz, dx, dy) of input image to network
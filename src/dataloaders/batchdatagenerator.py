@@ -6,6 +6,7 @@ from common.exceptionmanager import catch_error_exception
 from common.functionutil import ImagesUtil
 from imageoperators.boundingboxes import BoundingBoxes
 from imageoperators.imageoperator import CropImage
+from dataloaders.imagedataworkingset import ImageDataWorkingSet
 from preprocessing.imagegenerator import ImageGenerator
 
 
@@ -21,6 +22,13 @@ class BatchDataGenerator(object):
         self._batch_size = batch_size
         self._shuffle = shuffle
         self._seed = seed
+        # the random streams of the shuffle in each epoch, and of the data augmentation of each sample, derive
+        # from (base_seed, epoch) and (base_seed, epoch, index_sample), so any sample can be generated independently
+        if seed is not None:
+            self._base_seed = seed
+        else:
+            self._base_seed = int(np.random.randint(np.iinfo(np.int32).max))
+        self._epoch_count = -1
 
         self._on_epoch_end()
 
@@ -30,15 +38,27 @@ class BatchDataGenerator(object):
 
     def _on_epoch_end(self) -> None:
         "Updates indexes after each epoch"
-        self._indexes = np.arange(self._size_data)
-        if (self._size_data % self._batch_size != 0):
-            extra_indexes = np.random.randint(self._size_data, size=self._batch_size)
-            self._indexes = np.concatenate([self._indexes, extra_indexes])
+        self._epoch_count += 1
+        self._indexes = self.get_indexes_epoch(self._epoch_count, is_fill_last_batch=True)
+
+    def get_indexes_epoch(self, epoch: int, is_fill_last_batch: bool = False) -> np.ndarray:
+        random_state = ImageGenerator.get_random_state((self._base_seed, epoch))
+        out_indexes = np.arange(self._size_data)
+        if is_fill_last_batch and (self._size_data % self._batch_size != 0):
+            extra_indexes = random_state.integers(self._size_data, size=self._batch_size)
+            out_indexes = np.concatenate([out_indexes, extra_indexes])
 
         if self._shuffle:
-            if self._seed is not None:
-                np.random.seed(self._seed)
-            np.random.shuffle(self._indexes)
+            random_state.shuffle(out_indexes)
+        return out_indexes
+
+    def get_indexes_epoch_train(self, epoch: int) -> np.ndarray:
+        # indexes of the samples consumed by the trainer in this epoch: the last batch filled, as in '_on_epoch_end'
+        out_indexes = self.get_indexes_epoch(epoch, is_fill_last_batch=True)
+        return out_indexes[:len(self) * self._batch_size]
+
+    def _get_seed_sample(self, index: int) -> Tuple[int, int, int]:
+        return (self._base_seed, self._epoch_count, int(index))
 
     def _get_indexes_batch(self, index: int) -> List[int]:
         return self._indexes[index * self._batch_size: (index + 1) * self._batch_size]
@@ -51,6 +71,7 @@ class BatchDataGenerator(object):
 
 
 class BatchImageDataGenerator1Image(BatchDataGenerator):
+    _dtype_indexes_imagefile = np.dtype([('index_file', '<i4'), ('index_image', '<i8')])
 
     def __init__(self,
                  size_image: Union[Tuple[int, int, int], Tuple[int, int]],
@@ -68,6 +89,9 @@ class BatchImageDataGenerator1Image(BatchDataGenerator):
         self._dtype_xdata = list_xdata[0].dtype
         self._image_generator = image_generator
         self._num_channels_in = num_channels_in
+        # volumes read from file on demand, in a working set of volumes resident in memory
+        self._working_set = ImageDataWorkingSet.get_working_set_data(list_xdata)
+        self._epoch_working_set = -1
 
         self._num_images = self._compute_list_indexes_images_files(is_print_datagen_info)
 
@@ -76,24 +100,93 @@ class BatchImageDataGenerator1Image(BatchDataGenerator):
         super(BatchImageDataGenerator1Image, self).__init__(self._num_images, batch_size, shuffle, seed)
 
     def _compute_list_indexes_images_files(self, is_print_datagen_info: bool = False) -> int:
-        "Store pairs of indexes (index_file, index_batch)"
-        self._list_indexes_imagefile = []
+        "Store pairs of indexes (index_file, index_image_file), in a structured array"
+        list_num_images_files = []
 
         for ifile, i_xdata in enumerate(self._list_xdata):
             self._image_generator.update_image_data(i_xdata.shape)
             num_images_file = self._image_generator.get_num_images()
-
-            for index in range(num_images_file):
-                self._list_indexes_imagefile.append((ifile, index))
+            list_num_images_files.append(num_images_file)
 
             if is_print_datagen_info:
                 message = self._image_generator.get_text_description()
                 print("Image file: \'%s\'..." % (ifile))
                 print(message[:-1])   # remove trailing '\n'
 
-        num_images = len(self._list_indexes_imagefile)
+        num_images = int(np.sum(list_num_images_files))
+        self._indexes_imagefile = np.empty(num_images, dtype=self._dtype_indexes_imagefile)
+        offsets_images_files = np.cumsum([0] + list_num_images_files[:-1])
+        self._indexes_imagefile['index_file'] = np.repeat(np.arange(len(list_num_images_files)),
+                                                          list_num_images_files)
+        self._indexes_imagefile['index_image'] = np.arange(num_images) \
+            - np.repeat(offsets_images_files, list_num_images_files)
+        # the image generator is updated with the data of a file only when the next sample is from another file
+        self._index_file_image_generator = len(list_num_images_files) - 1
         return num_images
 
+    def get_indexes_epoch(self, epoch: int, is_fill_last_batch: bool = False) -> np.ndarray:
+        if self._working_set is not None and self._shuffle:
+            # (the last batch is not filled, so that the samples of each volume are only in its time in memory)
+            return self._get_indexes_epoch_working_set(epoch)
+        else:
+            return super(BatchImageDataGenerator1Image, self).get_indexes_epoch(epoch, is_fill_last_batch)
+
+    def _get_indexes_epoch_working_set(self, epoch: int) -> np.ndarray:
+        # order of the samples with only 'num_files_working_set' volumes in use at any time: the volumes enter the
+        # working set in a random order, and each sample is drawn uniformly among the samples left in the working
+        # set. When all the samples of a volume are drawn, the next volume enters. Each sample is drawn once per
+        # epoch, and the samples of all volumes are mixed as in the uniform shuffle, within the span of W volumes
+        random_state = ImageGenerator.get_random_state((self._base_seed, epoch))
+        num_images_files = np.bincount(self._indexes_imagefile['index_file'], minlength=len(self._list_xdata))
+        offsets_images_files = np.cumsum(num_images_files) - num_images_files
+
+        order_files = random_state.permutation(len(self._list_xdata))
+        order_files = order_files[num_images_files[order_files] > 0]
+        num_files_working_set = min(self._working_set.get_num_files_working_set(), len(order_files))
+
+        def _get_indexes_images_file_shuffled(index_file: int) -> np.ndarray:
+            return offsets_images_files[index_file] + random_state.permutation(num_images_files[index_file])
+
+        list_indexes_working_set = [_get_indexes_images_file_shuffled(index_file)
+                                    for index_file in order_files[:num_files_working_set]]
+        num_images_left_working_set = np.array([len(indexes) for indexes in list_indexes_working_set])
+        index_next_file = num_files_working_set
+
+        out_indexes = np.empty(self._size_data, dtype=np.int64)
+        for i in range(self._size_data):
+            index_draw = random_state.integers(np.sum(num_images_left_working_set))
+            index_slot = int(np.searchsorted(np.cumsum(num_images_left_working_set), index_draw, side='right'))
+            num_images_left_working_set[index_slot] -= 1
+            out_indexes[i] = list_indexes_working_set[index_slot][num_images_left_working_set[index_slot]]
+
+            if num_images_left_working_set[index_slot] == 0 and index_next_file < len(order_files):
+                list_indexes_working_set[index_slot] = _get_indexes_images_file_shuffled(order_files[index_next_file])
+                num_images_left_working_set[index_slot] = len(list_indexes_working_set[index_slot])
+                index_next_file += 1
+
+        return out_indexes
+
+    def _update_working_set_epoch(self) -> None:
+        # tell the working set the order of the volumes in this epoch, to prefetch them and release them when done
+        indexes_epoch = self.get_indexes_epoch(self._epoch_count)
+        self._working_set.set_order_files_epoch(self._indexes_imagefile['index_file'][indexes_epoch])
+        self._epoch_working_set = self._epoch_count
+
+    def _notify_working_set_sample_done(self, index_file: int) -> None:
+        if self._working_set is not None:
+            self._working_set.notify_sample_done(index_file)
+
+    def _get_indexes_image_file(self, index: int) -> Tuple[int, int]:
+        if self._working_set is not None and self._epoch_count != self._epoch_working_set:
+            self._update_working_set_epoch()
+
+        index_file = int(self._indexes_imagefile['index_file'][index])
+        index_image_file = int(self._indexes_imagefile['index_image'][index])
+        if index_file != self._index_file_image_generator:
+            self._image_generator.update_image_data(self._list_xdata[index_file].shape)
+            self._index_file_image_generator = index_file
+        return (index_file, index_image_file)
+
     def __getitem__(self, index: int) -> np.ndarray:
         return self._get_data_batch(index)
 
@@ -112,11 +205,13 @@ class BatchImageDataGenerator1Image(BatchDataGenerator):
 
     def _get_data_sample(self, index: int) -> np.ndarray:
         "Generate one sample of batch of data"
-        (index_file, index_image_file) = self._list_indexes_imagefile[index]
-        self._image_generator.update_image_data(self._list_xdata[index_file].shape)
+        (index_file, index_image_file) = self._get_indexes_image_file(index)
 
         out_xdata_elem = self._image_generator.get_image(self._list_xdata[index_file],
-                                                         index=index_image_file, seed=None)
+                                                         index=index_image_file,
+                                                         index_file=index_file,
+                                                         seed=self._get_seed_sample(index))
+        self._notify_working_set_sample_done(index_file)
         return self._process_sample_xdata(out_xdata_elem)
 
     def get_full_data(self) -> np.ndarray:
@@ -177,6 +272,8 @@ class BatchImageDataGenerator2Images(BatchImageDataGenerator1Image):
                       % (len(list_xdata), len(list_ydata))
             catch_error_exception(message)
 
+        self._image_generator.update_labels_data(self._list_ydata)
+
         self._is_nnet_validconvs = is_nnet_validconvs
         if is_nnet_validconvs and size_output_image and (size_image != size_output_image):
             self._size_output_image = size_output_image
@@ -215,12 +312,15 @@ class BatchImageDataGenerator2Images(BatchImageDataGenerator1Image):
 
     def _get_data_sample(self, index: int) -> Tuple[np.ndarray, np.ndarray]:
         "Generate one sample of batch of data"
-        (index_file, index_image_file) = self._list_indexes_imagefile[index]
-        self._image_generator.update_image_data(self._list_xdata[index_file].shape)
+        (index_file, index_image_file) = self._get_indexes_image_file(index)
 
         (out_xdata_elem, out_ydata_elem) = self._image_generator.get_2images(self._list_xdata[index_file],
                                                                              self._list_ydata[index_file],
-                                                                             index=index_image_file, seed=None)
+                                                                             index=index_image_file,
+                                                                             index_file=index_file,
+                                                                             label_data=self._list_ydata[index_file],
+                                                                             seed=self._get_seed_sample(index))
+        self._notify_working_set_sample_done(index_file)
         return (self._process_sample_xdata(out_xdata_elem),
                 self._process_sample_ydata(out_ydata_elem))
 
@@ -1,19 +1,79 @@
 
 from typing import List, Dict, Tuple, Union, Any
+import numpy as np
 
 from common.constant import TYPE_DNNLIB_USED
+from common.exceptionmanager import catch_error_exception
 if TYPE_DNNLIB_USED == 'Pytorch':
     from dataloaders.pytorch.batchdatagenerator import \
         WrapperTrainBatchImageDataGenerator1Image as TrainBatchImageDataGenerator1Image, \
-        WrapperTrainBatchImageDataGenerator2Images as TrainBatchImageDataGenerator2Images
+        WrapperTrainBatchImageDataGenerator2Images as TrainBatchImageDataGenerator2Images, \
+        WrapperPrebakedTrainBatchImageDataGenerator as PrebakedTrainBatchImageDataGenerator
 elif TYPE_DNNLIB_USED == 'Keras':
     from dataloaders.keras.batchdatagenerator import TrainBatchImageDataGenerator1Image, \
-        TrainBatchImageDataGenerator2Images
+        TrainBatchImageDataGenerator2Images, PrebakedTrainBatchImageDataGenerator
 from dataloaders.batchdatagenerator import BatchImageDataGenerator1Image, BatchImageDataGenerator2Images
-from dataloaders.imagedataloader import ImageDataLoader
+from common.functionutil import dirname, get_modiftime_file, get_size_file, ImagesUtil
+from dataloaders.imagedataloader import ImageDataLoader, ImageDataLoaderMemmap, ImageDataLoaderChunked, \
+    ImageDataLoaderShards
+from dataloaders.imagedatashards import ImageDataShards
+from dataloaders.imagedataworkingset import ImageDataWorkingSet
+from dataloaders.prebakedepochs import PrebakedEpochsBuffer
 from preprocessing.preprocessing_manager import get_image_generator, fill_missing_trans_rigid_params
 
 
+def get_image_data_loader(list_filenames: List[str],
+                          is_memmap_data: bool = False,
+                          is_chunked_data: bool = False
+                          ) -> ImageDataLoader:
+    if is_memmap_data and is_chunked_data:
+        message = 'Options \'is_memmap_data\' and \'is_chunked_data\' cannot be used together'
+        catch_error_exception(message)
+
+    if len(list_filenames) > 0 and ImageDataShards.is_shards_dir(dirname(list_filenames[0])):
+        # input files packed in shards: images are already memory-mapped from the shard files
+        return ImageDataLoaderShards
+    elif is_memmap_data:
+        return ImageDataLoaderMemmap
+    elif is_chunked_data:
+        return ImageDataLoaderChunked
+    else:
+        return ImageDataLoader
+
+
+def get_list_data_compact_dtype(list_data: List[np.ndarray]) -> List[np.ndarray]:
+    # hold the volumes loaded in memory in the smallest integer dtype possible (int8 labels, int16 CT), without loss
+    # (memory-mapped data is not converted: it stays in the dtype stored in disk)
+    return [ImagesUtil.get_image_compact_dtype(in_data)
+            if isinstance(in_data, np.ndarray) and not ImagesUtil.is_image_file_backed(in_data) else in_data
+            for in_data in list_data]
+
+
+def get_list_data_working_set(list_filenames_groups: List[Tuple[str, ...]],
+                              num_files_working_set: int,
+                              max_size_working_set_gb: float,
+                              is_memmap_data: bool = False,
+                              is_chunked_data: bool = False,
+                              num_workers_train: int = 0
+                              ) -> List[List[np.ndarray]]:
+    # views of the volumes in a working set, read from file on demand: only 'num_files_working_set' volumes are
+    # resident in memory at any time, for training data larger than the memory
+    if is_memmap_data or is_chunked_data or \
+            (len(list_filenames_groups) > 0 and ImageDataShards.is_shards_dir(dirname(list_filenames_groups[0][0]))):
+        message = 'Working set of volumes cannot be used with memory-mapped, chunked or sharded data'
+        catch_error_exception(message)
+    if num_workers_train > 0:
+        message = 'Working set of volumes cannot be used with \'num_workers_train\' > 0: the volumes resident ' \
+                  'are in the main process'
+        catch_error_exception(message)
+
+    max_size_bytes = int(max_size_working_set_gb * 1024 ** 3)
+    print("Working set of \'%s\' volumes in memory, with max size \'%s\' GB..."
+          % (num_files_working_set, max_size_working_set_gb))
+    working_set = ImageDataWorkingSet(list_filenames_groups, num_files_working_set, max_size_bytes)
+    return working_set.get_list_views_data()
+
+
 def get_imagedataloader_1image(list_filenames_1: List[str],
                                size_images: Union[Tuple[int, int, int], Tuple[int, int]],
                                is_generate_patches: bool,
@@ -25,11 +85,16 @@ def get_imagedataloader_1image(list_filenames_1: List[str],
                                trans_rigid_params: Union[Dict[str, Any], None],
                                batch_size: int = 1,
                                is_shuffle: bool = True,
-                               manual_seed: int = None
+                               manual_seed: int = None,
+                               is_memmap_data: bool = False,
+                               is_chunked_data: bool = False,
+                               num_workers_load: int = 1
                                ) -> BatchImageDataGenerator1Image:
     print("Generate Data Loader with Batch Generator...")
 
-    list_xdata = ImageDataLoader.load_1list_files(list_filenames_1)
+    image_data_loader = get_image_data_loader(list_filenames_1, is_memmap_data, is_chunked_data)
+    list_xdata = image_data_loader.load_1list_files(list_filenames_1, num_workers=num_workers_load)
+    list_xdata = get_list_data_compact_dtype(list_xdata)
 
     if not is_generate_patches and (len(list_xdata) == 1):
         size_images = list_xdata[0].shape
@@ -51,6 +116,7 @@ def get_imagedataloader_1image(list_filenames_1: List[str],
                                           trans_flip_dirs=trans_rigid_params['flip_dirs'],
                                           trans_zoom_range=trans_rigid_params['zoom_range'],
                                           trans_fill_mode=trans_rigid_params['fill_mode'],
+                                          trans_order_interp_image=trans_rigid_params['order_interp_image'],
                                           size_volume_images=size_volume_images)
     print(image_generator.get_text_description())
 
@@ -77,11 +143,19 @@ def get_imagedataloader_2images(list_filenames_1: List[str],
                                 size_output_images: Union[Tuple[int, int, int], Tuple[int, int]] = None,
                                 batch_size: int = 1,
                                 is_shuffle: bool = True,
-                                manual_seed: int = None
+                                manual_seed: int = None,
+                                is_memmap_data: bool = False,
+                                is_chunked_data: bool = False,
+                                num_workers_load: int = 1,
+                                prob_foreground_window: float = 0.5
                                 ) -> BatchImageDataGenerator2Images:
     print("Generate Data Loader with Batch Generator...")
 
-    (list_xdata, list_ydata) = ImageDataLoader.load_2list_files(list_filenames_1, list_filenames_2)
+    image_data_loader = get_image_data_loader(list_filenames_1, is_memmap_data, is_chunked_data)
+    (list_xdata, list_ydata) = image_data_loader.load_2list_files(list_filenames_1, list_filenames_2,
+                                                                  num_workers=num_workers_load)
+    list_xdata = get_list_data_compact_dtype(list_xdata)
+    list_ydata = get_list_data_compact_dtype(list_ydata)
 
     if not is_generate_patches and (len(list_xdata) == 1):
         size_images = list_xdata[0].shape
@@ -104,7 +178,9 @@ def get_imagedataloader_2images(list_filenames_1: List[str],
                                           trans_flip_dirs=trans_rigid_params['flip_dirs'],
                                           trans_zoom_range=trans_rigid_params['zoom_range'],
                                           trans_fill_mode=trans_rigid_params['fill_mode'],
-                                          size_volume_images=size_volume_images)
+                                          trans_order_interp_image=trans_rigid_params['order_interp_image'],
+                                          size_volume_images=size_volume_images,
+                                          prob_foreground_window=prob_foreground_window)
     print(image_generator.get_text_description())
 
     return BatchImageDataGenerator2Images(size_images,
@@ -131,11 +207,24 @@ def get_train_imagedataloader_1image(list_filenames_1: List[str],
                                      trans_rigid_params: Union[Dict[str, Any], None],
                                      batch_size: int = 1,
                                      is_shuffle: bool = True,
-                                     manual_seed: int = None
+                                     manual_seed: int = None,
+                                     is_memmap_data: bool = False,
+                                     is_chunked_data: bool = False,
+                                     num_workers_load: int = 1,
+                                     num_workers_train: int = 0,
+                                     num_files_working_set: int = None,
+                                     max_size_working_set_gb: float = None
                                      ) -> TrainBatchImageDataGenerator1Image:
     print("Generate Data Loader with Batch Generator...")
 
-    list_xdata = ImageDataLoader.load_1list_files(list_filenames_1)
+    if num_files_working_set:
+        (list_xdata,) = get_list_data_working_set([(filename,) for filename in list_filenames_1],
+                                                  num_files_working_set, max_size_working_set_gb,
+                                                  is_memmap_data, is_chunked_data, num_workers_train)
+    else:
+        image_data_loader = get_image_data_loader(list_filenames_1, is_memmap_data, is_chunked_data)
+        list_xdata = image_data_loader.load_1list_files(list_filenames_1, num_workers=num_workers_load)
+        list_xdata = get_list_data_compact_dtype(list_xdata)
 
     size_volume_images = list_xdata[0].shape if len(list_xdata) == 1 else (0, 0, 0)
     num_channels_in = 1
@@ -154,6 +243,7 @@ def get_train_imagedataloader_1image(list_filenames_1: List[str],
                                           trans_flip_dirs=trans_rigid_params['flip_dirs'],
                                           trans_zoom_range=trans_rigid_params['zoom_range'],
                                           trans_fill_mode=trans_rigid_params['fill_mode'],
+                                          trans_order_interp_image=trans_rigid_params['order_interp_image'],
                                           size_volume_images=size_volume_images)
     print(image_generator.get_text_description())
 
@@ -163,7 +253,8 @@ def get_train_imagedataloader_1image(list_filenames_1: List[str],
                                               num_channels_in=num_channels_in,
                                               batch_size=batch_size,
                                               shuffle=is_shuffle,
-                                              seed=manual_seed)
+                                              seed=manual_seed,
+                                              num_workers=num_workers_train)
 
 
 def get_train_imagedataloader_2images(list_filenames_1: List[str],
@@ -180,11 +271,31 @@ def get_train_imagedataloader_2images(list_filenames_1: List[str],
                                       size_output_images: Union[Tuple[int, int, int], Tuple[int, int]] = None,
                                       batch_size: int = 1,
                                       is_shuffle: bool = True,
-                                      manual_seed: int = None
+                                      manual_seed: int = None,
+                                      is_memmap_data: bool = False,
+                                      is_chunked_data: bool = False,
+                                      num_workers_load: int = 1,
+                                      num_workers_train: int = 0,
+                                      prob_foreground_window: float = 0.5,
+                                      num_files_working_set: int = None,
+                                      max_size_working_set_gb: float = None
                                       ) -> TrainBatchImageDataGenerator2Images:
     print("Generate Data Loader with Batch Generator...")
 
-    (list_xdata, list_ydata) = ImageDataLoader.load_2list_files(list_filenames_1, list_filenames_2)
+    if num_files_working_set:
+        if len(list_filenames_1) != len(list_filenames_2):
+            message = 'Size of list files 1 \'%s\' not equal to size of list files 2 \'%s\'' \
+                      % (len(list_filenames_1), len(list_filenames_2))
+            catch_error_exception(message)
+        (list_xdata, list_ydata) = get_list_data_working_set(list(zip(list_filenames_1, list_filenames_2)),
+                                                             num_files_working_set, max_size_working_set_gb,
+                                                             is_memmap_data, is_chunked_data, num_workers_train)
+    else:
+        image_data_loader = get_image_data_loader(list_filenames_1, is_memmap_data, is_chunked_data)
+        (list_xdata, list_ydata) = image_data_loader.load_2list_files(list_filenames_1, list_filenames_2,
+                                                                      num_workers=num_workers_load)
+        list_xdata = get_list_data_compact_dtype(list_xdata)
+        list_ydata = get_list_data_compact_dtype(list_ydata)
 
     size_volume_images = list_xdata[0].shape if len(list_xdata) == 1 else (0, 0, 0)
     num_channels_in = 1
@@ -204,7 +315,9 @@ def get_train_imagedataloader_2images(list_filenames_1: List[str],
                                           trans_flip_dirs=trans_rigid_params['flip_dirs'],
                                           trans_zoom_range=trans_rigid_params['zoom_range'],
                                           trans_fill_mode=trans_rigid_params['fill_mode'],
-                                          size_volume_images=size_volume_images)
+                                          trans_order_interp_image=trans_rigid_params['order_interp_image'],
+                                          size_volume_images=size_volume_images,
+                                          prob_foreground_window=prob_foreground_window)
     print(image_generator.get_text_description())
 
     return TrainBatchImageDataGenerator2Images(size_images,
@@ -217,4 +330,94 @@ def get_train_imagedataloader_2images(list_filenames_1: List[str],
                                                size_output_image=size_output_images,
                                                batch_size=batch_size,
                                                shuffle=is_shuffle,
-                                               seed=manual_seed)
+                                               seed=manual_seed,
+                                               num_workers=num_workers_train)
+
+
+def get_train_prebaked_dataloader(prebaked_epochs_dir: str,
+                                  batch_size: int = 1
+                                  ) -> PrebakedTrainBatchImageDataGenerator:
+    print("Generate Data Loader with Batch Generator from prebaked epochs in \'%s\'..." % (prebaked_epochs_dir))
+
+    return PrebakedTrainBatchImageDataGenerator(prebaked_epochs_dir,
+                                                batch_size=batch_size)
+
+
+def get_version_file_data(filename: str) -> Tuple[Any, ...]:
+    if ImageDataShards.is_shards_dir(dirname(filename)):
+        # files packed in shards: the names are virtual paths in the shards dir
+        return ImageDataShards.get_version_file(filename)
+    else:
+        return (get_modiftime_file(filename), get_size_file(filename))
+
+
+def get_valid_cached_dataloader_2images(cache_dir: str,
+                                        list_filenames_1: List[str],
+                                        list_filenames_2: List[str],
+                                        size_images: Union[Tuple[int, int, int], Tuple[int, int]],
+                                        is_generate_patches: bool,
+                                        type_generate_patches: str,
+                                        prop_overlap_slide_images: Union[Tuple[float, float, float],
+                                                                         Tuple[float, float]],
+                                        num_random_images: int,
+                                        is_nnet_validconvs: bool = False,
+                                        size_output_images: Union[Tuple[int, int, int], Tuple[int, int]] = None,
+                                        batch_size: int = 1,
+                                        manual_seed: int = None,
+                                        is_memmap_data: bool = False,
+                                        is_chunked_data: bool = False,
+                                        num_workers_load: int = 1,
+                                        prob_foreground_window: float = 0.5
+                                        ) -> PrebakedTrainBatchImageDataGenerator:
+    # the patches for validation (without augmentation) are the same in every epoch: generate them only once,
+    # stored in disk in the dtypes of the source data, and then read them in order in each epoch. The patches are
+    # generated again only if the input files or the settings have changed. Each patch is stored once: the last batch
+    # is not filled with repeated patches
+    print("Generate Data Loader with Batch Generator from cached patches in \'%s\'..." % (cache_dir))
+
+    key_data = {'files': [(filename,) + get_version_file_data(filename)
+                          for filename in list(list_filenames_1) + list(list_filenames_2)],
+                'size_images': tuple(size_images),
+                'is_generate_patches': is_generate_patches,
+                'type_generate_patches': type_generate_patches,
+                'prop_overlap_slide_images': tuple(prop_overlap_slide_images),
+                'num_random_images': num_random_images,
+                'size_output_images': tuple(size_output_images) if is_nnet_validconvs and size_output_images
+                else None,
+                'manual_seed': manual_seed,
+                'prob_foreground_window': prob_foreground_window,
+                'is_fill_last_batch': False}
+
+    if PrebakedEpochsBuffer.is_prebaked_data_updated(cache_dir, key_data):
+        print("Found cached patches up to date...")
+    else:
+        batchdata_generator = get_imagedataloader_2images(list_filenames_1,
+                                                          list_filenames_2,
+                                                          size_images=size_images,
+                                                          is_generate_patches=is_generate_patches,
+                                                          type_generate_patches=type_generate_patches,
+                                                          prop_overlap_slide_images=prop_overlap_slide_images,
+                                                          num_random_images=num_random_images,
+                                                          is_transform_images=False,
+                                                          type_transform_images='',
+                                                          trans_rigid_params=None,
+                                                          is_nnet_validconvs=is_nnet_validconvs,
+                                                          size_output_images=size_output_images,
+                                                          batch_size=batch_size,
+                                                          is_shuffle=False,
+                                                          manual_seed=manual_seed,
+                                                          is_memmap_data=is_memmap_data,
+                                                          is_chunked_data=is_chunked_data,
+                                                          num_workers_load=num_workers_load,
+                                                          prob_foreground_window=prob_foreground_window)
+
+        PrebakedEpochsBuffer.write_epochs(cache_dir, batchdata_generator,
+                                          num_epochs=1,
+                                          initial_epoch=0,
+                                          num_slots=1,
+                                          key_data=key_data,
+                                          is_fill_last_batch=False)
+
+    return PrebakedTrainBatchImageDataGenerator(cache_dir,
+                                                batch_size=batch_size,
+                                                is_fixed_epoch=True)
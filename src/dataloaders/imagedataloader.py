@@ -1,36 +1,49 @@
 
-from typing import List, Tuple, Union
+from typing import List, Tuple, Union, Iterator
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 from common.exceptionmanager import catch_error_exception
-from common.functionutil import is_exist_file
-from dataloaders.imagefilereader import ImageFileReader
+from common.functionutil import is_exist_file, makedir, movefile, join_path_names, dirname, basename_filenoext, \
+    get_modiftime_file
+from dataloaders.imagefilereader import ImageFileReader, NiftiReader, DicomReader, MemmapReader, Hdf5Reader, \
+    ImageFileRegionsView
+from dataloaders.imagedatashards import ImageDataShards
 
 
 class ImageDataLoader(object):
+    _num_workers_default = 1
+
+    @classmethod
+    def _get_image(cls, filename: str) -> np.ndarray:
+        return ImageFileReader.get_image(filename)
+
+    @classmethod
+    def _is_exist_file(cls, filename: str) -> bool:
+        return is_exist_file(filename)
 
     @classmethod
     def load_1file(cls, filename: str) -> np.ndarray:
-        if not is_exist_file(filename):
+        if not cls._is_exist_file(filename):
             message = 'input file does not exist: \'%s\'' % (filename)
             catch_error_exception(message)
 
-        return ImageFileReader.get_image(filename)
+        return cls._get_image(filename)
 
     @classmethod
     def load_2files(cls,
                     filename_1: str,
                     filename_2: str
                     ) -> Tuple[np.ndarray, np.ndarray]:
-        if not is_exist_file(filename_1):
+        if not cls._is_exist_file(filename_1):
             message = 'input file 1 does not exist: \'%s\'' % (filename_1)
             catch_error_exception(message)
-        if not is_exist_file(filename_2):
+        if not cls._is_exist_file(filename_2):
             message = 'input file 1 does not exist: \'%s\'' % (filename_2)
             catch_error_exception(message)
 
-        out_image_1 = ImageFileReader.get_image(filename_1)
-        out_image_2 = ImageFileReader.get_image(filename_2)
+        out_image_1 = cls._get_image(filename_1)
+        out_image_2 = cls._get_image(filename_2)
 
         if out_image_1.shape != out_image_2.shape:
             message = 'input image 1 and 2 of different size: (\'%s\' != \'%s\')' \
@@ -40,7 +53,16 @@ class ImageDataLoader(object):
         return (out_image_1, out_image_2)
 
     @classmethod
-    def load_1list_files(cls, list_filenames: List[str]) -> List[np.ndarray]:
+    def load_1list_files(cls,
+                         list_filenames: List[str],
+                         num_workers: int = _num_workers_default
+                         ) -> List[np.ndarray]:
+        if num_workers > 1 and len(list_filenames) > 1:
+            # decode several files concurrently (decompression and file reads release the GIL)
+            # 'map()' returns the images in the same order as the input files
+            with ThreadPoolExecutor(max_workers=min(num_workers, len(list_filenames))) as executor:
+                return list(executor.map(cls.load_1file, list_filenames))
+
         out_list_images = []
         for in_file in list_filenames:
             out_image = cls.load_1file(in_file)
@@ -51,13 +73,23 @@ class ImageDataLoader(object):
     @classmethod
     def load_2list_files(cls,
                          list_filenames_1: List[str],
-                         list_filenames_2: List[str]
+                         list_filenames_2: List[str],
+                         num_workers: int = _num_workers_default
                          ) -> Tuple[List[np.ndarray], List[np.ndarray]]:
         if len(list_filenames_1) != len(list_filenames_2):
             message = 'number files in list1 (%s) and list2 (%s) are not equal' \
                       % (len(list_filenames_1), len(list_filenames_2))
             catch_error_exception(message)
 
+        if num_workers > 1 and len(list_filenames_1) > 1:
+            # each worker loads a pair of files and checks their sizes are the same
+            with ThreadPoolExecutor(max_workers=min(num_workers, len(list_filenames_1))) as executor:
+                list_out_images = list(executor.map(cls.load_2files, list_filenames_1, list_filenames_2))
+
+            out_list_images_1 = [elem[0] for elem in list_out_images]
+            out_list_images_2 = [elem[1] for elem in list_out_images]
+            return (out_list_images_1, out_list_images_2)
+
         out_list_images_1 = []
         out_list_images_2 = []
         for in_file_1, in_file_2 in zip(list_filenames_1, list_filenames_2):
@@ -68,6 +100,97 @@ class ImageDataLoader(object):
         return (out_list_images_1, out_list_images_2)
 
 
+class ImageDataLoaderMemmap(ImageDataLoader):
+    # convert (only once) each input file to an uncompressed memory-mapped file, and load images as memmap views,
+    # so that only the memory pages touched when cropping image patches are resident in RAM
+    _name_memmap_cache_relpath = 'MemmapCache/'
+    _extension_memmap_files = '.mmap'
+
+    @classmethod
+    def _get_image(cls, filename: str) -> np.ndarray:
+        memmap_filename = cls.get_memmap_filename(filename)
+        if not cls._is_memmap_file_updated(filename, memmap_filename):
+            cls.convert_file_to_memmap(filename, memmap_filename)
+
+        return MemmapReader.get_image(memmap_filename)
+
+    @classmethod
+    def get_memmap_filename(cls, filename: str) -> str:
+        memmap_cache_path = join_path_names(dirname(filename), cls._name_memmap_cache_relpath)
+        makedir(memmap_cache_path)
+        return join_path_names(memmap_cache_path, basename_filenoext(filename) + cls._extension_memmap_files)
+
+    @staticmethod
+    def convert_file_to_memmap(filename: str, memmap_filename: str) -> None:
+        print("Convert input file to memory-mapped file: \'%s\'..." % (memmap_filename))
+        in_image = ImageFileReader.get_image(filename)
+        if issubclass(ImageFileReader._get_filereader_class(filename), (NiftiReader, DicomReader)):
+            in_metadata = ImageFileReader.get_image_metadata_info(filename)
+        else:
+            in_metadata = None
+        MemmapReader.write_image(memmap_filename, in_image, metadata=in_metadata)
+
+    @staticmethod
+    def _is_memmap_file_updated(filename: str, memmap_filename: str) -> bool:
+        # the header file is written the last: check it to tell whether the memmap file is complete
+        header_filename = MemmapReader.get_header_filename(memmap_filename)
+        return is_exist_file(memmap_filename) and is_exist_file(header_filename) \
+            and (get_modiftime_file(header_filename) >= get_modiftime_file(filename))
+
+
+class ImageDataLoaderChunked(ImageDataLoader):
+    # convert (only once) each input file to a chunked HDF5 file, and load images as views of these files,
+    # so that cropping image patches only reads and decompresses the chunks that the patch overlaps
+    _name_chunked_cache_relpath = 'ChunkedCache/'
+    _extension_chunked_files = '.hdf5'
+    _size_chunks_default = (64, 64, 64)
+    _compression_default = 'gzip'
+
+    @classmethod
+    def _get_image(cls, filename: str) -> ImageFileRegionsView:
+        chunked_filename = cls.get_chunked_filename(filename)
+        if not cls._is_chunked_file_updated(filename, chunked_filename):
+            cls.convert_file_to_chunked(filename, chunked_filename)
+
+        return ImageFileRegionsView(chunked_filename,
+                                    shape=Hdf5Reader.get_image_size(chunked_filename),
+                                    dtype=Hdf5Reader.get_image_dtype(chunked_filename))
+
+    @classmethod
+    def get_chunked_filename(cls, filename: str) -> str:
+        chunked_cache_path = join_path_names(dirname(filename), cls._name_chunked_cache_relpath)
+        makedir(chunked_cache_path)
+        return join_path_names(chunked_cache_path, basename_filenoext(filename) + cls._extension_chunked_files)
+
+    @classmethod
+    def convert_file_to_chunked(cls, filename: str, chunked_filename: str) -> None:
+        print("Convert input file to chunked file: \'%s\'..." % (chunked_filename))
+        in_image = ImageFileReader.get_image(filename)
+        # write in a temporary file and then rename it, so that the chunked file exists only when complete
+        chunked_filename_tmp = chunked_filename + '.tmp'
+        Hdf5Reader.write_image(chunked_filename_tmp, in_image,
+                               size_chunks=cls._size_chunks_default,
+                               compression=cls._compression_default)
+        movefile(chunked_filename_tmp, chunked_filename)
+
+    @staticmethod
+    def _is_chunked_file_updated(filename: str, chunked_filename: str) -> bool:
+        return is_exist_file(chunked_filename) \
+            and (get_modiftime_file(chunked_filename) >= get_modiftime_file(filename))
+
+
+class ImageDataLoaderShards(ImageDataLoader):
+    # load images from a dataset packed in shard files: the input files are the names of the files packed, as if
+    # they were in the shards dir. Images are loaded as memory-mapped views of the shard files
+    @classmethod
+    def _get_image(cls, filename: str) -> np.ndarray:
+        return ImageDataShards.get_image(filename)
+
+    @classmethod
+    def _is_exist_file(cls, filename: str) -> bool:
+        return ImageDataShards.is_exist_file(filename)
+
+
 class ImageDataBatchesLoader(ImageDataLoader):
     _max_load_images_default = None
 
@@ -139,21 +262,20 @@ class ImageDataBatchesLoader(ImageDataLoader):
                          list_filenames: List[str],
                          max_load_images: Union[int, None] = _max_load_images_default,
                          is_shuffle: bool = False
-                         ) -> List[np.ndarray]:
-        out_dtype = super(ImageDataBatchesLoader, self).load_1file(list_filenames[0]).dtype
-        out_batch_images = np.array([], dtype=out_dtype).reshape((0,) + self._size_image)
-        sumrun_out_images = 0
-
-        for in_file in list_filenames:
+                         ) -> np.ndarray:
+        # allocate the output once, with size and dtype from the file headers, and fill it with the images
+        (list_num_images_files, out_dtype) = self._get_info_load_images_files(list_filenames, max_load_images)
+        num_total_images = sum(list_num_images_files)
+        out_batch_images = np.empty((num_total_images,) + self._size_image, dtype=out_dtype)
+
+        count_images = 0
+        for in_file, num_images_file in zip(list_filenames, list_num_images_files):
+            if num_images_file == 0:
+                # do not decode the files beyond the max number of images to load
+                break
             in_stack_images = super(ImageDataBatchesLoader, self).load_1file(in_file)
-            num_images_stack = in_stack_images.shape[0]
-            sumrun_out_images = sumrun_out_images + num_images_stack
-
-            if max_load_images is not None and (sumrun_out_images > max_load_images):
-                num_images_rest_batch = num_images_stack - (sumrun_out_images - max_load_images)
-                in_stack_images = in_stack_images[0:num_images_rest_batch]
-
-            out_batch_images = np.concatenate((out_batch_images, in_stack_images), axis=0)
+            out_batch_images[count_images:count_images + num_images_file] = in_stack_images[0:num_images_file]
+            count_images += num_images_file
 
         if is_shuffle:
             (out_batch_images, _) = self._shuffle_data(out_batch_images)
@@ -165,32 +287,127 @@ class ImageDataBatchesLoader(ImageDataLoader):
                          list_filenames_2: List[str],
                          max_load_images: Union[int, None] = _max_load_images_default,
                          is_shuffle: bool = False
-                         ) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+                         ) -> Tuple[np.ndarray, np.ndarray]:
         if len(list_filenames_1) != len(list_filenames_2):
             message = 'number files in list1 (%s) and list2 (%s) are not equal' \
                       % (len(list_filenames_1), len(list_filenames_2))
             catch_error_exception(message)
 
-        out_dtype_1 = super(ImageDataBatchesLoader, self).load_1file(list_filenames_1[0]).dtype
-        out_dtype_2 = super(ImageDataBatchesLoader, self).load_1file(list_filenames_2[0]).dtype
-        out_batch_images_1 = np.array([], dtype=out_dtype_1).reshape((0,) + self._size_image)
-        out_batch_images_2 = np.array([], dtype=out_dtype_2).reshape((0,) + self._size_image)
-        sumrun_out_images = 0
+        (list_num_images_files, out_dtype_1) = self._get_info_load_images_files(list_filenames_1, max_load_images)
+        (_, out_dtype_2) = self._get_info_load_images_files(list_filenames_2, max_load_images)
+        num_total_images = sum(list_num_images_files)
+        out_batch_images_1 = np.empty((num_total_images,) + self._size_image, dtype=out_dtype_1)
+        out_batch_images_2 = np.empty((num_total_images,) + self._size_image, dtype=out_dtype_2)
 
-        for in_file1, in_file2 in zip(list_filenames_1, list_filenames_2):
+        count_images = 0
+        for in_file1, in_file2, num_images_file in zip(list_filenames_1, list_filenames_2, list_num_images_files):
+            if num_images_file == 0:
+                break
             (in_stack_images_1, in_stack_images_2) = super(ImageDataBatchesLoader, self).load_2files(in_file1, in_file2)
-            num_images_stack = in_stack_images_1.shape[0]
-            sumrun_out_images = sumrun_out_images + num_images_stack
-
-            if max_load_images is not None and (sumrun_out_images > max_load_images):
-                num_images_rest_batch = num_images_stack - (sumrun_out_images - max_load_images)
-                in_stack_images_1 = in_stack_images_1[0:num_images_rest_batch]
-                in_stack_images_2 = in_stack_images_2[0:num_images_rest_batch]
-
-            out_batch_images_1 = np.concatenate((out_batch_images_1, in_stack_images_1), axis=0)
-            out_batch_images_2 = np.concatenate((out_batch_images_2, in_stack_images_2), axis=0)
+            out_batch_images_1[count_images:count_images + num_images_file] = in_stack_images_1[0:num_images_file]
+            out_batch_images_2[count_images:count_images + num_images_file] = in_stack_images_2[0:num_images_file]
+            count_images += num_images_file
 
         if is_shuffle:
             (out_batch_images_1, out_batch_images_2) = self._shuffle_data(out_batch_images_1, out_batch_images_2)
 
         return (out_batch_images_1, out_batch_images_2)
+
+    def iterate_1list_files(self,
+                            list_filenames: List[str],
+                            size_chunk: int,
+                            max_load_images: Union[int, None] = _max_load_images_default
+                            ) -> Iterator[np.ndarray]:
+        # yield chunks of 'size_chunk' images (the last can be smaller), keeping in memory only one file at a time
+        (list_num_images_files, out_dtype) = self._get_info_load_images_files(list_filenames, max_load_images)
+        out_chunk_images = np.empty((size_chunk,) + self._size_image, dtype=out_dtype)
+
+        count_images_chunk = 0
+        for in_file, num_images_file in zip(list_filenames, list_num_images_files):
+            if num_images_file == 0:
+                break
+            in_stack_images = super(ImageDataBatchesLoader, self).load_1file(in_file)
+
+            index_image = 0
+            while index_image < num_images_file:
+                num_images_copy = min(num_images_file - index_image, size_chunk - count_images_chunk)
+                out_chunk_images[count_images_chunk:count_images_chunk + num_images_copy] = \
+                    in_stack_images[index_image:index_image + num_images_copy]
+                index_image += num_images_copy
+                count_images_chunk += num_images_copy
+
+                if count_images_chunk == size_chunk:
+                    yield out_chunk_images.copy()
+                    count_images_chunk = 0
+
+        if count_images_chunk > 0:
+            yield out_chunk_images[0:count_images_chunk].copy()
+
+    def iterate_2list_files(self,
+                            list_filenames_1: List[str],
+                            list_filenames_2: List[str],
+                            size_chunk: int,
+                            max_load_images: Union[int, None] = _max_load_images_default
+                            ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        if len(list_filenames_1) != len(list_filenames_2):
+            message = 'number files in list1 (%s) and list2 (%s) are not equal' \
+                      % (len(list_filenames_1), len(list_filenames_2))
+            catch_error_exception(message)
+
+        (list_num_images_files, out_dtype_1) = self._get_info_load_images_files(list_filenames_1, max_load_images)
+        (_, out_dtype_2) = self._get_info_load_images_files(list_filenames_2, max_load_images)
+        out_chunk_images_1 = np.empty((size_chunk,) + self._size_image, dtype=out_dtype_1)
+        out_chunk_images_2 = np.empty((size_chunk,) + self._size_image, dtype=out_dtype_2)
+
+        count_images_chunk = 0
+        for in_file1, in_file2, num_images_file in zip(list_filenames_1, list_filenames_2, list_num_images_files):
+            if num_images_file == 0:
+                break
+            (in_stack_images_1, in_stack_images_2) = super(ImageDataBatchesLoader, self).load_2files(in_file1, in_file2)
+
+            index_image = 0
+            while index_image < num_images_file:
+                num_images_copy = min(num_images_file - index_image, size_chunk - count_images_chunk)
+                out_chunk_images_1[count_images_chunk:count_images_chunk + num_images_copy] = \
+                    in_stack_images_1[index_image:index_image + num_images_copy]
+                out_chunk_images_2[count_images_chunk:count_images_chunk + num_images_copy] = \
+                    in_stack_images_2[index_image:index_image + num_images_copy]
+                index_image += num_images_copy
+                count_images_chunk += num_images_copy
+
+                if count_images_chunk == size_chunk:
+                    yield (out_chunk_images_1.copy(), out_chunk_images_2.copy())
+                    count_images_chunk = 0
+
+        if count_images_chunk > 0:
+            yield (out_chunk_images_1[0:count_images_chunk].copy(), out_chunk_images_2[0:count_images_chunk].copy())
+
+    def _get_info_load_images_files(self,
+                                    list_filenames: List[str],
+                                    max_load_images: Union[int, None]
+                                    ) -> Tuple[List[int], np.dtype]:
+        # read only the file headers: number of images to load from each file, and dtype to store all images
+        list_num_images_files = []
+        list_dtypes_files = []
+        sumrun_out_images = 0
+        for in_file in list_filenames:
+            if max_load_images is not None and (sumrun_out_images >= max_load_images):
+                list_num_images_files.append(0)
+                continue
+
+            in_size_stack = ImageFileReader.get_image_size(in_file)
+            if tuple(in_size_stack[1:]) != self._size_image:
+                message = 'image size in input stack is different from image size in class: (\'%s\' != \'%s\'). ' \
+                          'change input size in class to be equal to the first' \
+                          % (tuple(in_size_stack[1:]), self._size_image)
+                catch_error_exception(message)
+
+            num_images_stack = in_size_stack[0]
+            if max_load_images is not None:
+                num_images_stack = min(num_images_stack, max_load_images - sumrun_out_images)
+            list_num_images_files.append(num_images_stack)
+            list_dtypes_files.append(ImageFileReader.get_image_dtype(in_file))
+            sumrun_out_images += num_images_stack
+
+        out_dtype = np.result_type(*list_dtypes_files)
+        return (list_num_images_files, out_dtype)
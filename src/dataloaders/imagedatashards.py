@@ -0,0 +1,228 @@
+
+from typing import List, Dict, Tuple, Any
+import numpy as np
+import fnmatch
+
+from common.exceptionmanager import catch_error_exception
+from common.functionutil import is_exist_file, join_path_names, makedir, movefile, removefile, basename, dirname, \
+    basename_filenoext, get_modiftime_file, get_size_file
+from dataloaders.imagefilereader import ImageFileReader, NiftiReader
+
+
+class ImageDataShards(object):
+    # packed dataset: image volumes concatenated (uncompressed) in a few large shard files, each with an index file
+    # that stores for each volume: the name of the original file, reference key, offset in shard, shape, dtype, affine
+    _name_shard_files = 'shard-%0.2i.bin'
+    _name_index_files = 'shard-%0.2i_index.npy'
+    _size_align_data = 4096
+    _max_size_shard_default = 4 * 1024**3
+    _max_ndim_images = 5
+    _dtype_index = np.dtype([('name', 'S128'),
+                             ('reference_key', 'S256'),
+                             ('offset', '<i8'),
+                             ('ndim', '<i4'),
+                             ('shape', '<i8', (_max_ndim_images,)),
+                             ('dtype', 'S16'),
+                             ('affine', '<f8', (4, 4))])
+
+    # cache (per process) of the shards open: {shards_dir: (versions_shards, dict_entries, list_shards_data)}
+    _dict_cache_shards_open = {}
+
+    @classmethod
+    def is_shards_dir(cls, dirname: str) -> bool:
+        return is_exist_file(join_path_names(dirname, cls._name_index_files % (0)))
+
+    @classmethod
+    def list_files_shards(cls, shards_dir: str, filename_pattern: str = '*') -> List[str]:
+        # return the names of the files packed, as if they were in the shards dir
+        (dict_entries, _) = cls._get_shards_open(shards_dir)
+        list_files = sorted(fnmatch.filter(dict_entries.keys(), filename_pattern))
+        if len(list_files) == 0:
+            message = 'No files found in shards in \'%s\' with \'%s\'' % (shards_dir, filename_pattern)
+            catch_error_exception(message)
+        return [join_path_names(shards_dir, in_name) for in_name in list_files]
+
+    @classmethod
+    def is_exist_file(cls, filename: str) -> bool:
+        shards_dir = dirname(filename)
+        if not cls.is_shards_dir(shards_dir):
+            return False
+        (dict_entries, _) = cls._get_shards_open(shards_dir)
+        return basename(filename) in dict_entries
+
+    @classmethod
+    def get_image(cls, filename: str) -> np.ndarray:
+        # return a read-only view of the volume in the shard, that is memory-mapped from disk
+        (dict_entries, list_shards_data) = cls._get_shards_open(dirname(filename))
+        in_name = basename(filename)
+        if in_name not in dict_entries:
+            message = 'file \'%s\' not found in shards in \'%s\'' % (in_name, dirname(filename))
+            catch_error_exception(message)
+
+        (index_shard, in_entry) = dict_entries[in_name]
+        in_shape = tuple(in_entry['shape'][:in_entry['ndim']])
+        in_dtype = np.dtype(in_entry['dtype'].decode())
+        num_elems = int(np.prod(in_shape))
+        return np.frombuffer(list_shards_data[index_shard], dtype=in_dtype, count=num_elems,
+                             offset=int(in_entry['offset'])).reshape(in_shape)
+
+    @classmethod
+    def get_version_file(cls, filename: str) -> Tuple[float, int, int]:
+        # version of a file packed: modification time and size of its shard file, and offset in the shard
+        (dict_entries, _) = cls._get_shards_open(dirname(filename))
+        in_name = basename(filename)
+        if in_name not in dict_entries:
+            message = 'file \'%s\' not found in shards in \'%s\'' % (in_name, dirname(filename))
+            catch_error_exception(message)
+
+        (index_shard, in_entry) = dict_entries[in_name]
+        shard_filename = join_path_names(dirname(filename), cls._name_shard_files % (index_shard))
+        return (get_modiftime_file(shard_filename), get_size_file(shard_filename), int(in_entry['offset']))
+
+    @classmethod
+    def get_image_affine(cls, filename: str) -> np.ndarray:
+        (dict_entries, _) = cls._get_shards_open(dirname(filename))
+        return np.copy(dict_entries[basename(filename)][1]['affine'])
+
+    @classmethod
+    def get_reference_keys(cls, shards_dir: str) -> Dict[str, str]:
+        (dict_entries, _) = cls._get_shards_open(shards_dir)
+        return {in_name: in_entry['reference_key'].decode() for in_name, (_, in_entry) in dict_entries.items()}
+
+    @classmethod
+    def write_shards(cls,
+                     shards_dir: str,
+                     list_filenames: List[str],
+                     dict_reference_keys: Dict[str, str],
+                     max_size_shard: int = _max_size_shard_default
+                     ) -> None:
+        if len(list_filenames) == 0:
+            message = 'no input files to pack in shards'
+            catch_error_exception(message)
+
+        # check the names fit in the fields of the index, before writing any shard
+        for in_file in list_filenames:
+            in_name = basename(in_file)
+            cls._check_size_field_index('name', in_name)
+            cls._check_size_field_index('reference_key', dict_reference_keys.get(basename_filenoext(in_name), ''))
+
+        makedir(shards_dir)
+        # remove the shards of a previous pack in this dir, otherwise those past the last shard written are read
+        cls._remove_shards(shards_dir)
+        list_entries_shard = []
+        index_shard = 0
+        offset_shard = 0
+        fout = cls._open_write_shard(shards_dir, index_shard)
+
+        for in_file in list_filenames:
+            in_image = np.ascontiguousarray(ImageFileReader.get_image(in_file))
+            if in_image.ndim > cls._max_ndim_images:
+                message = 'image with too many dims (\'%s\') to store in shard' % (in_image.ndim)
+                catch_error_exception(message)
+
+            if offset_shard > 0 and (offset_shard + in_image.nbytes > max_size_shard):
+                # start a new shard
+                cls._close_write_shard(fout, shards_dir, index_shard, list_entries_shard)
+                list_entries_shard = []
+                index_shard += 1
+                offset_shard = 0
+                fout = cls._open_write_shard(shards_dir, index_shard)
+
+            in_name = basename(in_file)
+            print("Pack file \'%s\' in shard \'%s\'..." % (in_name, cls._name_shard_files % (index_shard)))
+            in_entry = np.zeros((), dtype=cls._dtype_index)
+            in_entry['name'] = in_name.encode()
+            in_entry['reference_key'] = str(dict_reference_keys.get(basename_filenoext(in_name), '')).encode()
+            in_entry['offset'] = offset_shard
+            in_entry['ndim'] = in_image.ndim
+            in_entry['shape'][:in_image.ndim] = in_image.shape
+            in_entry['dtype'] = in_image.dtype.str.encode()
+            in_entry['affine'] = cls._get_image_affine_file(in_file)
+            list_entries_shard.append(in_entry)
+
+            fout.write(in_image.tobytes())
+            # align the start of the next volume in the shard
+            size_padding = (-in_image.nbytes) % cls._size_align_data
+            fout.write(b'\x00' * size_padding)
+            offset_shard += in_image.nbytes + size_padding
+        # endfor
+
+        cls._close_write_shard(fout, shards_dir, index_shard, list_entries_shard)
+
+    @classmethod
+    def _remove_shards(cls, shards_dir: str) -> None:
+        index_shard = 0
+        while is_exist_file(join_path_names(shards_dir, cls._name_index_files % (index_shard))) \
+                or is_exist_file(join_path_names(shards_dir, cls._name_shard_files % (index_shard))):
+            # remove the index file first, as its existence means that the shard file is complete
+            for in_filename in [cls._name_index_files % (index_shard), cls._name_shard_files % (index_shard)]:
+                if is_exist_file(join_path_names(shards_dir, in_filename)):
+                    removefile(join_path_names(shards_dir, in_filename))
+            index_shard += 1
+        cls._dict_cache_shards_open.pop(shards_dir, None)
+
+    @classmethod
+    def _check_size_field_index(cls, name_field: str, in_value: str) -> None:
+        size_value = len(str(in_value).encode())
+        size_field = cls._dtype_index[name_field].itemsize
+        if size_value > size_field:
+            message = 'value \'%s\' too long to store in field \'%s\' of shards index: \'%s\' > \'%s\' bytes' \
+                      % (in_value, name_field, size_value, size_field)
+            catch_error_exception(message)
+
+    @classmethod
+    def _open_write_shard(cls, shards_dir: str, index_shard: int) -> Any:
+        return open(join_path_names(shards_dir, cls._name_shard_files % (index_shard)), 'wb')
+
+    @classmethod
+    def _close_write_shard(cls, fout: Any, shards_dir: str, index_shard: int, list_entries: List[np.ndarray]) -> None:
+        fout.close()
+        # write the index file the last, so that its existence means that the shard file is complete
+        index_filename = join_path_names(shards_dir, cls._name_index_files % (index_shard))
+        index_filename_tmp = index_filename.replace('.npy', '_tmp.npy')
+        np.save(index_filename_tmp, np.array(list_entries, dtype=cls._dtype_index))
+        movefile(index_filename_tmp, index_filename)
+
+    @classmethod
+    def _get_shards_open(cls, shards_dir: str) -> Tuple[Dict[str, Tuple[int, np.ndarray]], List[np.memmap]]:
+        # read the index files (small), and memory-map the shard files, only once per process. Open them again if
+        # any index or shard file has changed
+        versions_shards = cls._get_versions_shards(shards_dir)
+        if shards_dir in cls._dict_cache_shards_open:
+            (versions_cached, dict_entries, list_shards_data) = cls._dict_cache_shards_open[shards_dir]
+            if versions_cached == versions_shards:
+                return (dict_entries, list_shards_data)
+
+        dict_entries = {}
+        list_shards_data = []
+        index_shard = 0
+        while is_exist_file(join_path_names(shards_dir, cls._name_index_files % (index_shard))):
+            in_index = np.load(join_path_names(shards_dir, cls._name_index_files % (index_shard)))
+            for in_entry in in_index:
+                dict_entries[in_entry['name'].decode()] = (index_shard, in_entry)
+            shard_filename = join_path_names(shards_dir, cls._name_shard_files % (index_shard))
+            list_shards_data.append(np.memmap(shard_filename, dtype=np.uint8, mode='r'))
+            index_shard += 1
+
+        cls._dict_cache_shards_open[shards_dir] = (versions_shards, dict_entries, list_shards_data)
+        return (dict_entries, list_shards_data)
+
+    @classmethod
+    def _get_versions_shards(cls, shards_dir: str) -> List[Tuple[float, float, int]]:
+        # modification times of the index and shard files, and size of the shard files
+        out_versions = []
+        index_shard = 0
+        while is_exist_file(join_path_names(shards_dir, cls._name_index_files % (index_shard))):
+            index_filename = join_path_names(shards_dir, cls._name_index_files % (index_shard))
+            shard_filename = join_path_names(shards_dir, cls._name_shard_files % (index_shard))
+            out_versions.append((get_modiftime_file(index_filename), get_modiftime_file(shard_filename),
+                                 get_size_file(shard_filename)))
+            index_shard += 1
+        return out_versions
+
+    @staticmethod
+    def _get_image_affine_file(filename: str) -> np.ndarray:
+        if issubclass(ImageFileReader._get_filereader_class(filename), NiftiReader):
+            return ImageFileReader.get_image_metadata_info(filename)
+        else:
+            return np.eye(4)
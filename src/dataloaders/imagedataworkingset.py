@@ -0,0 +1,242 @@
+
+from typing import List, Tuple, Dict, Union, Any
+import threading
+import numpy as np
+
+from common.exceptionmanager import catch_error_exception
+from dataloaders.imagefilereader import ImageFileReader
+
+
+class ImageDataWorkingSet(object):
+    # training data larger than the memory: the volumes are read from file on demand, and only a working set of
+    # 'num_files_working_set' volumes (plus the ones prefetched ahead) is resident in memory, within 'max_size_bytes'.
+    # The batch generator draws the samples of each epoch only from the resident volumes, and tells the working set
+    # the order of the volumes in the epoch ('set_order_files_epoch') and each sample done ('notify_sample_done').
+    # A volume is released when all its samples in the epoch are done, and the next volumes in the order of the
+    # epoch are read in a background thread. Each volume is read together with the other files of its group
+    # (e.g. the image and its labels)
+
+    def __init__(self,
+                 list_filenames_groups: List[Tuple[str, ...]],
+                 num_files_working_set: int,
+                 max_size_bytes: int,
+                 num_files_prefetch: int = 1
+                 ) -> None:
+        if num_files_working_set < 1:
+            message = 'ImageDataWorkingSet:__init__: wrong \'num_files_working_set\': %s' % (num_files_working_set)
+            catch_error_exception(message)
+
+        self._list_filenames_groups = [tuple(filenames_group) for filenames_group in list_filenames_groups]
+        self._num_files = len(self._list_filenames_groups)
+        self._num_files_working_set = num_files_working_set
+        self._max_size_bytes = max_size_bytes
+        self._num_files_prefetch = num_files_prefetch
+
+        # the shape and dtype of the volumes are read from the file headers, without loading the volumes
+        self._list_shapes_groups = [tuple(tuple(ImageFileReader.get_image_size(filename))
+                                          for filename in filenames_group)
+                                    for filenames_group in self._list_filenames_groups]
+        self._list_dtypes_groups = [tuple(np.dtype(ImageFileReader.get_image_dtype(filename))
+                                          for filename in filenames_group)
+                                    for filenames_group in self._list_filenames_groups]
+        self._sizes_bytes_files = np.array([sum(int(np.prod(shape)) * dtype.itemsize
+                                                for (shape, dtype) in zip(shapes_group, dtypes_group))
+                                            for (shapes_group, dtypes_group)
+                                            in zip(self._list_shapes_groups, self._list_dtypes_groups)],
+                                           dtype=np.int64)
+
+        size_working_set = int(np.sum(np.sort(self._sizes_bytes_files)[::-1][:num_files_working_set]))
+        if size_working_set > max_size_bytes:
+            message = 'ImageDataWorkingSet:__init__: the \'%s\' largest volumes (\'%s\' bytes) do not fit in the ' \
+                      'max size of the working set: \'%s\' bytes' % (num_files_working_set, size_working_set,
+                                                                     max_size_bytes)
+            catch_error_exception(message)
+
+        self._dict_volumes_resident = {}
+        self._size_bytes_resident = 0
+        self._set_files_loading = set()
+        # the samples left of each volume in the epoch, and the volumes in the order of their first sample
+        self._num_samples_left_files = None
+        self._order_files_epoch = np.array([], dtype=np.int64)
+        self._index_next_prefetch = 0
+        self._num_hits = 0
+        self._num_misses = 0
+        self._condition = threading.Condition()
+        self._thread_prefetch = None
+
+    def get_num_files(self) -> int:
+        return self._num_files
+
+    def get_num_files_working_set(self) -> int:
+        return self._num_files_working_set
+
+    def get_list_views_data(self) -> List[List['ImageDataWorkingSetView']]:
+        # one list of views of the volumes for each file in the groups: e.g. ([images], [labels])
+        num_files_group = len(self._list_filenames_groups[0]) if self._num_files > 0 else 0
+        return [[ImageDataWorkingSetView(self, ifile, imember,
+                                         self._list_shapes_groups[ifile][imember],
+                                         self._list_dtypes_groups[ifile][imember])
+                 for ifile in range(self._num_files)]
+                for imember in range(num_files_group)]
+
+    @staticmethod
+    def get_working_set_data(list_data: List[Any]) -> Union['ImageDataWorkingSet', None]:
+        if len(list_data) > 0 and isinstance(list_data[0], ImageDataWorkingSetView):
+            return list_data[0].get_working_set()
+        else:
+            return None
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._condition:
+            return {'num_files_resident': len(self._dict_volumes_resident),
+                    'size_bytes_resident': self._size_bytes_resident,
+                    'num_hits': self._num_hits,
+                    'num_misses': self._num_misses}
+
+    def set_order_files_epoch(self, indexes_files_samples: np.ndarray) -> None:
+        # indexes of the volume of each sample, in the order of the samples in the epoch
+        indexes_files_samples = np.asarray(indexes_files_samples, dtype=np.int64)
+        (_, indexes_first_samples) = np.unique(indexes_files_samples, return_index=True)
+
+        with self._condition:
+            self._num_samples_left_files = np.bincount(indexes_files_samples, minlength=self._num_files)
+            self._order_files_epoch = indexes_files_samples[np.sort(indexes_first_samples)]
+            self._index_next_prefetch = 0
+
+            # release the volumes resident from the last epoch that are not needed soon in this epoch
+            num_files_keep = self._num_files_working_set + self._num_files_prefetch
+            set_files_keep = set(self._order_files_epoch[:num_files_keep].tolist())
+            for index_file in list(self._dict_volumes_resident.keys()):
+                if index_file not in set_files_keep:
+                    self._release_volume(index_file)
+
+            self._condition.notify_all()
+
+        if self._thread_prefetch is None:
+            self._thread_prefetch = threading.Thread(target=self._run_prefetch_volumes, daemon=True)
+            self._thread_prefetch.start()
+
+    def notify_sample_done(self, index_file: int) -> None:
+        with self._condition:
+            if self._num_samples_left_files is None or self._num_samples_left_files[index_file] <= 0:
+                return
+            self._num_samples_left_files[index_file] -= 1
+            if self._num_samples_left_files[index_file] == 0:
+                # all the samples of the volume in the epoch are done: free its space for the next volumes
+                self._release_volume(index_file)
+                self._condition.notify_all()
+
+    def get_volume(self, index_file: int, index_member: int) -> np.ndarray:
+        with self._condition:
+            while index_file in self._set_files_loading:
+                self._condition.wait()
+
+            if index_file in self._dict_volumes_resident:
+                self._num_hits += 1
+                return self._dict_volumes_resident[index_file][index_member]
+
+            self._num_misses += 1
+            # the volumes accessed outside the order of the epoch are read but not kept (e.g. to index the labels)
+            is_keep_resident = self._is_needed_epoch(index_file)
+            if is_keep_resident:
+                self._set_files_loading.add(index_file)
+
+        out_volumes = None
+        try:
+            out_volumes = self._load_volumes(index_file)
+        finally:
+            if is_keep_resident:
+                with self._condition:
+                    self._set_files_loading.discard(index_file)
+                    if out_volumes is not None:
+                        self._add_volume(index_file, out_volumes)
+                    self._condition.notify_all()
+
+        return out_volumes[index_member]
+
+    def _is_needed_epoch(self, index_file: int) -> bool:
+        return self._num_samples_left_files is not None and self._num_samples_left_files[index_file] > 0
+
+    def _add_volume(self, index_file: int, in_volumes: Tuple[np.ndarray, ...]) -> None:
+        self._dict_volumes_resident[index_file] = in_volumes
+        self._size_bytes_resident += sum(in_volume.nbytes for in_volume in in_volumes)
+
+    def _release_volume(self, index_file: int) -> None:
+        in_volumes = self._dict_volumes_resident.pop(index_file, None)
+        if in_volumes is not None:
+            self._size_bytes_resident -= sum(in_volume.nbytes for in_volume in in_volumes)
+
+    def _load_volumes(self, index_file: int) -> Tuple[np.ndarray, ...]:
+        # read directly with the file reader, not to keep a second copy of the volumes in the cache of images
+        return tuple(ImageFileReader._get_filereader_class(filename).get_image(filename)
+                     for filename in self._list_filenames_groups[index_file])
+
+    def _get_next_file_prefetch(self) -> Union[int, None]:
+        # the next volume in the order of the epoch that is not resident, if the working set has space for it
+        num_files_resident = len(self._dict_volumes_resident) + len(self._set_files_loading)
+        if num_files_resident >= self._num_files_working_set + self._num_files_prefetch:
+            return None
+
+        while self._index_next_prefetch < len(self._order_files_epoch):
+            index_file = int(self._order_files_epoch[self._index_next_prefetch])
+            if not self._is_needed_epoch(index_file) or index_file in self._dict_volumes_resident \
+                    or index_file in self._set_files_loading:
+                self._index_next_prefetch += 1
+                continue
+
+            size_bytes_needed = self._size_bytes_resident + self._sizes_bytes_files[index_file]
+            if num_files_resident > 0 and size_bytes_needed > self._max_size_bytes:
+                return None
+            return index_file
+
+        return None
+
+    def _run_prefetch_volumes(self) -> None:
+        while True:
+            with self._condition:
+                index_file = self._get_next_file_prefetch()
+                while index_file is None:
+                    self._condition.wait()
+                    index_file = self._get_next_file_prefetch()
+                self._set_files_loading.add(index_file)
+
+            out_volumes = None
+            try:
+                out_volumes = self._load_volumes(index_file)
+            except Exception as excep:
+                # leave the volume not resident: it is read again when accessed, and the error raised then
+                print("WARNING: error when prefetching the volume \'%s\': %s..." % (index_file, excep))
+            finally:
+                with self._condition:
+                    self._set_files_loading.discard(index_file)
+                    if out_volumes is not None and self._is_needed_epoch(index_file):
+                        self._add_volume(index_file, out_volumes)
+                    self._condition.notify_all()
+
+
+class ImageDataWorkingSetView(object):
+    # array-like view of a volume in the working set: the volume is read from file when accessed, if not resident
+
+    def __init__(self,
+                 working_set: ImageDataWorkingSet,
+                 index_file: int,
+                 index_member: int,
+                 shape: Tuple[int, ...],
+                 dtype: np.dtype
+                 ) -> None:
+        self._working_set = working_set
+        self._index_file = index_file
+        self._index_member = index_member
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+
+    def get_working_set(self) -> ImageDataWorkingSet:
+        return self._working_set
+
+    def __getitem__(self, index: Any) -> np.ndarray:
+        return self._working_set.get_volume(self._index_file, self._index_member)[index]
+
+    def __array__(self, dtype: np.dtype = None) -> np.ndarray:
+        out_image = self._working_set.get_volume(self._index_file, self._index_member)
+        return out_image.astype(dtype) if dtype is not None else out_image
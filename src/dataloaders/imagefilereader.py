@@ -1,9 +1,16 @@
 
-from typing import Tuple, Any
+from typing import Tuple, List, Dict, Union, Any, Callable
+from collections import OrderedDict
 import numpy as np
 import SimpleITK as sitk
 import pydicom
 import gzip
+import zlib
+import struct
+import copy
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import warnings
 with warnings.catch_warnings():
     # disable FutureWarning: conversion of the second argument of issubdtype from `float` to `np.floating` is deprecated
@@ -11,23 +18,33 @@ with warnings.catch_warnings():
     import nibabel as nib
     import h5py
 
+from common.constant import COMPRESS_LEVEL_NIFTI_FILES, NUM_THREADS_COMPRESS_NIFTI_FILES, MAX_SIZE_CACHE_IMAGES_MB
 from common.exceptionmanager import catch_error_exception
-from common.functionutil import fileextension
+from common.functionutil import fileextension, read_dictionary_numpy, save_dictionary_numpy, get_modiftime_file, \
+    get_size_file, is_exist_dir, is_exist_file, list_files_dir, makedir, join_path_names
+from imageoperators.boundingboxes import BoundBox3DType, BoundBox2DType
 
 
 class ImageFileReader(object):
+    # cache (per process) of the info read from the image headers, with entries {(filename, name_info): (mtime, info)}
+    _dict_cache_header_info = {}
+    # cache (per process) of the images read, opt-in
+    _cache_images = None
 
     @classmethod
     def get_image_position(cls, filename: str) -> Tuple[float, float, float]:
-        return cls._get_filereader_class(filename).get_image_position(filename)
+        return cls._get_cached_header_info(filename, 'position',
+                                           cls._get_filereader_class(filename).get_image_position)
 
     @classmethod
     def get_image_voxelsize(cls, filename: str) -> Tuple[float, float, float]:
-        return cls._get_filereader_class(filename).get_image_voxelsize(filename)
+        return cls._get_cached_header_info(filename, 'voxelsize',
+                                           cls._get_filereader_class(filename).get_image_voxelsize)
 
     @classmethod
     def get_image_metadata_info(cls, filename: str) -> Any:
-        return cls._get_filereader_class(filename).get_image_metadata_info(filename)
+        return cls._get_cached_header_info(filename, 'metadata',
+                                           cls._get_filereader_class(filename).get_image_metadata_info)
 
     @classmethod
     def update_image_metadata_info(cls, filename: str, **kwargs) -> Any:
@@ -36,18 +53,92 @@ class ImageFileReader(object):
 
     @classmethod
     def get_image_size(cls, filename: str) -> Tuple[int, int, int]:
-        return cls.get_image(filename).shape
+        return cls._get_cached_header_info(filename, 'size',
+                                           cls._get_filereader_class(filename).get_image_size)
+
+    @classmethod
+    def get_image_dtype(cls, filename: str) -> np.dtype:
+        return cls._get_cached_header_info(filename, 'dtype',
+                                           cls._get_filereader_class(filename).get_image_dtype)
 
     @classmethod
     def get_image(cls, filename: str) -> np.ndarray:
+        if ImageFileReader._cache_images is not None:
+            return ImageFileReader._cache_images.get_image(filename, cls._get_filereader_class(filename).get_image)
         return cls._get_filereader_class(filename).get_image(filename)
 
+    @classmethod
+    def get_image_region(cls, filename: str, in_boundbox: Union[BoundBox3DType, BoundBox2DType]) -> np.ndarray:
+        return cls._get_filereader_class(filename)._get_image_region(filename, in_boundbox)
+
     @classmethod
     def write_image(cls, filename: str, in_image: np.ndarray, **kwargs) -> None:
         cls._get_filereader_class(filename).write_image(filename, in_image, **kwargs)
 
+    @classmethod
+    def _get_image_region(cls, filename: str, in_boundbox: Union[BoundBox3DType, BoundBox2DType]) -> np.ndarray:
+        # default for formats that cannot be read partially: decode the full image and crop the region. Read the
+        # image through the cache of images, if enabled. Copy the region, not to keep a view of the full image
+        return np.array(cls._crop_image_region(ImageFileReader.get_image(filename), in_boundbox))
+
+    @classmethod
+    def enable_cache_images(cls, max_size_bytes: int) -> None:
+        # images returned from the cache are read-only, so that callers cannot modify the cached images
+        ImageFileReader._cache_images = ImageCacheLRU(max_size_bytes)
+
+    @classmethod
+    def disable_cache_images(cls) -> None:
+        ImageFileReader._cache_images = None
+
+    @classmethod
+    def get_stats_cache_images(cls) -> Union[Dict[str, int], None]:
+        if ImageFileReader._cache_images is not None:
+            return ImageFileReader._cache_images.get_stats()
+        else:
+            return None
+
+    @classmethod
+    def clear_cache_header_info(cls) -> None:
+        ImageFileReader._dict_cache_header_info.clear()
+
+    @classmethod
+    def _get_cached_header_info(cls, filename: str, name_info: str, func_get_header_info: Any) -> Any:
+        # the info is read again only if the file has been modified since the info was cached
+        key_cache = (filename, name_info)
+        modiftime_file = get_modiftime_file(filename)
+        if key_cache in ImageFileReader._dict_cache_header_info:
+            (modiftime_cached, header_info) = ImageFileReader._dict_cache_header_info[key_cache]
+            if modiftime_cached == modiftime_file:
+                # return a copy, as the metadata returned can be modified later in place
+                return copy.deepcopy(header_info)
+
+        header_info = func_get_header_info(filename)
+        ImageFileReader._dict_cache_header_info[key_cache] = (modiftime_file, header_info)
+        return copy.deepcopy(header_info)
+
+    @staticmethod
+    def _get_sitk_image_header_info(filename: str) -> sitk.ImageFileReader:
+        image_reader = sitk.ImageFileReader()
+        image_reader.SetFileName(filename)
+        image_reader.ReadImageInformation()
+        return image_reader
+
+    @staticmethod
+    def _get_sitk_dtype_from_header_info(image_reader: sitk.ImageFileReader) -> np.dtype:
+        # get the numpy dtype of the sitk pixel type from a dummy image of one voxel
+        dummy_image = sitk.Image([1] * image_reader.GetDimension(), image_reader.GetPixelID(),
+                                 image_reader.GetNumberOfComponents())
+        return sitk.GetArrayViewFromImage(dummy_image).dtype
+
+    @staticmethod
+    def _crop_image_region(in_image: np.ndarray, in_boundbox: Union[BoundBox3DType, BoundBox2DType]) -> np.ndarray:
+        return in_image[tuple(slice(limits[0], limits[1]) for limits in in_boundbox)]
+
     @staticmethod
     def _get_filereader_class(filename: str) -> 'ImageFileReader':
+        if is_exist_dir(filename):
+            # directory with the files of a dicom series (to write a new series, use 'DicomSeriesReader')
+            return DicomSeriesReader
         extension = fileextension(filename)
         if extension == '.nii' or extension == '.nii.gz':
             return NiftiReader
@@ -61,12 +152,16 @@ class ImageFileReader(object):
             return NumpyZReader
         elif extension == '.hdf5':
             return Hdf5Reader
+        elif extension == '.mmap':
+            return MemmapReader
         else:
             message = "Not valid file extension: %s..." % (extension)
             catch_error_exception(message)
 
 
 class NiftiReader(ImageFileReader):
+    _compress_level_default = COMPRESS_LEVEL_NIFTI_FILES
+    _num_threads_compress_default = NUM_THREADS_COMPRESS_NIFTI_FILES
 
     @classmethod
     def get_image_position(cls, filename: str) -> Tuple[float, float, float]:
@@ -88,17 +183,50 @@ class NiftiReader(ImageFileReader):
         translate_factor = kwargs['translate_factor'] if 'translate_factor' in kwargs.keys() else None
         return cls._update_affine_matrix(in_metadata, rescale_factor, translate_factor)
 
+    @classmethod
+    def get_image_size(cls, filename: str) -> Tuple[int, int, int]:
+        # 'nib.load()' only reads the header, the image data is loaded when requested
+        out_shape = list(nib.load(filename).shape)
+        out_shape[0], out_shape[2] = out_shape[2], out_shape[0]     # same as in '_fix_dims_image_read()'
+        return tuple(out_shape)
+
+    @classmethod
+    def get_image_dtype(cls, filename: str) -> np.dtype:
+        nib_image = nib.load(filename)
+        # (nibabel moves the scaling factors from the header to the array proxy when loading the file)
+        if (nib_image.dataobj.slope, nib_image.dataobj.inter) != (1.0, 0.0):
+            # data rescaled (in float64) when read: the output dtype is not the one stored in the header
+            return np.result_type(nib_image.get_data_dtype(), np.float64)
+        return nib_image.get_data_dtype()
+
     @classmethod
     def get_image(cls, filename: str) -> np.ndarray:
-        out_image = nib.load(filename).get_data()
+        if fileextension(filename) == '.nii.gz' and GzipManager.is_multiblock_file(filename):
+            # inflate the gzip members of the file in parallel
+            with open(filename, 'rb') as fin:
+                in_data = fin.read()
+            in_data = GzipManager.decompress_data_multiblock(in_data, cls._num_threads_compress_default)
+            out_image = nib.Nifti1Image.from_bytes(in_data).get_data()
+        else:
+            out_image = nib.load(filename).get_data()
         return cls._fix_dims_image_read(out_image)
 
     @classmethod
     def write_image(cls, filename: str, in_image: np.ndarray, **kwargs) -> None:
         affine = kwargs['metadata'] if 'metadata' in kwargs.keys() else None
+        compress_level = kwargs['compress_level'] if 'compress_level' in kwargs.keys() \
+            else cls._compress_level_default
+        num_threads = kwargs['num_threads'] if 'num_threads' in kwargs.keys() \
+            else cls._num_threads_compress_default
         in_image = cls._fix_dims_image_write(in_image)
         nib_image = nib.Nifti1Image(in_image, affine)
-        nib.save(nib_image, filename)
+        if fileextension(filename) == '.nii.gz' and (compress_level is not None or num_threads > 1):
+            # compress blocks of data in parallel, and write them as members of a standard multi-member gzip file
+            out_data = GzipManager.compress_data_multiblock(nib_image.to_bytes(), compress_level, num_threads)
+            with open(filename, 'wb') as fout:
+                fout.write(out_data)
+        else:
+            nib.save(nib_image, filename)
 
     @staticmethod
     def _get_image_affine_matrix(filename: str) -> np.ndarray:
@@ -170,7 +298,7 @@ class DicomReader(ImageFileReader):
 
     @classmethod
     def get_image_position(cls, filename: str) -> Tuple[float, float, float]:
-        ds = pydicom.read_file(filename)
+        ds = pydicom.read_file(filename, stop_before_pixels=True)
         image_position_str = ds[0x0020, 0x0032].value   # Elem 'Image Position (Patient)'
         return (float(image_position_str[0]),
                 float(image_position_str[1]),
@@ -178,11 +306,21 @@ class DicomReader(ImageFileReader):
 
     @classmethod
     def get_image_voxelsize(cls, filename: str) -> Tuple[float, float, float]:
-        ds = pydicom.read_file(filename)
+        ds = pydicom.read_file(filename, stop_before_pixels=True)
         return (float(ds.SpacingBetweenSlices),
                 float(ds.PixelSpacing[0]),
                 float(ds.PixelSpacing[1]))
 
+    @classmethod
+    def get_image_size(cls, filename: str) -> Tuple[int, int, int]:
+        ds = pydicom.read_file(filename, stop_before_pixels=True)
+        num_frames = int(ds.NumberOfFrames) if 'NumberOfFrames' in ds else 1
+        return (num_frames, int(ds.Rows), int(ds.Columns))
+
+    @classmethod
+    def get_image_dtype(cls, filename: str) -> np.dtype:
+        return cls._get_sitk_dtype_from_header_info(cls._get_sitk_image_header_info(filename))
+
     @staticmethod
     def get_dicom_header(filename: str, is_return_tags_description: bool = False) -> Any:
         header_read = pydicom.read_file(filename)
@@ -193,9 +331,10 @@ class DicomReader(ImageFileReader):
 
     @classmethod
     def get_image_metadata_info(cls, filename: str) -> Any:
-        image_read = sitk.ReadImage(filename)
-        metadata_keys = image_read.GetMetaDataKeys()
-        return {key: image_read.GetMetaData(key) for key in metadata_keys}
+        # read only the header info, not the image data
+        image_reader = cls._get_sitk_image_header_info(filename)
+        metadata_keys = image_reader.GetMetaDataKeys()
+        return {key: image_reader.GetMetaData(key) for key in metadata_keys}
 
     @classmethod
     def update_image_metadata_info(cls, in_metadata: Any, **kwargs) -> Any:
@@ -251,8 +390,176 @@ class DicomReader(ImageFileReader):
         return inout_metadata
 
 
+class DicomSeriesReader(DicomReader):
+    # dicom series stored as a directory with one file per slice. The slices are sorted by their 'Image Position'
+    # along the normal to the slices, and read / written in parallel. The image geometry is read once per series,
+    # and the sorted slices are cached until the files in the directory change
+    _num_threads_default = 8
+    _name_slice_files_write = 'slice-%0.4i.dcm'
+
+    @classmethod
+    def get_image_position(cls, filename: str) -> Tuple[float, float, float]:
+        list_slice_files = cls._get_list_slice_files_sorted(filename)
+        return super(DicomSeriesReader, cls).get_image_position(list_slice_files[0])
+
+    @classmethod
+    def get_image_voxelsize(cls, filename: str) -> Tuple[float, float, float]:
+        list_slice_files = cls._get_list_slice_files_sorted(filename)
+        ds = pydicom.read_file(list_slice_files[0], stop_before_pixels=True)
+        if len(list_slice_files) > 1:
+            # distance between slices computed from their positions, as the tag 'Spacing Between Slices' is optional
+            position_first = np.array(ds.ImagePositionPatient, dtype=np.float64)
+            ds_next = pydicom.read_file(list_slice_files[1], stop_before_pixels=True)
+            position_next = np.array(ds_next.ImagePositionPatient, dtype=np.float64)
+            spacing_slices = float(np.linalg.norm(position_next - position_first))
+        else:
+            spacing_slices = float(ds.SpacingBetweenSlices) if 'SpacingBetweenSlices' in ds else 1.0
+        return (spacing_slices,
+                float(ds.PixelSpacing[0]),
+                float(ds.PixelSpacing[1]))
+
+    @classmethod
+    def get_image_size(cls, filename: str) -> Tuple[int, int, int]:
+        list_slice_files = cls._get_list_slice_files_sorted(filename)
+        ds = pydicom.read_file(list_slice_files[0], stop_before_pixels=True)
+        return (len(list_slice_files), int(ds.Rows), int(ds.Columns))
+
+    @classmethod
+    def get_image_dtype(cls, filename: str) -> np.dtype:
+        list_slice_files = cls._get_list_slice_files_sorted(filename)
+        return super(DicomSeriesReader, cls).get_image_dtype(list_slice_files[0])
+
+    @classmethod
+    def get_image_metadata_info(cls, filename: str) -> Any:
+        list_slice_files = cls._get_list_slice_files_sorted(filename)
+        return super(DicomSeriesReader, cls).get_image_metadata_info(list_slice_files[0])
+
+    @classmethod
+    def get_image(cls, filename: str) -> np.ndarray:
+        list_slice_files = cls._get_list_slice_files_sorted(filename)
+        # read the first slice to get the size and dtype of the volume, and allocate it once
+        in_first_slice = super(DicomSeriesReader, cls).get_image(list_slice_files[0])
+        out_image = np.empty((len(list_slice_files),) + in_first_slice.shape[1:], dtype=in_first_slice.dtype)
+        out_image[0] = in_first_slice[0]
+
+        def func_read_slice(index_slice: int) -> None:
+            in_slice = DicomReader.get_image(list_slice_files[index_slice])
+            if in_slice.shape[1:] != out_image.shape[1:]:
+                message = 'slice \'%s\' of different size than the first in series: (\'%s\' != \'%s\')' \
+                          % (list_slice_files[index_slice], in_slice.shape[1:], out_image.shape[1:])
+                catch_error_exception(message)
+            out_image[index_slice] = in_slice[0]
+
+        cls._run_in_parallel(func_read_slice, range(1, len(list_slice_files)))
+        return out_image
+
+    @classmethod
+    def write_image(cls, filename: str, in_image: np.ndarray, **kwargs) -> None:
+        # metadata are the header tags of the first slice in the series. For the other slices, the tags for
+        # 'Image Position' and 'Instance Number' are updated with the slice position in the series
+        dict_metadata = kwargs['metadata'] if 'metadata' in kwargs.keys() else {}
+        voxel_size = kwargs['voxel_size'] if 'voxel_size' in kwargs.keys() else None
+        if in_image.dtype != np.uint16:
+            in_image = in_image.astype(np.uint16)
+        makedir(filename)
+
+        tag_image_position = '0020|0032'
+        tag_image_orientation = '0020|0037'
+        tag_instance_number = '0020|0013'
+        tag_spacing_slices = '0018|0088'
+        if tag_image_position in dict_metadata:
+            position_first = np.array([float(elem) for elem in dict_metadata[tag_image_position].split('\\')])
+        else:
+            position_first = np.zeros(3)
+        if tag_image_orientation in dict_metadata:
+            orientation = np.array([float(elem) for elem in dict_metadata[tag_image_orientation].split('\\')])
+            direction_slices = np.cross(orientation[0:3], orientation[3:6])
+        else:
+            direction_slices = np.array([0.0, 0.0, 1.0])
+        if voxel_size is not None:
+            spacing_slices = voxel_size[0]
+        elif tag_spacing_slices in dict_metadata:
+            spacing_slices = float(dict_metadata[tag_spacing_slices])
+        else:
+            spacing_slices = 1.0
+        tag_pixel_spacing = '0028|0030'
+        if voxel_size is not None:
+            pixel_spacing = (voxel_size[1], voxel_size[2])
+        elif tag_pixel_spacing in dict_metadata:
+            pixel_spacing = tuple([float(elem) for elem in dict_metadata[tag_pixel_spacing].split('\\')])
+        else:
+            pixel_spacing = (1.0, 1.0)
+
+        def func_write_slice(index_slice: int) -> None:
+            image_write = sitk.GetImageFromArray(in_image[index_slice:index_slice + 1])
+            # sitk writes the pixel spacing from the image spacing, in dims (dx, dy, dz)
+            image_write.SetSpacing((pixel_spacing[1], pixel_spacing[0], spacing_slices))
+            for (key, val) in dict_metadata.items():
+                image_write.SetMetaData(key, val)
+            position_slice = position_first + index_slice * spacing_slices * direction_slices
+            image_write.SetMetaData(tag_image_position, '\\'.join(['%g' % (elem) for elem in position_slice]))
+            image_write.SetMetaData(tag_instance_number, str(index_slice + 1))
+            sitk.WriteImage(image_write, join_path_names(filename, cls._name_slice_files_write % (index_slice)))
+
+        cls._run_in_parallel(func_write_slice, range(in_image.shape[0]))
+        # the slice files may have been overwritten without changing the modification time of the directory
+        for key_cache in list(ImageFileReader._dict_cache_header_info):
+            if key_cache[0] == filename:
+                ImageFileReader._dict_cache_header_info.pop(key_cache, None)
+
+    @classmethod
+    def _get_list_slice_files_sorted(cls, dirname: str) -> List[str]:
+        return cls._get_cached_header_info(dirname, 'list_slice_files_sorted', cls._compute_list_slice_files_sorted)
+
+    @classmethod
+    def _compute_list_slice_files_sorted(cls, dirname: str) -> List[str]:
+        list_slice_files = [in_file for in_file in list_files_dir(dirname) if is_exist_file(in_file)]
+
+        def func_read_header_slice(in_file: str) -> Any:
+            return pydicom.read_file(in_file, stop_before_pixels=True,
+                                     specific_tags=['ImagePositionPatient', 'ImageOrientationPatient',
+                                                    'InstanceNumber'])
+
+        list_headers_slices = cls._run_in_parallel(func_read_header_slice, list_slice_files)
+
+        if all('ImagePositionPatient' in ds and 'ImageOrientationPatient' in ds for ds in list_headers_slices):
+            # sort by position of the slices along the normal to the slices
+            orientation = np.array(list_headers_slices[0].ImageOrientationPatient, dtype=np.float64)
+            direction_slices = np.cross(orientation[0:3], orientation[3:6])
+            list_keys_sort = [float(np.dot(np.array(ds.ImagePositionPatient, dtype=np.float64), direction_slices))
+                              for ds in list_headers_slices]
+        else:
+            list_keys_sort = [int(ds.InstanceNumber) if 'InstanceNumber' in ds else 0 for ds in list_headers_slices]
+
+        indexes_sorted = np.argsort(list_keys_sort, kind='stable')
+        return [list_slice_files[ind] for ind in indexes_sorted]
+
+    @classmethod
+    def _run_in_parallel(cls, func_run: Any, list_inputs: Any) -> List[Any]:
+        # threads overlap the file reads / writes, and sitk releases the GIL when decoding / encoding
+        list_inputs = list(list_inputs)
+        if cls._num_threads_default > 1 and len(list_inputs) > 1:
+            with ThreadPoolExecutor(max_workers=min(cls._num_threads_default, len(list_inputs))) as executor:
+                return list(executor.map(func_run, list_inputs))
+        else:
+            return [func_run(in_elem) for in_elem in list_inputs]
+
+
 class MHDRawReader(ImageFileReader):
 
+    @classmethod
+    def get_image_voxelsize(cls, filename: str) -> Tuple[float, float, float]:
+        # spacing in sitk is in dims (dx, dy, dz): reverse to be as in the image array
+        return tuple(reversed(cls._get_sitk_image_header_info(filename).GetSpacing()))
+
+    @classmethod
+    def get_image_size(cls, filename: str) -> Tuple[int, int, int]:
+        return tuple(reversed(cls._get_sitk_image_header_info(filename).GetSize()))
+
+    @classmethod
+    def get_image_dtype(cls, filename: str) -> np.dtype:
+        return cls._get_sitk_dtype_from_header_info(cls._get_sitk_image_header_info(filename))
+
     @classmethod
     def get_image(cls, filename: str) -> np.ndarray:
         image_read = sitk.ReadImage(filename)
@@ -266,10 +573,23 @@ class MHDRawReader(ImageFileReader):
 
 class NumpyReader(ImageFileReader):
 
+    @classmethod
+    def get_image_size(cls, filename: str) -> Tuple[int, int, int]:
+        # memory-mapping the file only reads the header
+        return np.load(filename, mmap_mode='r').shape
+
+    @classmethod
+    def get_image_dtype(cls, filename: str) -> np.dtype:
+        return np.load(filename, mmap_mode='r').dtype
+
     @classmethod
     def get_image(cls, filename: str) -> np.ndarray:
         return np.load(filename)
 
+    @classmethod
+    def _get_image_region(cls, filename: str, in_boundbox: Union[BoundBox3DType, BoundBox2DType]) -> np.ndarray:
+        return np.array(cls._crop_image_region(np.load(filename, mmap_mode='r'), in_boundbox))
+
     @classmethod
     def write_image(cls, filename: str, in_image: np.ndarray, **kwargs) -> None:
         np.save(filename, in_image)
@@ -277,6 +597,14 @@ class NumpyReader(ImageFileReader):
 
 class NumpyZReader(ImageFileReader):
 
+    @classmethod
+    def get_image_size(cls, filename: str) -> Tuple[int, int, int]:
+        return cls.get_image(filename).shape
+
+    @classmethod
+    def get_image_dtype(cls, filename: str) -> np.dtype:
+        return cls.get_image(filename).dtype
+
     @classmethod
     def get_image(cls, filename: str) -> np.ndarray:
         return np.load(filename)['arr_0']
@@ -287,6 +615,22 @@ class NumpyZReader(ImageFileReader):
 
 
 class Hdf5Reader(ImageFileReader):
+    # with data stored in chunks ('size_chunks' when writing), reading an image region only decompresses the chunks
+    # that the region overlaps
+
+    @classmethod
+    def get_image_size(cls, filename: str) -> Tuple[int, ...]:
+        data_file = h5py.File(filename, 'r')
+        out_shape = data_file['data'].shape
+        data_file.close()
+        return out_shape
+
+    @classmethod
+    def get_image_dtype(cls, filename: str) -> np.dtype:
+        data_file = h5py.File(filename, 'r')
+        out_dtype = data_file['data'].dtype
+        data_file.close()
+        return out_dtype
 
     @classmethod
     def get_image(cls, filename: str) -> np.ndarray:
@@ -295,12 +639,252 @@ class Hdf5Reader(ImageFileReader):
 
     @classmethod
     def write_image(cls, filename: str, in_image: np.ndarray, **kwargs) -> None:
+        size_chunks = kwargs['size_chunks'] if 'size_chunks' in kwargs.keys() else None
+        compression = kwargs['compression'] if 'compression' in kwargs.keys() else None
+        if size_chunks is not None:
+            # chunks not larger than the image, and chunk size for extra dims (i.e. channels) is the full dim
+            ndims_chunks = len(size_chunks)
+            chunks = tuple([min(size_chunk, size_dim) for (size_chunk, size_dim)
+                            in zip(size_chunks, in_image.shape)]) + in_image.shape[ndims_chunks:]
+        else:
+            chunks = None
+
         data_file = h5py.File(filename, 'w')
-        data_file.create_dataset('data', data=in_image)
+        if chunks is None and compression is None:
+            data_file.create_dataset('data', data=in_image)
+        else:
+            data_file.create_dataset('data', data=in_image, chunks=chunks, compression=compression)
         data_file.close()
 
+    @classmethod
+    def _get_image_region(cls, filename: str, in_boundbox: Union[BoundBox3DType, BoundBox2DType]) -> np.ndarray:
+        data_file = h5py.File(filename, 'r')
+        out_image = cls._crop_image_region(data_file['data'], in_boundbox)
+        data_file.close()
+        return out_image
+
+
+class MemmapReader(ImageFileReader):
+    # uncompressed raw array, with a header file (shape, dtype and metadata) stored next to it
+    _suffix_header_file = '.npy'
+
+    @classmethod
+    def get_image_metadata_info(cls, filename: str) -> Any:
+        return cls._read_header_file(filename)['metadata']
+
+    @classmethod
+    def get_image_size(cls, filename: str) -> Tuple[int, int, int]:
+        return tuple(cls._read_header_file(filename)['shape'])
+
+    @classmethod
+    def get_image_dtype(cls, filename: str) -> np.dtype:
+        return np.dtype(cls._read_header_file(filename)['dtype'])
+
+    @classmethod
+    def get_image(cls, filename: str) -> np.ndarray:
+        dict_header = cls._read_header_file(filename)
+        return np.memmap(filename, dtype=np.dtype(dict_header['dtype']), mode='r', shape=dict_header['shape'])
+
+    @classmethod
+    def _get_image_region(cls, filename: str, in_boundbox: Union[BoundBox3DType, BoundBox2DType]) -> np.ndarray:
+        return np.array(cls._crop_image_region(cls.get_image(filename), in_boundbox))
+
+    @classmethod
+    def write_image(cls, filename: str, in_image: np.ndarray, **kwargs) -> None:
+        metadata = kwargs['metadata'] if 'metadata' in kwargs.keys() else None
+        out_memmap = np.memmap(filename, dtype=in_image.dtype, mode='w+', shape=in_image.shape)
+        out_memmap[:] = in_image
+        out_memmap.flush()
+        del out_memmap
+        # write header file the last, so that its existence means that the data file is complete
+        dict_header = {'shape': tuple(in_image.shape), 'dtype': in_image.dtype.str, 'metadata': metadata}
+        save_dictionary_numpy(cls.get_header_filename(filename), dict_header)
+
+    @classmethod
+    def get_header_filename(cls, filename: str) -> str:
+        return filename + cls._suffix_header_file
+
+    @classmethod
+    def _read_header_file(cls, filename: str) -> Dict[str, Any]:
+        return read_dictionary_numpy(cls.get_header_filename(filename))
+
+
+class ImageFileRegionsView(object):
+    # array-like view of an image file, that only reads from disk the region of each cropped image patch
+
+    def __init__(self, filename: str, shape: Tuple[int, ...], dtype: np.dtype) -> None:
+        self._filename = filename
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, index: Any) -> np.ndarray:
+        in_boundbox = self._get_boundbox_from_index(index)
+        if in_boundbox is not None:
+            return ImageFileReader.get_image_region(self._filename, in_boundbox)
+        else:
+            return np.asarray(self)[index]
+
+    def __array__(self, dtype: np.dtype = None) -> np.ndarray:
+        out_image = ImageFileReader.get_image(self._filename)
+        return out_image.astype(dtype) if dtype is not None else out_image
+
+    def _get_boundbox_from_index(self, index: Any) -> Union[BoundBox3DType, BoundBox2DType, None]:
+        # only the indexing by slices (with unit step) is read from disk partially: i.e. 'CropImage' operators
+        if not isinstance(index, tuple):
+            index = (index,)
+        if len(index) > 0 and index[-1] is Ellipsis:
+            index = index[:-1]
+        if len(index) > self.ndim:
+            return None
+
+        out_boundbox = []
+        for i, index_dim in enumerate(index):
+            if not isinstance(index_dim, slice) or (index_dim.step not in (None, 1)):
+                return None
+            (limit_left, limit_right, _) = index_dim.indices(self.shape[i])
+            out_boundbox.append((limit_left, max(limit_left, limit_right)))
+        for i in range(len(index), self.ndim):
+            out_boundbox.append((0, self.shape[i]))
+
+        return tuple(out_boundbox)
+
+
+class ImageCacheLRU(object):
+    # cache of images read from file, with a max size in bytes, and evicting the least recently used images. The
+    # images are keyed by the filename, and are read again if the modification time or size of the file changed
+
+    def __init__(self, max_size_bytes: int) -> None:
+        self._max_size_bytes = max_size_bytes
+        self._dict_images = OrderedDict()
+        self._size_bytes = 0
+        self._num_hits = 0
+        self._num_misses = 0
+        self._lock = threading.Lock()
+
+    def get_image(self, filename: str, func_read_image: Callable[[str], np.ndarray]) -> np.ndarray:
+        version_file = (get_modiftime_file(filename), get_size_file(filename))
+        with self._lock:
+            if filename in self._dict_images:
+                (version_cached, out_image) = self._dict_images[filename]
+                if version_cached == version_file:
+                    self._dict_images.move_to_end(filename)
+                    self._num_hits += 1
+                    return out_image
+                else:
+                    self._remove_image(filename)
+            self._num_misses += 1
+
+        out_image = func_read_image(filename)
+
+        if isinstance(out_image, np.ndarray) and not isinstance(out_image, np.memmap) \
+                and out_image.nbytes <= self._max_size_bytes:
+            # do not cache memory-mapped images, nor images larger than the cache
+            out_image.setflags(write=False)
+            with self._lock:
+                if filename in self._dict_images:
+                    self._remove_image(filename)
+                self._dict_images[filename] = (version_file, out_image)
+                self._size_bytes += out_image.nbytes
+                while self._size_bytes > self._max_size_bytes:
+                    self._remove_image(next(iter(self._dict_images)))
+        return out_image
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'num_hits': self._num_hits,
+                    'num_misses': self._num_misses,
+                    'num_images': len(self._dict_images),
+                    'size_bytes': self._size_bytes}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._dict_images.clear()
+            self._size_bytes = 0
+
+    def _remove_image(self, filename: str) -> None:
+        (_, in_image) = self._dict_images.pop(filename)
+        self._size_bytes -= in_image.nbytes
+
+
+class ImageFileWriterAsync(object):
+    # write images to file in background threads, so that the processing of the next images goes on meanwhile.
+    # The queue of images pending to write is bounded, to limit the memory used. The images passed must not be
+    # modified afterwards. Errors when writing are reported when calling 'flush()' or 'close()'
+    _num_workers_default = 1
+    _max_size_queue_default = 2
+
+    def __init__(self,
+                 num_workers: int = _num_workers_default,
+                 max_size_queue: int = _max_size_queue_default
+                 ) -> None:
+        self._queue_images_write = queue.Queue(maxsize=max_size_queue)
+        self._list_errors_write = []
+        self._is_closed = False
+        self._list_workers = [threading.Thread(target=self._run_worker, daemon=True) for _ in range(num_workers)]
+        for worker in self._list_workers:
+            worker.start()
+
+    def __enter__(self) -> 'ImageFileWriterAsync':
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.close()
+
+    def write_image(self, filename: str, in_image: np.ndarray, **kwargs) -> None:
+        if self._is_closed:
+            message = 'Cannot write image \'%s\': the async writer is already closed' % (filename)
+            catch_error_exception(message)
+        # block if the queue is full, until a worker takes the next image to write
+        self._queue_images_write.put((filename, in_image, kwargs))
+
+    def flush(self) -> None:
+        # wait until all images in the queue are written
+        self._queue_images_write.join()
+        self._check_errors_write()
+
+    def close(self) -> None:
+        if self._is_closed:
+            return
+        self._is_closed = True
+        for _ in self._list_workers:
+            self._queue_images_write.put(None)
+        for worker in self._list_workers:
+            worker.join()
+        self._check_errors_write()
+
+    def _run_worker(self) -> None:
+        while True:
+            elem_queue = self._queue_images_write.get()
+            if elem_queue is None:
+                self._queue_images_write.task_done()
+                break
+            (filename, in_image, kwargs) = elem_queue
+            try:
+                ImageFileReader.write_image(filename, in_image, **kwargs)
+            except BaseException as exc:
+                # also catch 'SystemExit' from 'catch_error_exception()'
+                self._list_errors_write.append((filename, exc))
+            finally:
+                self._queue_images_write.task_done()
+
+    def _check_errors_write(self) -> None:
+        if len(self._list_errors_write) > 0:
+            list_errors = ['\'%s\': %s' % (filename, repr(exc)) for (filename, exc) in self._list_errors_write]
+            self._list_errors_write = []
+            message = 'Errors when writing images to file:\n%s' % ('\n'.join(list_errors))
+            catch_error_exception(message)
+
 
 class GzipManager(object):
+    # multi-member gzip files, with each member storing a block of data compressed independently. The size of each
+    # member is stored in an 'extra field' in the member header, so that the members can be inflated in parallel.
+    # These files can be read by any standard gzip reader
+    _compress_level_default = 6
+    _size_block_multiblock = 2**22
+    _id_extrafield_multiblock = b'MB'
+    _size_header_multiblock = 20
+    _size_trailer_multiblock = 8
 
     @staticmethod
     def get_read_file(filename: str) -> Any:
@@ -314,8 +898,89 @@ class GzipManager(object):
     def close_file(fileobj: Any) -> None:
         fileobj.close()
 
+    @classmethod
+    def is_multiblock_file(cls, filename: str) -> bool:
+        with open(filename, 'rb') as fin:
+            in_header = fin.read(cls._size_header_multiblock)
+        return cls._is_header_multiblock(in_header)
+
+    @classmethod
+    def compress_data_multiblock(cls, in_data: bytes, compress_level: int = None, num_threads: int = 1) -> bytes:
+        if compress_level is None:
+            compress_level = cls._compress_level_default
+        in_data = memoryview(in_data)
+        list_blocks = [in_data[i:i + cls._size_block_multiblock]
+                       for i in range(0, max(len(in_data), 1), cls._size_block_multiblock)]
+
+        def func_compress_block(in_block: memoryview) -> bytes:
+            return cls._compress_block(in_block, compress_level)
+
+        if num_threads > 1 and len(list_blocks) > 1:
+            # zlib releases the GIL when (de)compressing
+            with ThreadPoolExecutor(max_workers=min(num_threads, len(list_blocks))) as executor:
+                list_members = list(executor.map(func_compress_block, list_blocks))
+        else:
+            list_members = [func_compress_block(in_block) for in_block in list_blocks]
+
+        return b''.join(list_members)
+
+    @classmethod
+    def decompress_data_multiblock(cls, in_data: bytes, num_threads: int = 1) -> bytes:
+        in_data = memoryview(in_data)
+        list_members = []
+        offset = 0
+        while offset < len(in_data):
+            in_header = in_data[offset:offset + cls._size_header_multiblock]
+            if not cls._is_header_multiblock(in_header):
+                message = 'Wrong header of gzip member at byte \'%s\', not written as multi-block gzip' % (offset)
+                catch_error_exception(message)
+            size_member = struct.unpack('<I', in_header[16:20])[0]
+            list_members.append(in_data[offset:offset + size_member])
+            offset += size_member
+
+        if num_threads > 1 and len(list_members) > 1:
+            with ThreadPoolExecutor(max_workers=min(num_threads, len(list_members))) as executor:
+                list_blocks = list(executor.map(cls._decompress_member, list_members))
+        else:
+            list_blocks = [cls._decompress_member(in_member) for in_member in list_members]
+
+        return b''.join(list_blocks)
+
+    @classmethod
+    def _compress_block(cls, in_block: memoryview, compress_level: int) -> bytes:
+        # raw deflate stream, with the gzip header and trailer written here
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        out_deflated = compressor.compress(in_block) + compressor.flush()
+        size_member = cls._size_header_multiblock + len(out_deflated) + cls._size_trailer_multiblock
+        # header: magic, method deflate, flag FEXTRA, mtime 0, xfl 0, os unknown, extra field with the member size
+        out_header = b'\x1f\x8b\x08\x04' + b'\x00\x00\x00\x00' + b'\x00\xff' + struct.pack('<H', 8) \
+            + cls._id_extrafield_multiblock + struct.pack('<H', 4) + struct.pack('<I', size_member)
+        out_trailer = struct.pack('<II', zlib.crc32(in_block) & 0xffffffff, len(in_block) & 0xffffffff)
+        return out_header + out_deflated + out_trailer
+
+    @classmethod
+    def _decompress_member(cls, in_member: memoryview) -> bytes:
+        out_block = zlib.decompress(in_member[cls._size_header_multiblock:-cls._size_trailer_multiblock],
+                                    -zlib.MAX_WBITS)
+        (crc_member, size_block) = struct.unpack('<II', in_member[-cls._size_trailer_multiblock:])
+        if (zlib.crc32(out_block) & 0xffffffff) != crc_member or (len(out_block) & 0xffffffff) != size_block:
+            message = 'Wrong CRC or size of data in gzip member: data corrupted'
+            catch_error_exception(message)
+        return out_block
+
+    @classmethod
+    def _is_header_multiblock(cls, in_header: bytes) -> bool:
+        return len(in_header) == cls._size_header_multiblock and in_header[0:4] == b'\x1f\x8b\x08\x04' \
+            and in_header[12:14] == cls._id_extrafield_multiblock
+
 
 # all available file readers
 DICT_AVAIL_FILE_READER = {'nifti': NiftiReader,
                           'dicom': DicomReader,
-                          'numpy': NumpyReader}
+                          'dicom_series': DicomSeriesReader,
+                          'numpy': NumpyReader,
+                          'memmap': MemmapReader,
+                          'hdf5': Hdf5Reader}
+
+if MAX_SIZE_CACHE_IMAGES_MB > 0:
+    ImageFileReader.enable_cache_images(MAX_SIZE_CACHE_IMAGES_MB * 1024**2)
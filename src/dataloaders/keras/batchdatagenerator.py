@@ -5,6 +5,7 @@ import numpy as np
 from tensorflow.keras.utils import Sequence as Sequence_keras
 
 from dataloaders.batchdatagenerator import BatchImageDataGenerator1Image, BatchImageDataGenerator2Images
+from dataloaders.prebakedepochs import PrebakedBatchImageDataGenerator
 from preprocessing.imagegenerator import ImageGenerator
 
 OutputDataType = np.float32
@@ -20,8 +21,10 @@ class TrainBatchImageDataGenerator1Image(BatchImageDataGenerator1Image, Sequence
                  batch_size: int = 1,
                  shuffle: bool = True,
                  seed: int = None,
+                 num_workers: int = 0,
                  is_print_datagen_info: bool = False
                  ) -> None:
+        # 'num_workers' not used here: in keras, the workers to load the data are set in 'fit_generator'
         super(TrainBatchImageDataGenerator1Image, self).__init__(size_image,
                                                                  list_xdata,
                                                                  image_generator,
@@ -36,8 +39,9 @@ class TrainBatchImageDataGenerator1Image(BatchImageDataGenerator1Image, Sequence
     def __len__(self) -> int:
         return super(TrainBatchImageDataGenerator1Image, self).__len__()
 
-    def _on_epoch_end(self) -> None:
-        super(TrainBatchImageDataGenerator1Image, self)._on_epoch_end()
+    def on_epoch_end(self) -> None:
+        # called by keras at the end of each epoch
+        self._on_epoch_end()
 
     def __getitem__(self, index: int) -> np.ndarray:
         out_xdata = super(TrainBatchImageDataGenerator1Image, self).__getitem__(index)
@@ -58,8 +62,10 @@ class TrainBatchImageDataGenerator2Images(BatchImageDataGenerator2Images, Sequen
                  batch_size: int = 1,
                  shuffle: bool = True,
                  seed: int = None,
+                 num_workers: int = 0,
                  is_print_datagen_info: bool = False
                  ) -> None:
+        # 'num_workers' not used here: in keras, the workers to load the data are set in 'fit_generator'
         super(TrainBatchImageDataGenerator2Images, self).__init__(size_image,
                                                                   list_xdata,
                                                                   list_ydata,
@@ -78,10 +84,39 @@ class TrainBatchImageDataGenerator2Images(BatchImageDataGenerator2Images, Sequen
     def __len__(self) -> int:
         return super(TrainBatchImageDataGenerator2Images, self).__len__()
 
-    def _on_epoch_end(self) -> None:
-        super(TrainBatchImageDataGenerator2Images, self)._on_epoch_end()
+    def on_epoch_end(self) -> None:
+        # called by keras at the end of each epoch
+        self._on_epoch_end()
 
     def __getitem__(self, index: int) -> Tuple[np.ndarray, np.ndarray]:
         (out_xdata, out_ydata) = super(TrainBatchImageDataGenerator2Images, self).__getitem__(index)
         return (out_xdata.astype(dtype=OutputDataType),
                 out_ydata.astype(dtype=OutputDataType))
+
+
+class PrebakedTrainBatchImageDataGenerator(PrebakedBatchImageDataGenerator, Sequence_keras):
+
+    def __init__(self,
+                 buffer_dir: str,
+                 batch_size: int = 1,
+                 is_fixed_epoch: bool = False
+                 ) -> None:
+        super(PrebakedTrainBatchImageDataGenerator, self).__init__(buffer_dir,
+                                                                   batch_size=batch_size,
+                                                                   type_image_format='channels_last',
+                                                                   is_fixed_epoch=is_fixed_epoch)
+        Sequence_keras.__init__(self)
+
+    def __len__(self) -> int:
+        return super(PrebakedTrainBatchImageDataGenerator, self).__len__()
+
+    def on_epoch_end(self) -> None:
+        # called by keras at the end of each epoch
+        self._on_epoch_end()
+
+    def __getitem__(self, index: int) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        out_data = super(PrebakedTrainBatchImageDataGenerator, self).__getitem__(index)
+        if isinstance(out_data, tuple):
+            return (out_data[0].astype(dtype=OutputDataType), out_data[1].astype(dtype=OutputDataType))
+        else:
+            return out_data.astype(dtype=OutputDataType)
@@ -0,0 +1,304 @@
+
+from typing import Tuple, Dict, Any, Union
+import numpy as np
+import multiprocessing
+import time
+
+from common.exceptionmanager import catch_error_exception
+from common.functionutil import ImagesUtil, is_exist_file, join_path_names, makedir, movefile, removefile
+from dataloaders.batchdatagenerator import BatchImageDataGenerator1Image, BatchImageDataGenerator2Images
+
+
+class PrebakedEpochsBuffer(object):
+    # rolling buffer on disk with epochs of augmented samples, generated ahead of training by producer processes.
+    # The buffer has 'num_slots' slots, and the epoch 'e' is written in the slot 'e % num_slots', as '.npy' files
+    # (memory-mappable) with the samples in the order of training. Each slot has a marker file with the epoch
+    # stored, written the last, so that its existence means that the data of the epoch is complete. The producer
+    # reuses a slot only after the trainer has consumed the epoch in it (stored in the consumed marker file).
+    # A buffer with one epoch and one slot can also store a fixed set of samples, reused in every epoch (e.g. the
+    # patches for validation), with a key of the source data and settings to know when it is stale
+    _name_info_file = 'prebaked_info.npy'
+    _name_xdata_files = 'slot-%0.2i_xdata.npy'
+    _name_ydata_files = 'slot-%0.2i_ydata.npy'
+    _name_ready_files = 'slot-%0.2i_epoch.npy'
+    _name_consumed_file = 'consumed_epoch.npy'
+    _num_slots_default = 2
+    _time_poll_files = 1.0
+
+    @classmethod
+    def is_prebaked_dir(cls, dirname: str) -> bool:
+        return is_exist_file(join_path_names(dirname, cls._name_info_file))
+
+    @classmethod
+    def get_info(cls, buffer_dir: str) -> Dict[str, Any]:
+        if not cls.is_prebaked_dir(buffer_dir):
+            message = 'No buffer of prebaked epochs found in \'%s\'' % (buffer_dir)
+            catch_error_exception(message)
+        return dict(np.load(join_path_names(buffer_dir, cls._name_info_file), allow_pickle=True).item())
+
+    @classmethod
+    def is_prebaked_data_updated(cls, buffer_dir: str, key_data: Dict[str, Any]) -> bool:
+        if not cls.is_prebaked_dir(buffer_dir):
+            return False
+        info_buffer = cls.get_info(buffer_dir)
+        index_slot = info_buffer['initial_epoch'] % info_buffer['num_slots']
+        ready_filename = join_path_names(buffer_dir, cls._name_ready_files % (index_slot))
+        return info_buffer.get('key_data') == key_data and is_exist_file(ready_filename)
+
+    @classmethod
+    def write_epochs(cls,
+                     buffer_dir: str,
+                     batchdata_generator: BatchImageDataGenerator1Image,
+                     num_epochs: int,
+                     initial_epoch: int = 0,
+                     num_slots: int = _num_slots_default,
+                     num_processes: int = 1,
+                     key_data: Dict[str, Any] = None,
+                     is_fill_last_batch: bool = True
+                     ) -> None:
+        # 'is_fill_last_batch': store the samples as consumed by the trainer in each epoch, with the last batch
+        # filled if the trainer does so. Otherwise, store each sample only once (e.g. for validation)
+        makedir(buffer_dir)
+        if cls.is_prebaked_dir(buffer_dir):
+            # remove the markers of the epochs from a previous run, not to be read by the trainer
+            info_buffer_old = cls.get_info(buffer_dir)
+            removefile(join_path_names(buffer_dir, cls._name_info_file))
+            for index_slot in range(info_buffer_old['num_slots']):
+                ready_filename = join_path_names(buffer_dir, cls._name_ready_files % (index_slot))
+                if is_exist_file(ready_filename):
+                    removefile(ready_filename)
+
+        is_ydata = isinstance(batchdata_generator, BatchImageDataGenerator2Images)
+        num_samples = len(cls._get_indexes_epoch(batchdata_generator, initial_epoch, is_fill_last_batch))
+
+        info_buffer = {'initial_epoch': initial_epoch,
+                       'num_epochs': num_epochs,
+                       'num_slots': num_slots,
+                       'num_samples': num_samples,
+                       'is_ydata': is_ydata,
+                       'key_data': key_data}
+        cls._save_file_atomic(join_path_names(buffer_dir, cls._name_info_file), info_buffer)
+        if is_exist_file(join_path_names(buffer_dir, cls._name_consumed_file)):
+            removefile(join_path_names(buffer_dir, cls._name_consumed_file))
+
+        for epoch in range(initial_epoch, num_epochs):
+            index_slot = epoch % num_slots
+            if epoch - num_slots >= initial_epoch and cls._get_consumed_epoch(buffer_dir) < epoch - num_slots:
+                # wait until the trainer has consumed the epoch stored before in this slot
+                print("Wait for trainer to consume epoch \'%s\'..." % (epoch - num_slots + 1))
+                while cls._get_consumed_epoch(buffer_dir) < epoch - num_slots:
+                    time.sleep(cls._time_poll_files)
+
+            ready_filename = join_path_names(buffer_dir, cls._name_ready_files % (index_slot))
+            if is_exist_file(ready_filename):
+                removefile(ready_filename)
+
+            print("Generate epoch \'%s\' with \'%s\' samples in slot \'%s\'..."
+                  % (epoch + 1, num_samples, index_slot))
+            start_time = time.time()
+
+            indexes_epoch = cls._get_indexes_epoch(batchdata_generator, epoch, is_fill_last_batch)
+            list_data_filenames = cls._create_files_data_slot(buffer_dir, index_slot, batchdata_generator,
+                                                              num_samples, is_ydata)
+            if num_processes > 1:
+                # (fork, so that the generator with the data in memory is not copied to the processes)
+                context_fork = multiprocessing.get_context('fork')
+                list_processes = []
+                for indexes_chunk in np.array_split(np.arange(num_samples), num_processes):
+                    if len(indexes_chunk) == 0:
+                        continue
+                    new_process = context_fork.Process(target=cls._write_samples_epoch,
+                                                       args=(list_data_filenames, batchdata_generator, epoch,
+                                                             indexes_epoch, indexes_chunk[0], indexes_chunk[-1] + 1))
+                    new_process.start()
+                    list_processes.append(new_process)
+
+                for iprocess in list_processes:
+                    iprocess.join()
+                    if iprocess.exitcode != 0:
+                        message = 'Producer process of prebaked epochs failed with exit code \'%s\'' \
+                                  % (iprocess.exitcode)
+                        catch_error_exception(message)
+            else:
+                cls._write_samples_epoch(list_data_filenames, batchdata_generator, epoch,
+                                         indexes_epoch, 0, num_samples)
+
+            for in_tmp_filename in list_data_filenames:
+                # (rename to replace the files of the slot: the trainer still reading them keeps the old files)
+                movefile(in_tmp_filename, in_tmp_filename.replace('_tmp.npy', '.npy'))
+            cls._save_file_atomic(ready_filename, np.array([epoch], dtype=np.int64))
+
+            elapsed_time = time.time() - start_time
+            print("Time elapsed: \'%0.3f\' secs. Throughput: \'%0.3f\' samples/s..."
+                  % (elapsed_time, num_samples / elapsed_time))
+        # endfor
+
+    @classmethod
+    def get_epoch_data(cls, buffer_dir: str, epoch: int) -> Tuple[np.ndarray, Union[np.ndarray, None]]:
+        # return the samples of the epoch memory-mapped from disk (read-only). Wait until the producer has written it
+        info_buffer = cls.get_info(buffer_dir)
+        if not (info_buffer['initial_epoch'] <= epoch < info_buffer['num_epochs']):
+            message = 'Epoch \'%s\' not in the range of epochs prebaked: [%s, %s)' \
+                      % (epoch, info_buffer['initial_epoch'], info_buffer['num_epochs'])
+            catch_error_exception(message)
+
+        index_slot = epoch % info_buffer['num_slots']
+        ready_filename = join_path_names(buffer_dir, cls._name_ready_files % (index_slot))
+        is_print_wait = True
+        while not (is_exist_file(ready_filename) and int(np.load(ready_filename)[0]) == epoch):
+            if is_print_wait:
+                print("Wait for producer to generate epoch \'%s\'..." % (epoch + 1))
+                is_print_wait = False
+            time.sleep(cls._time_poll_files)
+
+        out_xdata = np.load(join_path_names(buffer_dir, cls._name_xdata_files % (index_slot)), mmap_mode='r')
+        if info_buffer['is_ydata']:
+            out_ydata = np.load(join_path_names(buffer_dir, cls._name_ydata_files % (index_slot)), mmap_mode='r')
+        else:
+            out_ydata = None
+        return (out_xdata, out_ydata)
+
+    @classmethod
+    def release_epoch(cls, buffer_dir: str, epoch: int) -> None:
+        # tell the producer that the slot of this epoch can be reused
+        cls._save_file_atomic(join_path_names(buffer_dir, cls._name_consumed_file), np.array([epoch], dtype=np.int64))
+
+    @classmethod
+    def get_next_epoch_consume(cls, buffer_dir: str) -> int:
+        return max(cls._get_consumed_epoch(buffer_dir) + 1, cls.get_info(buffer_dir)['initial_epoch'])
+
+    @classmethod
+    def _get_consumed_epoch(cls, buffer_dir: str) -> int:
+        consumed_filename = join_path_names(buffer_dir, cls._name_consumed_file)
+        if is_exist_file(consumed_filename):
+            return int(np.load(consumed_filename)[0])
+        else:
+            return -1
+
+    @staticmethod
+    def _get_indexes_epoch(batchdata_generator: BatchImageDataGenerator1Image,
+                           epoch: int,
+                           is_fill_last_batch: bool
+                           ) -> np.ndarray:
+        if is_fill_last_batch:
+            return batchdata_generator.get_indexes_epoch_train(epoch)
+        else:
+            return batchdata_generator.get_indexes_epoch(epoch, is_fill_last_batch=False)
+
+    @classmethod
+    def _create_files_data_slot(cls,
+                                buffer_dir: str,
+                                index_slot: int,
+                                batchdata_generator: BatchImageDataGenerator1Image,
+                                num_samples: int,
+                                is_ydata: bool
+                                ) -> Tuple[str, ...]:
+        # samples stored as generated for the batches, in "channels_last" and the dtype of the source data
+        list_data_filenames = [join_path_names(buffer_dir, (cls._name_xdata_files % (index_slot))
+                                               .replace('.npy', '_tmp.npy'))]
+        list_data_shapes = [(num_samples,) + batchdata_generator._size_image
+                            + (batchdata_generator._num_channels_in,)]
+        list_data_dtypes = [batchdata_generator._dtype_xdata]
+        if is_ydata:
+            list_data_filenames.append(join_path_names(buffer_dir, (cls._name_ydata_files % (index_slot))
+                                                       .replace('.npy', '_tmp.npy')))
+            list_data_shapes.append((num_samples,) + batchdata_generator._size_output_image
+                                    + (batchdata_generator._num_classes_out,))
+            list_data_dtypes.append(batchdata_generator._dtype_ydata)
+
+        for (in_filename, in_shape, in_dtype) in zip(list_data_filenames, list_data_shapes, list_data_dtypes):
+            out_data = np.lib.format.open_memmap(in_filename, mode='w+', dtype=in_dtype, shape=in_shape)
+            del out_data
+        return tuple(list_data_filenames)
+
+    @staticmethod
+    def _write_samples_epoch(list_data_filenames: Tuple[str, ...],
+                             batchdata_generator: BatchImageDataGenerator1Image,
+                             epoch: int,
+                             indexes_epoch: np.ndarray,
+                             begin_sample: int,
+                             end_sample: int
+                             ) -> None:
+        # generate the samples with the random streams of this epoch, the same as in the training without prebaking
+        list_out_data = [np.load(in_filename, mmap_mode='r+') for in_filename in list_data_filenames]
+        batchdata_generator._epoch_count = epoch
+
+        for i_sample in range(begin_sample, end_sample):
+            out_sample = batchdata_generator._get_data_sample(indexes_epoch[i_sample])
+            if len(list_out_data) == 1:
+                list_out_data[0][i_sample] = out_sample
+            else:
+                for (out_data, out_sample_elem) in zip(list_out_data, out_sample):
+                    out_data[i_sample] = out_sample_elem
+        # endfor
+
+        for out_data in list_out_data:
+            out_data.flush()
+
+    @staticmethod
+    def _save_file_atomic(filename: str, in_data: Any) -> None:
+        filename_tmp = filename.replace('.npy', '_tmp.npy')
+        np.save(filename_tmp, in_data)
+        movefile(filename_tmp, filename)
+
+
+class PrebakedBatchImageDataGenerator(object):
+    # batches read from the epochs prebaked on disk, consumed in order. The epoch is loaded (memory-mapped) when
+    # accessed the 1st batch, and released to the producer at the end of the epoch. With 'is_fixed_epoch', the
+    # same prebaked epoch is read in every epoch, and kept memory-mapped
+
+    def __init__(self,
+                 buffer_dir: str,
+                 batch_size: int = 1,
+                 type_image_format: str = 'channels_last',
+                 is_fixed_epoch: bool = False
+                 ) -> None:
+        self._buffer_dir = buffer_dir
+        self._batch_size = batch_size
+        self._is_reshape_channels_first = type_image_format == 'channels_first'
+        self._is_fixed_epoch = is_fixed_epoch
+
+        info_buffer = PrebakedEpochsBuffer.get_info(buffer_dir)
+        self._num_samples = info_buffer['num_samples']
+        self._is_ydata = info_buffer['is_ydata']
+        if is_fixed_epoch:
+            self._epoch_count = info_buffer['initial_epoch']
+        else:
+            self._epoch_count = PrebakedEpochsBuffer.get_next_epoch_consume(buffer_dir)
+        self._epoch_xdata = None
+        self._epoch_ydata = None
+
+    def __len__(self) -> int:
+        return (self._num_samples + self._batch_size - 1) // self._batch_size
+
+    def _on_epoch_end(self) -> None:
+        if self._is_fixed_epoch:
+            return
+        if self._epoch_xdata is not None:
+            self._epoch_xdata = None
+            self._epoch_ydata = None
+            PrebakedEpochsBuffer.release_epoch(self._buffer_dir, self._epoch_count)
+        self._epoch_count += 1
+
+    def __getitem__(self, index: int) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        return self._get_data_batch(index)
+
+    def _get_data_batch(self, index: int) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        if self._epoch_xdata is None:
+            (self._epoch_xdata, self._epoch_ydata) = \
+                PrebakedEpochsBuffer.get_epoch_data(self._buffer_dir, self._epoch_count)
+
+        # (consecutive samples in disk, the epoch is stored already in the order of training)
+        slice_batch = slice(index * self._batch_size, (index + 1) * self._batch_size)
+        out_xdata = self._process_batch_data(self._epoch_xdata[slice_batch])
+        if self._is_ydata:
+            out_ydata = self._process_batch_data(self._epoch_ydata[slice_batch])
+            return (out_xdata, out_ydata)
+        else:
+            return out_xdata
+
+    def _process_batch_data(self, in_batch_data: np.ndarray) -> np.ndarray:
+        if self._is_reshape_channels_first:
+            in_batch_data = ImagesUtil.reshape_channels_first(in_batch_data)
+        # read from disk into memory
+        return np.array(in_batch_data, order='C')
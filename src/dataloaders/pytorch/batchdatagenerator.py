@@ -1,25 +1,85 @@
 
-from typing import List, Tuple, Union
+from typing import List, Tuple, Union, Dict, Any, Iterator
 import numpy as np
 
 from torch.utils import data as data_torch
 import torch
 
-from common.constant import IS_MODEL_GPU, IS_MODEL_HALFPREC
+from common.constant import IS_MODEL_GPU
 from common.functionutil import ImagesUtil
 from dataloaders.batchdatagenerator import BatchImageDataGenerator1Image, BatchImageDataGenerator2Images
+from dataloaders.prebakedepochs import PrebakedBatchImageDataGenerator
 from preprocessing.imagegenerator import ImageGenerator
 
-if IS_MODEL_GPU:
-    if IS_MODEL_HALFPREC:
-        OutputDataType = torch.cuda.HalfTensor
-    else:
-        OutputDataType = torch.cuda.FloatTensor
-else:
-    if IS_MODEL_HALFPREC:
-        OutputDataType = torch.HalfTensor
-    else:
-        OutputDataType = torch.FloatTensor
+# numpy dtypes that have a torch equivalent
+_LIST_DTYPES_TORCH = [np.bool_, np.uint8, np.int8, np.int16, np.int32, np.int64,
+                      np.float16, np.float32, np.float64]
+
+
+def _get_list_data_shared_memory(list_data: List[np.ndarray]) -> List[Union[torch.Tensor, np.ndarray]]:
+    # copy the volumes (once) to shared memory, so that the worker processes use them without copies
+    out_list_data = []
+    for in_data in list_data:
+        # (memory-mapped data is already shared between processes via the page cache)
+        if isinstance(in_data, np.ndarray) and in_data.dtype.type in _LIST_DTYPES_TORCH \
+                and not ImagesUtil.is_image_file_backed(in_data):
+            out_data = torch.from_numpy(np.empty(in_data.shape, dtype=in_data.dtype)).share_memory_()
+            out_data.numpy()[...] = in_data
+            out_list_data.append(out_data)
+        else:
+            out_list_data.append(in_data)
+    return out_list_data
+
+
+def _get_list_data_numpy(list_data: List[Union[torch.Tensor, np.ndarray]]) -> List[np.ndarray]:
+    return [in_data.numpy() if isinstance(in_data, torch.Tensor) else in_data for in_data in list_data]
+
+
+def _get_tensor_sample(in_sample: np.ndarray) -> torch.Tensor:
+    # keep the sample in the dtype of the source data (e.g. int16 images, int8 labels): the batches are converted to
+    # the dtype of the network only once, in the model trainer after sending them to the device
+    if in_sample.dtype.type not in _LIST_DTYPES_TORCH:
+        in_sample = in_sample.astype(np.float32)
+    elif not in_sample.flags.writeable or any(stride < 0 for stride in in_sample.strides):
+        # e.g. view of read-only memory-mapped data, or flipped view (negative strides, not valid in torch)
+        in_sample = in_sample.copy()
+    return torch.from_numpy(in_sample)
+
+
+def _init_worker_random_state(worker_id: int) -> None:
+    # different global random state in each worker (otherwise all the workers forked from the main process draw
+    # the same numbers), for random numbers not from the streams per sample of the image generators
+    np.random.seed(torch.initial_seed() % 2**32)
+
+
+class SamplerIndexesEpochs(data_torch.Sampler):
+    # sampler of the indexes of the samples in each epoch, done in the main process, that encodes the epoch in the
+    # indexes: 'epoch * num_samples + index_sample', so that the workers generate each sample with its random stream
+
+    def __init__(self, batchdata_generator: BatchImageDataGenerator1Image) -> None:
+        self._batchdata_generator = batchdata_generator
+        self._num_samples = len(batchdata_generator)
+        self._epoch_count = 0
+
+    def __len__(self) -> int:
+        return self._num_samples
+
+    def __iter__(self) -> Iterator[int]:
+        indexes_epoch = self._batchdata_generator.get_indexes_epoch_train(self._epoch_count)
+        out_indexes = self._epoch_count * self._num_samples + indexes_epoch
+        self._epoch_count += 1
+        return iter(out_indexes.tolist())
+
+
+def _get_kwargs_dataloader(num_workers: int) -> Dict[str, Any]:
+    out_kwargs = {}
+    if num_workers > 0:
+        out_kwargs['num_workers'] = num_workers
+        out_kwargs['worker_init_fn'] = _init_worker_random_state
+        out_kwargs['pin_memory'] = IS_MODEL_GPU
+        # keep the workers (and the data) alive between epochs
+        out_kwargs['persistent_workers'] = True
+    return out_kwargs
 
 
 class TrainBatchImageDataGenerator1Image(BatchImageDataGenerator1Image):
@@ -32,6 +92,7 @@ class TrainBatchImageDataGenerator1Image(BatchImageDataGenerator1Image):
                  batch_size: int = 1,
                  shuffle: bool = True,
                  seed: int = None,
+                 num_workers: int = 0,
                  is_print_datagen_info: bool = False
                  ) -> None:
         super(TrainBatchImageDataGenerator1Image, self).__init__(size_image,
@@ -43,11 +104,37 @@ class TrainBatchImageDataGenerator1Image(BatchImageDataGenerator1Image):
                                                                  shuffle=shuffle,
                                                                  seed=seed,
                                                                  is_print_datagen_info=is_print_datagen_info)
+        if num_workers > 0:
+            self._list_xdata_shared = _get_list_data_shared_memory(self._list_xdata)
+            self._list_xdata = _get_list_data_numpy(self._list_xdata_shared)
+        else:
+            self._list_xdata_shared = None
+
+    def __len__(self) -> int:
+        # the torch data loader takes single samples, and builds the batches and shuffles the samples in each epoch
+        return self._num_images
+
+    def get_indexes_epoch_train(self, epoch: int) -> np.ndarray:
+        # the torch data loader does not fill the last batch
+        return self.get_indexes_epoch(epoch)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # when sent to worker processes, pass the data in shared memory, not the copies in numpy arrays
+        out_state = self.__dict__.copy()
+        if self._list_xdata_shared is not None:
+            out_state['_list_xdata'] = None
+        return out_state
+
+    def __setstate__(self, in_state: Dict[str, Any]) -> None:
+        self.__dict__.update(in_state)
+        if self._list_xdata_shared is not None:
+            self._list_xdata = _get_list_data_numpy(self._list_xdata_shared)
 
     def __getitem__(self, index: int) -> np.ndarray:
+        (self._epoch_count, index) = divmod(index, self._num_images)
         out_xdata = self._get_data_sample(index)
         out_xdata = ImagesUtil.reshape_channels_first(out_xdata, is_input_sample=True)
-        return torch.from_numpy(out_xdata.copy()).type(OutputDataType)
+        return _get_tensor_sample(out_xdata)
 
 
 class TrainBatchImageDataGenerator2Images(BatchImageDataGenerator2Images):
@@ -64,6 +151,7 @@ class TrainBatchImageDataGenerator2Images(BatchImageDataGenerator2Images):
                  batch_size: int = 1,
                  shuffle: bool = True,
                  seed: int = None,
+                 num_workers: int = 0,
                  is_print_datagen_info: bool = False
                  ) -> None:
         super(TrainBatchImageDataGenerator2Images, self).__init__(size_image,
@@ -79,13 +167,43 @@ class TrainBatchImageDataGenerator2Images(BatchImageDataGenerator2Images):
                                                                   shuffle=shuffle,
                                                                   seed=seed,
                                                                   is_print_datagen_info=is_print_datagen_info)
+        if num_workers > 0:
+            self._list_xdata_shared = _get_list_data_shared_memory(self._list_xdata)
+            self._list_ydata_shared = _get_list_data_shared_memory(self._list_ydata)
+            self._list_xdata = _get_list_data_numpy(self._list_xdata_shared)
+            self._list_ydata = _get_list_data_numpy(self._list_ydata_shared)
+        else:
+            self._list_xdata_shared = None
+            self._list_ydata_shared = None
+
+    def __len__(self) -> int:
+        # the torch data loader takes single samples, and builds the batches and shuffles the samples in each epoch
+        return self._num_images
+
+    def get_indexes_epoch_train(self, epoch: int) -> np.ndarray:
+        # the torch data loader does not fill the last batch
+        return self.get_indexes_epoch(epoch)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # when sent to worker processes, pass the data in shared memory, not the copies in numpy arrays
+        out_state = self.__dict__.copy()
+        if self._list_xdata_shared is not None:
+            out_state['_list_xdata'] = None
+            out_state['_list_ydata'] = None
+        return out_state
+
+    def __setstate__(self, in_state: Dict[str, Any]) -> None:
+        self.__dict__.update(in_state)
+        if self._list_xdata_shared is not None:
+            self._list_xdata = _get_list_data_numpy(self._list_xdata_shared)
+            self._list_ydata = _get_list_data_numpy(self._list_ydata_shared)
 
     def __getitem__(self, index: int) -> Tuple[np.ndarray, np.ndarray]:
+        (self._epoch_count, index) = divmod(index, self._num_images)
         (out_xdata, out_ydata) = self._get_data_sample(index)
         out_xdata = ImagesUtil.reshape_channels_first(out_xdata, is_input_sample=True)
         out_ydata = ImagesUtil.reshape_channels_first(out_ydata, is_input_sample=True)
-        return (torch.from_numpy(out_xdata.copy()).type(OutputDataType),
-                torch.from_numpy(out_ydata.copy()).type(OutputDataType))
+        return (_get_tensor_sample(out_xdata), _get_tensor_sample(out_ydata))
 
 
 class WrapperTrainBatchImageDataGenerator1Image(data_torch.DataLoader):
@@ -98,6 +216,7 @@ class WrapperTrainBatchImageDataGenerator1Image(data_torch.DataLoader):
                  batch_size: int = 1,
                  shuffle: bool = True,
                  seed: int = None,
+                 num_workers: int = 0,
                  is_print_datagen_info: bool = False
                  ) -> None:
         self._batchdata_generator = TrainBatchImageDataGenerator1Image(size_image,
@@ -107,10 +226,13 @@ class WrapperTrainBatchImageDataGenerator1Image(data_torch.DataLoader):
                                                                        batch_size=batch_size,
                                                                        shuffle=shuffle,
                                                                        seed=seed,
+                                                                       num_workers=num_workers,
                                                                        is_print_datagen_info=is_print_datagen_info)
+        sampler_indexes = SamplerIndexesEpochs(self._batchdata_generator)
         super(WrapperTrainBatchImageDataGenerator1Image, self).__init__(self._batchdata_generator,
                                                                         batch_size=batch_size,
-                                                                        shuffle=shuffle)
+                                                                        sampler=sampler_indexes,
+                                                                        **_get_kwargs_dataloader(num_workers))
 
     def get_full_data(self) -> np.ndarray:
         return self._batchdata_generator.get_full_data()
@@ -130,6 +252,7 @@ class WrapperTrainBatchImageDataGenerator2Images(data_torch.DataLoader):
                  batch_size: int = 1,
                  shuffle: bool = True,
                  seed: int = None,
+                 num_workers: int = 0,
                  is_print_datagen_info: bool = False
                  ) -> None:
         self._batchdata_generator = TrainBatchImageDataGenerator2Images(size_image,
@@ -143,10 +266,39 @@ class WrapperTrainBatchImageDataGenerator2Images(data_torch.DataLoader):
                                                                         batch_size=batch_size,
                                                                         shuffle=shuffle,
                                                                         seed=seed,
+                                                                        num_workers=num_workers,
                                                                         is_print_datagen_info=is_print_datagen_info)
+        sampler_indexes = SamplerIndexesEpochs(self._batchdata_generator)
         super(WrapperTrainBatchImageDataGenerator2Images, self).__init__(self._batchdata_generator,
                                                                          batch_size=batch_size,
-                                                                         shuffle=shuffle)
+                                                                         sampler=sampler_indexes,
+                                                                         **_get_kwargs_dataloader(num_workers))
 
     def get_full_data(self) -> Tuple[np.ndarray, np.ndarray]:
         return self._batchdata_generator.get_full_data()
+
+
+class WrapperPrebakedTrainBatchImageDataGenerator(PrebakedBatchImageDataGenerator):
+    # in place of the torch data loader: each iteration gives the batches of the next epoch prebaked on disk
+
+    def __init__(self,
+                 buffer_dir: str,
+                 batch_size: int = 1,
+                 is_fixed_epoch: bool = False
+                 ) -> None:
+        super(WrapperPrebakedTrainBatchImageDataGenerator, self).__init__(buffer_dir,
+                                                                          batch_size=batch_size,
+                                                                          type_image_format='channels_first',
+                                                                          is_fixed_epoch=is_fixed_epoch)
+
+    def __iter__(self) -> Iterator[Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]]:
+        try:
+            for index in range(len(self)):
+                yield self._get_data_batch(index)
+        finally:
+            # also when the loop over the batches is stopped early
+            self._on_epoch_end()
+
+    def _process_batch_data(self, in_batch_data: np.ndarray) -> torch.Tensor:
+        out_batch_data = super(WrapperPrebakedTrainBatchImageDataGenerator, self)._process_batch_data(in_batch_data)
+        return _get_tensor_sample(out_batch_data)
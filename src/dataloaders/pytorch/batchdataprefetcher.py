@@ -0,0 +1,146 @@
+
+from typing import Tuple, Union, Iterator, Callable, Any
+from threading import Thread, Event
+from queue import Queue, Empty, Full
+import time
+
+import torch
+
+BatchDataType = Union[torch.Tensor, Tuple[torch.Tensor, ...]]
+
+
+class BatchDataPrefetcher(object):
+    # iterate over the batches of a data loader, with the next batches staged while the current one is computed.
+    # The batches are loaded in a background thread, up to 'num_prefetch' batches ahead, and:
+    # - on gpu: batch k+1 is taken in pinned host memory (in the thread), and sent to the device (and converted to
+    #   the dtype of the network) with non-blocking copies in a separate cuda stream, while the kernels of batch k run
+    # - on cpu: the batches are converted to the dtype of the network in the thread
+    # The time waiting for the data loader is accumulated in each epoch, to report it in the loss history
+    _num_prefetch_default = 2
+    _timeout_queue = 0.1
+
+    def __init__(self,
+                 data_loader: Any,
+                 device: torch.device,
+                 dtype_data: torch.dtype = torch.float32,
+                 num_prefetch: int = _num_prefetch_default
+                 ) -> None:
+        self._data_loader = data_loader
+        self._device = device
+        self._dtype_data = dtype_data
+        self._num_prefetch = num_prefetch
+        self._is_device_gpu = (device.type == 'cuda')
+        self._time_wait_data = 0.0
+
+    def __len__(self) -> int:
+        return len(self._data_loader)
+
+    def get_time_wait_data(self) -> float:
+        # time waiting for the data (in secs) in the last pass over the data loader
+        return self._time_wait_data
+
+    def __iter__(self) -> Iterator[BatchDataType]:
+        self._time_wait_data = 0.0
+        if self._is_device_gpu:
+            return self._iterate_prefetch_gpu()
+        else:
+            return self._iterate_prefetch_thread(self._get_batch_data_device)
+
+    def _get_batch_data_device(self, in_batch_data: BatchDataType) -> BatchDataType:
+        if isinstance(in_batch_data, (tuple, list)):
+            return tuple(self._get_batch_data_device(elem) for elem in in_batch_data)
+        if self._is_device_gpu and not in_batch_data.is_pinned():
+            # non-blocking copies to the gpu only from pinned memory (the data loader pins the batches when
+            # it has workers). 'pin_memory()' reuses the host buffers cached by torch
+            in_batch_data = in_batch_data.pin_memory()
+        return in_batch_data.to(self._device, non_blocking=True).to(self._dtype_data)
+
+    def _get_batch_data_pinned(self, in_batch_data: BatchDataType) -> BatchDataType:
+        if isinstance(in_batch_data, (tuple, list)):
+            return tuple(self._get_batch_data_pinned(elem) for elem in in_batch_data)
+        return in_batch_data if in_batch_data.is_pinned() else in_batch_data.pin_memory()
+
+    @staticmethod
+    def _record_stream_batch_data(in_batch_data: BatchDataType, stream: torch.cuda.Stream) -> None:
+        # tell the caching allocator that the memory of the batch is used in 'stream', not to reuse it before
+        if isinstance(in_batch_data, (tuple, list)):
+            for elem in in_batch_data:
+                elem.record_stream(stream)
+        else:
+            in_batch_data.record_stream(stream)
+
+    def _iterate_prefetch_gpu(self) -> Iterator[BatchDataType]:
+        stream_copy = torch.cuda.Stream(device=self._device)
+        # the batches are loaded and pinned in the background thread, and only the copies are issued here
+        iterator_data = self._iterate_prefetch_thread(self._get_batch_data_pinned)
+
+        def _load_next_batch() -> Union[BatchDataType, None]:
+            in_batch_data = next(iterator_data, None)
+            if in_batch_data is None:
+                return None
+
+            with torch.cuda.stream(stream_copy):
+                return self._get_batch_data_device(in_batch_data)
+
+        try:
+            next_batch_data = _load_next_batch()
+            while next_batch_data is not None:
+                stream_compute = torch.cuda.current_stream(device=self._device)
+                stream_compute.wait_stream(stream_copy)
+                out_batch_data = next_batch_data
+                self._record_stream_batch_data(out_batch_data, stream_compute)
+
+                # issue the copies of the next batch, before the kernels of this batch are run
+                next_batch_data = _load_next_batch()
+                yield out_batch_data
+        finally:
+            # stop the thread loading the batches
+            iterator_data.close()
+
+    def _iterate_prefetch_thread(self, func_process_batch: Callable[[BatchDataType], BatchDataType]
+                                 ) -> Iterator[BatchDataType]:
+        queue_batches = Queue(maxsize=self._num_prefetch)
+        is_stop_event = Event()
+        end_marker = object()
+
+        def _put_queue(in_item: Any) -> bool:
+            while not is_stop_event.is_set():
+                try:
+                    queue_batches.put(in_item, timeout=self._timeout_queue)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def _run_load_batches() -> None:
+            try:
+                for in_batch_data in self._data_loader:
+                    if not _put_queue(func_process_batch(in_batch_data)):
+                        return
+                _put_queue(end_marker)
+            except BaseException as excep:
+                # raise the exception in the main thread (also 'SystemExit' from 'catch_error_exception()')
+                _put_queue(excep)
+
+        thread_load_batches = Thread(target=_run_load_batches, daemon=True)
+        thread_load_batches.start()
+        try:
+            while True:
+                start_time = time.time()
+                out_item = queue_batches.get()
+                self._time_wait_data += time.time() - start_time
+
+                if out_item is end_marker:
+                    break
+                elif isinstance(out_item, BaseException):
+                    raise out_item
+                yield out_item
+        finally:
+            # when the loop over the batches is stopped early, stop the thread and release the queue
+            is_stop_event.set()
+            while True:
+                try:
+                    queue_batches.get_nowait()
+                except Empty:
+                    break
+            thread_load_batches.join()
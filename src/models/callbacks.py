@@ -22,7 +22,8 @@ class RecordLossHistoryBase(CallbackBase):
     def __init__(self,
                  loss_filename: str,
                  list_metrics: List[MetricBase] = None,
-                 is_hist_validation: bool = True
+                 is_hist_validation: bool = True,
+                 is_hist_time_wait_data: bool = False
                  ) -> None:
         self._loss_filename = loss_filename
         self._names_hist_fields = ['loss']
@@ -35,6 +36,10 @@ class RecordLossHistoryBase(CallbackBase):
                 names_hist_fields_new += [iname, 'val_%s' % (iname)]
             self._names_hist_fields = names_hist_fields_new
 
+        if is_hist_time_wait_data:
+            # time (in secs) waiting for the data in the epoch, with the training stopped
+            self._names_hist_fields += ['time_wait_data']
+
     def on_train_begin(self) -> None:
         list_names_header = ['/epoch/'] + ['/%s/' % (elem) for elem in self._names_hist_fields]
         str_header = ' '.join(list_names_header) + '\n'
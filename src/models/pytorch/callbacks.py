@@ -10,10 +10,12 @@ class RecordLossHistory(RecordLossHistoryBase):
     def __init__(self,
                  loss_filename: str,
                  list_metrics: List[MetricBase] = None,
-                 is_hist_validation: bool = True
+                 is_hist_validation: bool = True,
+                 is_hist_time_wait_data: bool = False
                  ) -> None:
         super(RecordLossHistory, self).__init__(loss_filename, list_metrics,
-                                                is_hist_validation=is_hist_validation)
+                                                is_hist_validation=is_hist_validation,
+                                                is_hist_time_wait_data=is_hist_time_wait_data)
 
     def on_train_begin(self, *args, **kwargs) -> None:
         super(RecordLossHistory, self).on_train_begin()
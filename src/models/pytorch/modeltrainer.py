@@ -1,5 +1,5 @@
 
-from typing import Tuple, List
+from typing import Tuple, List, Dict, Union, Any
 import numpy as np
 
 import torch
@@ -8,8 +8,11 @@ from tqdm import tqdm
 
 from common.functionutil import ImagesUtil, join_path_names
 from dataloaders.batchdatagenerator import BatchDataGenerator
+from dataloaders.pytorch.batchdataprefetcher import BatchDataPrefetcher
 from models.modeltrainer import ModelTrainerBase
 from models.pytorch.callbacks import RecordLossHistory, ModelCheckpoint
+from preprocessing.preprocessing_manager import fill_missing_trans_rigid_params
+from preprocessing.pytorch.transformrigidbatch import TransformRigidBatchImages3D
 
 NAME_SAVEDMODEL_EPOCH = 'model_e%0.2d.pt'
 NAME_SAVEDMODEL_LAST = 'model_last.pt'
@@ -20,6 +23,8 @@ class ModelTrainer(ModelTrainerBase):
     def __init__(self):
         super(ModelTrainer, self).__init__()
         self._device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+        self._dtype_data = torch.float32
+        self._transform_batch_data = None
 
     def _set_manual_random_seed(self, seed: int) -> None:
         import random
@@ -36,12 +41,29 @@ class ModelTrainer(ModelTrainerBase):
             kwargs['is_model_half_precision'] if 'is_model_half_precision' in kwargs.keys() else None
         if is_model_half_precision:
             self._network.half()
+            self._dtype_data = torch.float16
 
         self._network.to(self._device)  # if 'cuda:0', dispatch model to 'gpu'
 
     def finalise_model(self) -> None:
         pass
 
+    def create_transform_batch_data(self,
+                                    size_image: Tuple[int, int, int],
+                                    trans_rigid_params: Union[Dict[str, Any], None] = None,
+                                    seed: int = None
+                                    ) -> None:
+        # rigid transformations of the training batches in the device of the model, instead of in the data loader
+        trans_rigid_params = fill_missing_trans_rigid_params(trans_rigid_params)
+        self._transform_batch_data = TransformRigidBatchImages3D(size_image,
+                                                                 rotation_range=trans_rigid_params['rotation_range'],
+                                                                 shift_range=trans_rigid_params['shift_range'],
+                                                                 flip_dirs=trans_rigid_params['flip_dirs'],
+                                                                 zoom_range=trans_rigid_params['zoom_range'],
+                                                                 fill_mode=trans_rigid_params['fill_mode'],
+                                                                 seed=seed)
+        print(self._transform_batch_data.get_text_description())
+
     def create_callbacks(self, models_path: str, losshist_filename: str, **kwargs) -> None:
         self._list_callbacks = []
 
@@ -54,7 +76,8 @@ class ModelTrainer(ModelTrainerBase):
 
         losshist_filename = join_path_names(models_path, losshist_filename)
         new_callback = RecordLossHistory(losshist_filename, self._list_metrics,
-                                         is_hist_validation=is_validation_data)
+                                         is_hist_validation=is_validation_data,
+                                         is_hist_time_wait_data=True)
         self._list_callbacks.append(new_callback)
 
         model_filename = join_path_names(models_path, NAME_SAVEDMODEL_EPOCH)
@@ -204,6 +227,12 @@ class ModelTrainer(ModelTrainerBase):
                       'metrics_desc': [imetric.__class__.__name__ for imetric in self._list_metrics]}
         torch.save(model_full, model_filename)
 
+    def _get_batch_data_prefetcher(self, in_data_loader: BatchDataGenerator) -> BatchDataPrefetcher:
+        # batches come in the dtype of the source data (e.g. int16 images, int8 labels): the prefetcher sends them
+        # to the device, and converts them there (only once per batch) to the dtype of the network, while the
+        # previous batch is computed
+        return BatchDataPrefetcher(in_data_loader, self._device, dtype_data=self._dtype_data)
+
     def _criterion(self, in_predic: torch.Tensor, in_target: torch.Tensor) -> torch.Tensor:
         return self._loss.forward(in_target, in_predic)
 
@@ -231,8 +260,11 @@ class ModelTrainer(ModelTrainerBase):
               initial_epoch: int = 0,
               is_shuffle_data: bool = False
               ) -> None:
-        self._train_data_loader = train_data_loader
-        self._valid_data_loader = valid_data_loader
+        self._train_data_loader = self._get_batch_data_prefetcher(train_data_loader)
+        if valid_data_loader is not None:
+            self._valid_data_loader = self._get_batch_data_prefetcher(valid_data_loader)
+        else:
+            self._valid_data_loader = None
         self._num_epochs = num_epochs
         self._max_steps_epoch = max_steps_epoch
 
@@ -245,7 +277,7 @@ class ModelTrainer(ModelTrainerBase):
             self._epoch_start_count += 1
 
     def predict(self, test_data_loader: BatchDataGenerator) -> np.ndarray:
-        self._test_data_loader = test_data_loader
+        self._test_data_loader = self._get_batch_data_prefetcher(test_data_loader)
 
         self._network.eval()    # switch to evaluate mode
 
@@ -261,6 +293,7 @@ class ModelTrainer(ModelTrainerBase):
             self._run_callbacks_on_train_begin()
 
         (train_loss, train_metrics) = self._train_epoch()
+        time_wait_data = self._train_data_loader.get_time_wait_data()
 
         if self._valid_data_loader is not None:
             if (self._epoch_count % self.freq_validate_model == 0) or (self._epoch_start_count == 0):
@@ -279,9 +312,9 @@ class ModelTrainer(ModelTrainerBase):
             valid_metrics = [0.0] * self._num_metrics
 
         if self._valid_data_loader is not None:
-            data_output = [train_loss, valid_loss] + train_metrics + valid_metrics
+            data_output = [train_loss, valid_loss] + train_metrics + valid_metrics + [time_wait_data]
         else:
-            data_output = [train_loss] + train_metrics
+            data_output = [train_loss] + train_metrics + [time_wait_data]
 
         self._run_callbacks_on_epoch_end(self._epoch_count, data_output)
 
@@ -300,8 +333,9 @@ class ModelTrainer(ModelTrainerBase):
 
         i_batch = 0
         for (in_batch_xdata, in_batch_ydata) in self._train_data_loader:
-            in_batch_xdata.to(self._device)
-            in_batch_ydata.to(self._device)
+            if self._transform_batch_data is not None:
+                (in_batch_xdata, in_batch_ydata) = \
+                    self._transform_batch_data.get_batch_2images(in_batch_xdata, in_batch_ydata)
 
             self._optimizer.zero_grad()
             out_batch_predic = self._network(in_batch_xdata)
@@ -340,9 +374,6 @@ class ModelTrainer(ModelTrainerBase):
 
         i_batch = 0
         for (in_batch_xdata, in_batch_ydata) in self._valid_data_loader:
-            in_batch_xdata.to(self._device)
-            in_batch_ydata.to(self._device)
-
             with torch.no_grad():
                 out_batch_predic = self._network(in_batch_xdata)
                 loss = self._criterion(out_batch_predic, in_batch_ydata)
@@ -372,8 +403,6 @@ class ModelTrainer(ModelTrainerBase):
         progressbar = tqdm(total=num_batches, desc='Prediction')
 
         for i_batch, in_batch_xdata in enumerate(self._test_data_loader):
-            in_batch_xdata.to(self._device)
-
             with torch.no_grad():
                 out_batch_predic = self._network(in_batch_xdata)
                 out_batch_predic.detach()
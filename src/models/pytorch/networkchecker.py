@@ -57,8 +57,9 @@ class NetworkChecker(NetworkCheckerBase):
 
         self._network = self._network.eval()    # switch to evaluate mode
 
+        param_network = next(self._network.parameters())
         for i_img, x_image in enumerate(image_data_loader):
-            x_image.cuda()
+            x_image = x_image.to(param_network.device, dtype=param_network.dtype)
             self._network(x_image)
             out_featmaps[i_img] = out_featmaps_patch  # 'out_featmaps_patch' store inside the function 'hook' above
 
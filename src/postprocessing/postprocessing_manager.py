@@ -41,6 +41,7 @@ def get_image_reconstructor(size_images: Union[Tuple[int, int, int], Tuple[int,
                                               trans_flip_dirs=trans_rigid_params['flip_dirs'],
                                               trans_zoom_range=trans_rigid_params['zoom_range'],
                                               trans_fill_mode=trans_rigid_params['fill_mode'],
+                                              trans_order_interp_image=trans_rigid_params['order_interp_image'],
                                               size_volume_images=size_volume_images)
 
     if is_filter_output_images:
@@ -2,16 +2,17 @@
 from typing import Tuple, List, Union
 import numpy as np
 
-from scipy.ndimage import map_coordinates, gaussian_filter
-from elasticdeform import deform_random_grid
+from scipy.ndimage import map_coordinates, gaussian_filter1d
 
 from common.exceptionmanager import catch_error_exception
-from preprocessing.imagegenerator import ImageGenerator
+from preprocessing.imagegenerator import ImageGenerator, SeedType
 
 
 class ElasticDeformImages(ImageGenerator):
     _order_interp_image = 3
     _order_interp_mask = 0
+    # cache (per process) of the grids of coordinates and the bases of the displacement fields, per size of image
+    _dict_cache_grids = {}
 
     def __init__(self,
                  size_image: Union[Tuple[int, int, int], Tuple[int, int]],
@@ -60,13 +61,44 @@ class ElasticDeformImages(ImageGenerator):
         message = 'Inverse transformation not implemented for Elastic Deformations'
         catch_error_exception(message)
 
-    def _calc_gendata_elastic_deform(self, seed: int = None) -> np.ndarray:
+    def _calc_gendata_elastic_deform(self, seed: SeedType = None) -> np.ndarray:
         raise NotImplementedError
 
     @classmethod
     def _get_type_elastic_deform(cls) -> str:
         raise NotImplementedError
 
+    @classmethod
+    def _get_identity_grid(cls, size_image: Tuple[int, ...]) -> np.ndarray:
+        key_cache = ('identity', tuple(size_image))
+        if key_cache not in cls._dict_cache_grids:
+            cls._dict_cache_grids[key_cache] = np.indices(size_image, dtype=np.float32)
+        return cls._dict_cache_grids[key_cache]
+
+    @classmethod
+    def _get_spline_bases_grid(cls, size_image: Tuple[int, ...], num_points: int) -> List[np.ndarray]:
+        # cubic B-spline interpolation from the control points of the grid to the points of the image. This is
+        # separable, so it is stored as a matrix per dimension, of shape (size_dim, num_points)
+        key_cache = ('spline_bases', tuple(size_image), num_points)
+        if key_cache not in cls._dict_cache_grids:
+            list_bases = []
+            for size_dim in size_image:
+                xi = np.linspace(0, num_points - 1, size_dim)[np.newaxis, :]
+                unit_points = np.eye(num_points)
+                basis = np.stack([map_coordinates(unit_points[i], xi, order=3) for i in range(num_points)], axis=1)
+                list_bases.append(basis.astype(np.float32))
+            # endfor
+            cls._dict_cache_grids[key_cache] = list_bases
+        return cls._dict_cache_grids[key_cache]
+
+    @staticmethod
+    def _calc_displacement_field(displacement_points: np.ndarray, list_bases: List[np.ndarray]) -> np.ndarray:
+        # upsample the displacement at the control points to the image, by the product with the basis along each dim
+        out_displacement = displacement_points.astype(np.float32)
+        for i_dim, basis in enumerate(list_bases):
+            out_displacement = np.moveaxis(np.tensordot(out_displacement, basis, axes=(i_dim, 1)), -1, i_dim)
+        return out_displacement
+
     def get_text_description(self) -> str:
         message = 'Elastic deformations of images...\n'
         message += '- type of elastic deformation: \'%s\'...\n' % (self._get_type_elastic_deform())
@@ -90,42 +122,24 @@ class ElasticDeformGridwiseImages(ElasticDeformImages):
 
         super(ElasticDeformGridwiseImages, self).__init__(size_image, fill_mode=fill_mode, cval=cval)
 
-    def _calc_gendata_elastic_deform(self, seed: int = None) -> np.ndarray:
-        if seed is not None:
-            np.random.seed(seed)
-
-        if self._ndims == 2:
-            # creates the grid of coordinates of the points of the image (a ndim array per dimension)
-            coordinates = np.meshgrid(np.arange(self._size_image[0]),
-                                      np.arange(self._size_image[1]), indexing='ij')
-            # creates the grid of coordinates of the points of the image in the "deformation grid" frame of reference
-            xi = np.meshgrid(np.linspace(0, self._points - 1, self._size_image[0]),
-                             np.linspace(0, self._points - 1, self._size_image[1]), indexing='ij')
-            grid = [self._points, self._points]
-
-        elif self._ndims == 3:
-            # creates the grid of coordinates of the points of the image (a ndim array per dimension)
-            coordinates = np.meshgrid(np.arange(self._size_image[0]),
-                                      np.arange(self._size_image[1]),
-                                      np.arange(self._size_image[2]), indexing='ij')
-            # creates the grid of coordinates of the points of the image in the "deformation grid" frame of reference
-            xi = np.meshgrid(np.linspace(0, self._points - 1, self._size_image[0]),
-                             np.linspace(0, self._points - 1, self._size_image[1]),
-                             np.linspace(0, self._points - 1, self._size_image[2]), indexing='ij')
-            grid = [self._points, self._points, self._points]
-
-        # creates the deformation along each dimension and then add it to the coordinates
+    def _calc_gendata_elastic_deform(self, seed: SeedType = None) -> np.ndarray:
+        random_state = self.get_random_state(seed)
+
+        # the displacement at the points of the image is interpolated from that at the control points of the grid,
+        # with the spline bases precomputed for this size of image
+        list_bases = self._get_spline_bases_grid(self._size_image, self._points)
+        grid = (self._points,) * self._ndims
+
+        coordinates = np.empty((self._ndims,) + tuple(self._size_image), dtype=np.float32)
         for i in range(self._ndims):
             # creating the displacement at the control points
-            yi = np.random.randn(*grid) * self._sigma
-            # print(y.shape,coordinates[i].shape) #y and coordinates[i] should be of the same shape,
-            # otherwise the same displacement is applied to every ?row? of points ?
-            y = map_coordinates(yi, xi, order=3).reshape(self._size_image)
-            # adding the displacement
-            coordinates[i] = np.add(coordinates[i], y)
+            yi = random_state.standard_normal(grid) * self._sigma
+            coordinates[i] = self._calc_displacement_field(yi, list_bases)
         # endfor
+        # adding the displacement
+        coordinates += self._get_identity_grid(self._size_image)
 
-        return np.asarray(coordinates)
+        return coordinates
 
     @classmethod
     def _get_type_elastic_deform(cls) -> str:
@@ -149,27 +163,49 @@ class ElasticDeformPixelwiseImages(ElasticDeformImages):
 
         super(ElasticDeformPixelwiseImages, self).__init__(size_image, fill_mode=fill_mode, cval=cval)
 
-    def _calc_gendata_elastic_deform(self, seed: int = None) -> np.ndarray:
-        if seed is not None:
-            np.random.seed(seed)
+    def _calc_gendata_elastic_deform(self, seed: SeedType = None) -> np.ndarray:
+        random_state = self.get_random_state(seed)
 
-        if self._ndims == 2:
-            xi_dirs = np.meshgrid(np.arange(self._size_image[0]),
-                                  np.arange(self._size_image[1]), indexing='ij')
-        elif self._ndims == 3:
-            xi_dirs = np.meshgrid(np.arange(self._size_image[0]),
-                                  np.arange(self._size_image[1]),
-                                  np.arange(self._size_image[2]), indexing='ij')
+        # the smoothed random displacement is computed in a coarse grid, with spacing ~ 'sigma' / 2, and upsampled
+        # linearly to the image, with the bases precomputed for this size of image
+        list_bases = self._get_smoothing_bases_coarse_grid(self._size_image, self._sigma)
+        shape_coarse_grid = tuple(basis.shape[1] for basis in list_bases)
 
-        indices = []
+        coordinates = np.empty((self._ndims,) + tuple(self._size_image), dtype=np.float32)
         for i in range(self._ndims):
-            # originally with random_state.rand * 2 - 1
-            dx_i = gaussian_filter(np.random.randn(*self._size_image),
-                                   self._sigma, mode='constant', cval=0) * self._alpha
-            indices.append(xi_dirs[i] + dx_i)
+            noise_i = random_state.standard_normal(shape_coarse_grid) * self._alpha
+            coordinates[i] = self._calc_displacement_field(noise_i, list_bases)
         # endfor
+        coordinates += self._get_identity_grid(self._size_image)
+
+        return coordinates
 
-        return np.asarray(indices)
+    @classmethod
+    def _get_smoothing_bases_coarse_grid(cls, size_image: Tuple[int, ...], sigma: float) -> List[np.ndarray]:
+        # gaussian smoothing of white noise in a coarse grid (factor 'sigma' / 2 coarser), followed by linear
+        # interpolation to the image, along each dim. The amplitude is rescaled to match that of the white noise
+        # smoothed with 'sigma' in the image grid. Matrices of shape (size_dim, size_coarse_dim)
+        key_cache = ('smoothing_bases', tuple(size_image), sigma)
+        if key_cache not in cls._dict_cache_grids:
+            factor_coarse = max(1, int(np.ceil(sigma / 2)))
+            list_bases = []
+            for size_dim in size_image:
+                size_coarse_dim = int(np.ceil((size_dim - 1) / factor_coarse)) + 1
+                xi = np.arange(size_dim) / factor_coarse
+                index_left = np.minimum(np.floor(xi).astype(int), size_coarse_dim - 2) if size_coarse_dim > 1 \
+                    else np.zeros(size_dim, dtype=int)
+                weight_right = xi - index_left
+                interp_linear = np.zeros((size_dim, size_coarse_dim))
+                interp_linear[np.arange(size_dim), index_left] = 1.0 - weight_right
+                if size_coarse_dim > 1:
+                    interp_linear[np.arange(size_dim), index_left + 1] = weight_right
+                smoothing = gaussian_filter1d(np.eye(size_coarse_dim), sigma / factor_coarse, axis=0,
+                                              mode='constant', cval=0)
+                basis = np.dot(interp_linear, smoothing) / np.sqrt(factor_coarse)
+                list_bases.append(basis.astype(np.float32))
+            # endfor
+            cls._dict_cache_grids[key_cache] = list_bases
+        return cls._dict_cache_grids[key_cache]
 
     @classmethod
     def _get_type_elastic_deform(cls) -> str:
@@ -180,6 +216,7 @@ class ElasticDeformGridwiseImagesImproved(ElasticDeformImages):
     _sigma_default = 25
     _points_default = 3
     _type_elastic_deform = 'Grid-wise_improved'
+    _size_margin_interp = 2
 
     def __init__(self,
                  size_image: Union[Tuple[int, int, int], Tuple[int, int]],
@@ -193,30 +230,53 @@ class ElasticDeformGridwiseImagesImproved(ElasticDeformImages):
 
         super(ElasticDeformGridwiseImagesImproved, self).__init__(size_image, fill_mode=fill_mode, cval=cval)
 
-    def _calc_gendata_elastic_deform(self, seed: int = None) -> np.ndarray:
-        pass
+    def _update_gendata(self, **kwargs) -> None:
+        # 'origin_window': position of the output patch in a larger input volume, to deform only the patch region
+        seed = kwargs['seed']
+        origin_window = kwargs['origin_window'] if 'origin_window' in kwargs.keys() else None
+        self._gendata_elastic_deform = self._calc_gendata_elastic_deform(seed, origin_window)
+        self._count_trans_in_images = 0
 
-    def _get_image(self, in_image: np.ndarray) -> np.ndarray:
-        out_image = deform_random_grid(in_image, sigma=self._sigma, points=self._points, order=self._order_interp_image,
-                                       mode=self._fill_mode, cval=self._cval)
-        return out_image
-
-    def get_2images(self, in_image_1: np.ndarray, in_image_2: np.ndarray, **kwargs) -> Tuple[np.ndarray, np.ndarray]:
-        (out_image_1, out_image_2) = deform_random_grid([in_image_1, in_image_2],
-                                                        sigma=self._sigma,
-                                                        points=self._points,
-                                                        order=[self._order_interp_image, self._order_interp_mask],
-                                                        mode=self._fill_mode, cval=self._cval)
-        return (out_image_1, out_image_2)
-
-    def get_many_images(self, in_list_images: List[np.ndarray], **kwargs) -> List[np.ndarray]:
-        out_list_images = deform_random_grid(in_list_images,
-                                             sigma=self._sigma,
-                                             points=self._points,
-                                             order=[self._order_interp_image]
-                                             + [self._order_interp_mask] * (len(in_list_images) - 1),
-                                             mode=self._fill_mode, cval=self._cval)
-        return out_list_images
+    def _get_transformed_image(self, in_image: np.ndarray, is_type_input_image: bool = False) -> np.ndarray:
+        order_interp = self._order_interp_image if is_type_input_image else self._order_interp_mask
+
+        # sample only from the region of the input spanned by the deformed grid, with a margin for the support of
+        # the interpolation. For a patch inside a large volume, this avoids the spline prefilter of the whole volume
+        (coordinates, begin_region, end_region) = self._gendata_elastic_deform
+        size_margin = self._size_margin_interp * (order_interp + 1)
+        begin_region = np.maximum(begin_region - size_margin, 0)
+        end_region = np.maximum(np.minimum(end_region + size_margin, in_image.shape[:self._ndims]), begin_region + 1)
+        slices_region = tuple(slice(begin, end) for (begin, end) in zip(begin_region, end_region))
+        offset_region = begin_region.astype(np.float32).reshape((self._ndims,) + (1,) * self._ndims)
+
+        return map_coordinates(in_image[slices_region], coordinates - offset_region, order=order_interp,
+                               mode=self._fill_mode, cval=self._cval).reshape(self._size_image)
+
+    def _calc_gendata_elastic_deform(self, seed: SeedType = None,
+                                     origin_window: Union[Tuple[int, int, int], Tuple[int, int], None] = None
+                                     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # displacements at the control points of the grid (as in 'deform_random_grid'), from the seeded random stream.
+        # Computed once per sample, and the same coordinates are used for all the images (image, labels, ...)
+        random_state = self.get_random_state(seed)
+        shape_displacement = (self._ndims,) + (self._points,) * self._ndims
+        displacement_points = random_state.standard_normal(shape_displacement) * self._sigma
+
+        list_bases = self._get_spline_bases_grid(self._size_image, self._points)
+        coordinates = np.empty((self._ndims,) + tuple(self._size_image), dtype=np.float32)
+        for i in range(self._ndims):
+            coordinates[i] = self._calc_displacement_field(displacement_points[i], list_bases)
+        # endfor
+        coordinates += self._get_identity_grid(self._size_image)
+
+        if origin_window is not None:
+            coordinates += np.array(origin_window, dtype=np.float32).reshape((self._ndims,) + (1,) * self._ndims)
+
+        # bounding box of the input region where the deformed grid samples from
+        axes_image = tuple(range(1, self._ndims + 1))
+        begin_region = np.floor(np.min(coordinates, axis=axes_image)).astype(int)
+        end_region = np.ceil(np.max(coordinates, axis=axes_image)).astype(int) + 1
+
+        return (coordinates, begin_region, end_region)
 
     @classmethod
     def _get_type_elastic_deform(cls) -> str:
@@ -4,6 +4,8 @@ import numpy as np
 
 from common.functionutil import ImagesUtil
 
+SeedType = Union[int, Tuple[int, ...], None]
+
 
 class ImageGenerator(object):
 
@@ -24,6 +26,10 @@ class ImageGenerator(object):
     def update_image_data(self, in_shape_image: Tuple[int, ...]) -> None:
         raise NotImplementedError
 
+    def update_labels_data(self, list_in_labels: List[np.ndarray]) -> None:
+        # only for generators that use the labels to generate the images (e.g. foreground-aware windows)
+        pass
+
     def _initialize_gendata(self) -> None:
         raise NotImplementedError
 
@@ -81,11 +87,25 @@ class ImageGenerator(object):
     def get_text_description(self) -> str:
         raise NotImplementedError
 
-    def update_seed_with_index(self, seed: int, index: int) -> Union[int, None]:
-        if seed:
-            return seed + index
-        else:
+    @staticmethod
+    def update_seed_with_index(seed: SeedType, index: int) -> SeedType:
+        # seed of a sub-stream of random numbers: (seed, index)
+        if seed is None:
             return None
+        elif isinstance(seed, tuple):
+            return seed + (index,)
+        else:
+            return (seed, index)
+
+    @staticmethod
+    def get_random_state(seed: SeedType = None) -> np.random.Generator:
+        # counter-based random stream (Philox), that depends only on the seed, e.g. (base_seed, epoch, index_sample),
+        # so that any sample can be generated identically in any order, worker or process. If no seed, random stream
+        if seed is None:
+            return np.random.Generator(np.random.Philox())
+        entropy = seed if isinstance(seed, tuple) else (seed,)
+        # prepend the length, otherwise the seeds (s1, s2) and (s1, s2, 0) give the same stream
+        return np.random.Generator(np.random.Philox(np.random.SeedSequence((len(entropy),) + entropy)))
 
 
 class NullGenerator(ImageGenerator):
@@ -126,13 +146,20 @@ class CombinedImagesGenerator(ImageGenerator):
 
         self._num_images = self._get_compute_num_images()
 
+    def update_labels_data(self, list_in_labels: List[np.ndarray]) -> None:
+        for image_generator in self._list_image_generators:
+            image_generator.update_labels_data(list_in_labels)
+
     def _initialize_gendata(self) -> None:
         for image_generator in self._list_image_generators:
             image_generator._initialize_gendata()
 
     def _update_gendata(self, **kwargs) -> None:
-        for image_generator in self._list_image_generators:
-            image_generator._update_gendata(**kwargs)
+        seed = kwargs['seed'] if 'seed' in kwargs.keys() else None
+        for i, image_generator in enumerate(self._list_image_generators):
+            # a different random stream for each generator, otherwise their random parameters are correlated
+            add_kwargs = dict(kwargs, seed=self.update_seed_with_index(seed, i))
+            image_generator._update_gendata(**add_kwargs)
 
     def _get_image(self, in_image: np.ndarray) -> np.ndarray:
         out_image = in_image
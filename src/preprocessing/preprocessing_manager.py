@@ -3,13 +3,16 @@ from typing import Tuple, Dict, Union, Any
 
 from common.exceptionmanager import catch_error_exception
 from preprocessing.imagegenerator import ImageGenerator, NullGenerator, CombinedImagesGenerator
-from preprocessing.randomwindowimages import RandomWindowImages, FixedCentralWindowImages
+from preprocessing.randomwindowimages import RandomWindowImages, FixedCentralWindowImages, \
+    ForegroundRandomWindowImages
 from preprocessing.slidingwindowimages import SlidingWindowImages, SlicingImages
 from preprocessing.transformrigidimages import TransformRigidImages2D, TransformRigidImages3D
 from preprocessing.elasticdeformimages import ElasticDeformGridwiseImagesImproved as ElasticDeformImages
+from preprocessing.randomwindowtransformimages import RandomWindowTransformRigidImages, \
+    RandomWindowElasticDeformImages
 
-LIST_AVAIL_GENERATE_PATCHES = ['slide_window', 'slicing', 'random_window', 'fixed_window']
-LIST_AVAIL_TRANSFORM_IMAGES = ['rigid_trans', 'elastic_deform']
+LIST_AVAIL_GENERATE_PATCHES = ['slide_window', 'slicing', 'random_window', 'fixed_window', 'foreground_window']
+LIST_AVAIL_TRANSFORM_IMAGES = ['rigid_trans', 'rigid_trans_lattice', 'elastic_deform']
 
 
 def get_image_generator(size_images: Union[Tuple[int, int, int], Tuple[int, int]],
@@ -24,7 +27,9 @@ def get_image_generator(size_images: Union[Tuple[int, int, int], Tuple[int, int]
                         trans_flip_dirs: Union[Tuple[bool, bool, bool], Tuple[bool, bool]],
                         trans_zoom_range: Union[float, Tuple[float, float]],
                         trans_fill_mode: str,
-                        size_volume_images: Union[Tuple[int, int, int], Tuple[int, int]] = (0, 0, 0)
+                        size_volume_images: Union[Tuple[int, int, int], Tuple[int, int]] = (0, 0, 0),
+                        prob_foreground_window: float = 0.5,
+                        trans_order_interp_image: int = 0
                         ) -> ImageGenerator:
     if is_generate_patches:
         if type_generate_patches == 'slide_window':
@@ -44,6 +49,13 @@ def get_image_generator(size_images: Union[Tuple[int, int, int], Tuple[int, int]
                                                        num_random_images,
                                                        size_volume_images)
 
+        elif type_generate_patches == 'foreground_window':
+            # generate patches by random cropping window, containing foreground with a given probability...
+            image_patch_generator = ForegroundRandomWindowImages(size_images,
+                                                                 num_random_images,
+                                                                 size_volume_images,
+                                                                 prob_foreground=prob_foreground_window)
+
         elif type_generate_patches == 'fixed_window':
             # generate patches by the central cropping window...
             image_patch_generator = FixedCentralWindowImages(size_images,
@@ -60,8 +72,10 @@ def get_image_generator(size_images: Union[Tuple[int, int, int], Tuple[int, int]
     # ----------------------
 
     if is_transform_images:
-        if type_transform_images == 'rigid_trans':
+        if type_transform_images in ['rigid_trans', 'rigid_trans_lattice']:
             # generate images by random rigid transformations...
+            # (with 'rigid_trans_lattice', only transforms without interpolation, for high-throughput training)
+            is_lattice_transforms = (type_transform_images == 'rigid_trans_lattice')
             ndims = len(size_images)
             if ndims == 2:
                 image_transform_generator = TransformRigidImages2D(size_images,
@@ -71,7 +85,8 @@ def get_image_generator(size_images: Union[Tuple[int, int, int], Tuple[int, int]
                                                                    horizontal_flip=trans_flip_dirs[0],
                                                                    vertical_flip=trans_flip_dirs[1],
                                                                    zoom_range=trans_zoom_range,
-                                                                   fill_mode=trans_fill_mode)
+                                                                   fill_mode=trans_fill_mode,
+                                                                   is_lattice_transforms=is_lattice_transforms)
             elif ndims == 3:
                 image_transform_generator = TransformRigidImages3D(size_images,
                                                                    rotation_xy_range=trans_rotation_range[0],
@@ -84,7 +99,9 @@ def get_image_generator(size_images: Union[Tuple[int, int, int], Tuple[int, int]
                                                                    vertical_flip=trans_flip_dirs[1],
                                                                    axialdir_flip=trans_flip_dirs[2],
                                                                    zoom_range=trans_zoom_range,
-                                                                   fill_mode=trans_fill_mode)
+                                                                   fill_mode=trans_fill_mode,
+                                                                   is_lattice_transforms=is_lattice_transforms,
+                                                                   order_interp_image=trans_order_interp_image)
             else:
                 message = 'get_image_generator:__init__: wrong \'ndims\': %s' % (ndims)
                 catch_error_exception(message)
@@ -107,6 +124,16 @@ def get_image_generator(size_images: Union[Tuple[int, int, int], Tuple[int, int]
     if image_patch_generator is None and image_transform_generator is None:
         return NullGenerator()
 
+    elif isinstance(image_patch_generator, RandomWindowImages) \
+            and isinstance(image_transform_generator, TransformRigidImages3D):
+        # random-window cropping and rigid transformation fused: resample the patch directly from the volume
+        return RandomWindowTransformRigidImages(image_patch_generator, image_transform_generator)
+
+    elif isinstance(image_patch_generator, RandomWindowImages) \
+            and isinstance(image_transform_generator, ElasticDeformImages):
+        # random-window cropping and elastic deformation fused: deform only the patch region of the volume
+        return RandomWindowElasticDeformImages(image_patch_generator, image_transform_generator)
+
     elif image_patch_generator is not None and image_transform_generator is not None:
         # combination of two image generators
         return CombinedImagesGenerator([image_patch_generator, image_transform_generator])
@@ -124,6 +151,7 @@ def fill_missing_trans_rigid_params(in_trans_params: Union[Dict[str, Any], None]
     flip_dirs_default = (False, False, False)
     zoom_range_default = 0.0
     fill_mode_default = 'nearest'
+    order_interp_image_default = 0
 
     if in_trans_params is None:
         in_trans_params = {}
@@ -140,5 +168,7 @@ def fill_missing_trans_rigid_params(in_trans_params: Union[Dict[str, Any], None]
         in_trans_params['zoom_range'] = zoom_range_default
     if 'fill_mode' not in in_trans_params_keys:
         in_trans_params['fill_mode'] = fill_mode_default
+    if 'order_interp_image' not in in_trans_params_keys:
+        in_trans_params['order_interp_image'] = order_interp_image_default
 
     return in_trans_params
@@ -0,0 +1,134 @@
+
+from typing import Tuple
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+
+from common.exceptionmanager import catch_error_exception
+from preprocessing.imagegenerator import ImageGenerator, SeedType
+
+
+class TransformRigidBatchImages3D(object):
+    # rigid transformations (rotation, zoom, shift and flip) applied to a whole batch of images (and labels) in the
+    # device of the model, with one 'affine_grid' and one 'grid_sample' for each tensor (trilinear for the images,
+    # nearest for the labels). The random parameters are sampled as in 'TransformRigidImages3D', with the same
+    # settings as in the dictionary 'trans_rigid_params'. The batches are in "channels_first": (N, C, D, H, W)
+    _dict_padding_modes = {'nearest': 'border',
+                           'constant': 'zeros',
+                           'reflect': 'reflection',
+                           'mirror': 'reflection'}
+
+    def __init__(self,
+                 size_image: Tuple[int, int, int],
+                 rotation_range: Tuple[float, float, float] = (0.0, 0.0, 0.0),
+                 shift_range: Tuple[float, float, float] = (0.0, 0.0, 0.0),
+                 flip_dirs: Tuple[bool, bool, bool] = (False, False, False),
+                 zoom_range: float = 0.0,
+                 fill_mode: str = 'nearest',
+                 seed: SeedType = None
+                 ) -> None:
+        if len(size_image) != 3:
+            message = 'TransformRigidBatchImages3D:__init__: wrong \'ndims\': %s' % (len(size_image))
+            catch_error_exception(message)
+        if fill_mode not in self._dict_padding_modes.keys():
+            message = 'TransformRigidBatchImages3D:__init__: fill mode not available: \'%s\'. Options: \'%s\'' \
+                      % (fill_mode, ', '.join(self._dict_padding_modes.keys()))
+            catch_error_exception(message)
+
+        self._size_image = size_image
+        # (rotation in the planes: (xy, xz, yz), in degrees)
+        (self._rotation_xy_range, self._rotation_xz_range, self._rotation_yz_range) = rotation_range
+        # (shift in the axes: (height, width, depth), in fraction of the image size if < 1, or in voxels)
+        (self._height_shift_range, self._width_shift_range, self._depth_shift_range) = shift_range
+        # (flip of the axes: (horizontal, vertical, axialdir))
+        (self._horizontal_flip, self._vertical_flip, self._axialdir_flip) = flip_dirs
+        self._zoom_range = (1 - zoom_range, 1 + zoom_range)
+        self._padding_mode = self._dict_padding_modes[fill_mode]
+        self._random_state = ImageGenerator.get_random_state(seed)
+
+    def _calc_random_transform_matrix(self) -> np.ndarray:
+        # matrix (in voxel coordinates (z, x, y), around the center of the image) that maps the output to the input
+        random_state = self._random_state
+
+        angle_xy = np.deg2rad(random_state.uniform(-self._rotation_xy_range, self._rotation_xy_range))
+        angle_xz = np.deg2rad(random_state.uniform(-self._rotation_xz_range, self._rotation_xz_range))
+        angle_yz = np.deg2rad(random_state.uniform(-self._rotation_yz_range, self._rotation_yz_range))
+
+        shift_ranges = np.array([self._depth_shift_range, self._height_shift_range, self._width_shift_range])
+        (tz, tx, ty) = random_state.uniform(-shift_ranges, shift_ranges) \
+            * np.where(shift_ranges < 1, self._size_image, 1)
+
+        (zx, zy, zz) = random_state.uniform(self._zoom_range[0], self._zoom_range[1], 3)
+
+        flip_horizontal = (random_state.random() < 0.5) * self._horizontal_flip
+        flip_vertical = (random_state.random() < 0.5) * self._vertical_flip
+        flip_axialdir = (random_state.random() < 0.5) * self._axialdir_flip
+
+        rotation_xy_matrix = np.array([[1, 0, 0],
+                                       [0, np.cos(angle_xy), -np.sin(angle_xy)],
+                                       [0, np.sin(angle_xy), np.cos(angle_xy)]])
+        rotation_xz_matrix = np.array([[np.cos(angle_xz), np.sin(angle_xz), 0],
+                                       [-np.sin(angle_xz), np.cos(angle_xz), 0],
+                                       [0, 0, 1]])
+        rotation_yz_matrix = np.array([[np.cos(angle_yz), 0, np.sin(angle_yz)],
+                                       [0, 1, 0],
+                                       [-np.sin(angle_yz), 0, np.cos(angle_yz)]])
+        zoom_matrix = np.diag([zz, zx, zy])
+        # (flip the output coordinates, before the transformation)
+        flip_matrix = np.diag([-1 if flip_axialdir else 1,
+                               -1 if flip_vertical else 1,
+                               -1 if flip_horizontal else 1])
+
+        rotation_matrix = np.linalg.multi_dot([rotation_xy_matrix, rotation_xz_matrix, rotation_yz_matrix])
+
+        # composed as in 'TransformRigidImages3D': rotation * shift * zoom, with the flips first
+        transform_matrix = np.eye(4)
+        transform_matrix[:3, :3] = np.linalg.multi_dot([rotation_matrix, zoom_matrix, flip_matrix])
+        transform_matrix[:3, 3] = np.dot(rotation_matrix, [tz, tx, ty])
+        return transform_matrix
+
+    @staticmethod
+    def _get_theta_affine_grid(list_transform_matrix: np.ndarray, size_image: Tuple[int, int, int]) -> np.ndarray:
+        # transform the matrices to the normalized coordinates in 'affine_grid' (in [-1, 1], with align corners),
+        # with the axes in reverse order: (x, y, z) for (W, H, D)
+        scale_coords = (np.array(size_image, dtype=np.float64) - 1) / 2
+        scale_coords = np.maximum(scale_coords, 0.5)
+        out_theta = np.empty((len(list_transform_matrix), 3, 4))
+        out_theta[:, :, :3] = list_transform_matrix[:, :3, :3] * scale_coords[np.newaxis, np.newaxis, :] \
+            / scale_coords[np.newaxis, :, np.newaxis]
+        out_theta[:, :, 3] = list_transform_matrix[:, :3, 3] / scale_coords[np.newaxis, :]
+        return out_theta[:, ::-1, :][:, :, [2, 1, 0, 3]]
+
+    def _get_batch_transformed(self, in_batch_data: torch.Tensor, list_transform_matrix: np.ndarray, mode: str
+                               ) -> torch.Tensor:
+        # (the labels can be smaller than the images, when cropped with valid convolutions: the transformation is
+        # done around the same center, the center of both)
+        theta = self._get_theta_affine_grid(list_transform_matrix, tuple(in_batch_data.shape[2:]))
+        theta = torch.from_numpy(np.ascontiguousarray(theta)).to(in_batch_data.device, dtype=in_batch_data.dtype)
+        grid = F.affine_grid(theta, list(in_batch_data.shape), align_corners=True)
+        return F.grid_sample(in_batch_data, grid, mode=mode, padding_mode=self._padding_mode, align_corners=True)
+
+    def get_batch_images(self, in_batch_xdata: torch.Tensor) -> torch.Tensor:
+        list_transform_matrix = np.array([self._calc_random_transform_matrix() for _ in range(in_batch_xdata.shape[0])])
+        return self._get_batch_transformed(in_batch_xdata, list_transform_matrix, mode='bilinear')
+
+    def get_batch_2images(self, in_batch_xdata: torch.Tensor, in_batch_ydata: torch.Tensor
+                          ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # the same transformation to each pair of image and labels
+        list_transform_matrix = np.array([self._calc_random_transform_matrix() for _ in range(in_batch_xdata.shape[0])])
+        out_batch_xdata = self._get_batch_transformed(in_batch_xdata, list_transform_matrix, mode='bilinear')
+        out_batch_ydata = self._get_batch_transformed(in_batch_ydata, list_transform_matrix, mode='nearest')
+        return (out_batch_xdata, out_batch_ydata)
+
+    def get_text_description(self) -> str:
+        message = 'Rigid 3D transformations of batches in the device, with parameters...\n'
+        message += '- rotation range: \'%s\', \'%s\', \'%s\'...\n' \
+                   % (self._rotation_xy_range, self._rotation_xz_range, self._rotation_yz_range)
+        message += '- shift range: \'%s\', \'%s\', \'%s\'...\n' \
+                   % (self._height_shift_range, self._width_shift_range, self._depth_shift_range)
+        message += '- flip dirs: \'%s\', \'%s\', \'%s\'...\n' \
+                   % (self._horizontal_flip, self._vertical_flip, self._axialdir_flip)
+        message += '- zoom range: \'%s\'...\n' % (str(self._zoom_range))
+        message += '- fill mode: \'%s\'...\n' % (self._padding_mode)
+        return message
@@ -1,11 +1,11 @@
 
-from typing import Tuple, Union
+from typing import Tuple, List, Union
 import numpy as np
 
 from common.exceptionmanager import catch_error_exception
 from imageoperators.boundingboxes import BoundingBoxes, BoundBox3DType, BoundBox2DType
 from imageoperators.imageoperator import CropImage
-from preprocessing.imagegenerator import ImageGenerator
+from preprocessing.imagegenerator import ImageGenerator, SeedType
 
 
 class RandomWindowImages(ImageGenerator):
@@ -43,14 +43,14 @@ class RandomWindowImages(ImageGenerator):
     def _get_image(self, in_image: np.ndarray) -> np.ndarray:
         return self._func_crop_images(in_image, self._crop_boundbox)
 
-    def get_cropped_image(self, in_image: np.ndarray, seed: int = None) -> np.ndarray:
+    def get_cropped_image(self, in_image: np.ndarray, seed: SeedType = None) -> np.ndarray:
         crop_boundbox = self._get_crop_boundbox_image(seed)
         return self._func_crop_images(in_image, crop_boundbox)
 
-    def _get_crop_boundbox_image(self, seed: int) -> Union[BoundBox3DType, BoundBox2DType]:
+    def _get_crop_boundbox_image(self, seed: SeedType) -> Union[BoundBox3DType, BoundBox2DType]:
         return self._get_random_crop_boundbox_image(seed)
 
-    def _get_random_crop_boundbox_image(self, seed: int = None) -> Union[BoundBox3DType, BoundBox2DType]:
+    def _get_random_crop_boundbox_image(self, seed: SeedType = None) -> Union[BoundBox3DType, BoundBox2DType]:
         origin_crop_boundbox = self._get_random_origin_crop_boundbox_image(seed)
 
         crop_boundbox = []
@@ -64,14 +64,14 @@ class RandomWindowImages(ImageGenerator):
         else:
             return (crop_boundbox[0], crop_boundbox[1])
 
-    def _get_random_origin_crop_boundbox_image(self, seed: int = None) -> Union[Tuple[int, int, int], Tuple[int, int]]:
-        if seed is not None:
-            np.random.seed(seed)
+    def _get_random_origin_crop_boundbox_image(self, seed: SeedType = None
+                                               ) -> Union[Tuple[int, int, int], Tuple[int, int]]:
+        random_state = self.get_random_state(seed)
 
         origin_crop_boundbox = []
         for i in range(self._ndims):
             searching_space_1d = self._size_volume_image[i] - self._size_image[i]
-            origin_1d = np.random.randint(searching_space_1d + 1)
+            origin_1d = random_state.integers(searching_space_1d + 1)
             origin_crop_boundbox.append(origin_1d)
 
         if self._ndims == 3:
@@ -86,6 +86,114 @@ class RandomWindowImages(ImageGenerator):
         return message
 
 
+class ForegroundRandomWindowImages(RandomWindowImages):
+    # random windows that contain foreground (label) voxels with probability 'prob_foreground': the window is placed
+    # around a voxel drawn from an index of the foreground voxels, computed once per label volume, at the first window
+    # in the volume (from the labels passed in 'label_data'). Otherwise, the window is drawn uniformly inside the
+    # bounding-box of the region of interest (voxels not masked in the labels)
+    _value_mask_exclude = -1
+    _prob_foreground_default = 0.5
+
+    def __init__(self,
+                 size_image: Union[Tuple[int, int, int], Tuple[int, int]],
+                 num_images: int,
+                 size_volume_image: Union[Tuple[int, int, int], Tuple[int, int]] = (0, 0, 0),
+                 prob_foreground: float = _prob_foreground_default
+                 ) -> None:
+        super(ForegroundRandomWindowImages, self).__init__(size_image, num_images, size_volume_image)
+
+        if prob_foreground < 0.0 or prob_foreground > 1.0:
+            message = 'ForegroundRandomWindowImages:__init__: wrong \'prob_foreground\': %s' % (prob_foreground)
+            catch_error_exception(message)
+
+        self._prob_foreground = prob_foreground
+        self._list_indexes_foreground = []
+        self._list_boundbox_roi = []
+
+    def update_labels_data(self, list_in_labels: List[np.ndarray]) -> None:
+        # the labels are indexed lazily, not to read here all the label volumes when they are loaded on demand
+        # (chunked files, memory-mapped files, or working set of volumes)
+        self._list_indexes_foreground = [None] * len(list_in_labels)
+        self._list_boundbox_roi = [None] * len(list_in_labels)
+
+    def _compute_index_labels(self, in_label: np.ndarray, index_file: int) -> None:
+        # indexes (flattened) of the foreground voxels, and bounding-box of the region of interest, of label volume
+        in_label = np.asarray(in_label)
+        dtype_indexes = np.int32 if in_label.size <= np.iinfo(np.int32).max else np.int64
+        indexes_foreground = np.flatnonzero(in_label > 0).astype(dtype_indexes)
+
+        is_voxels_roi = (in_label != self._value_mask_exclude)
+        boundbox_roi = []
+        for i in range(self._ndims):
+            axes_other = tuple(j for j in range(in_label.ndim) if j != i)
+            is_roi_slices = np.any(is_voxels_roi, axis=axes_other)
+            indexes_roi_slices = np.flatnonzero(is_roi_slices)
+            if len(indexes_roi_slices) > 0:
+                boundbox_roi.append((indexes_roi_slices[0], indexes_roi_slices[-1] + 1))
+            else:
+                boundbox_roi.append((0, in_label.shape[i]))
+        # endfor
+
+        self._list_indexes_foreground[index_file] = indexes_foreground
+        self._list_boundbox_roi[index_file] = tuple(boundbox_roi)
+
+    def _update_gendata(self, **kwargs) -> None:
+        seed = kwargs['seed']
+        index_file = kwargs['index_file'] if 'index_file' in kwargs.keys() else None
+        label_data = kwargs['label_data'] if 'label_data' in kwargs.keys() else None
+
+        if index_file is not None and index_file < len(self._list_indexes_foreground) \
+                and self._list_indexes_foreground[index_file] is None and label_data is not None:
+            self._compute_index_labels(label_data, index_file)
+
+        if index_file is None or index_file >= len(self._list_indexes_foreground) \
+                or self._list_indexes_foreground[index_file] is None:
+            # without the labels indexed: uniform random windows
+            self._crop_boundbox = self._get_random_crop_boundbox_image(seed)
+        else:
+            self._crop_boundbox = self._get_foreground_crop_boundbox_image(seed, index_file)
+
+    def _get_foreground_crop_boundbox_image(self, seed: SeedType, index_file: int
+                                            ) -> Union[BoundBox3DType, BoundBox2DType]:
+        random_state = self.get_random_state(seed)
+        indexes_foreground = self._list_indexes_foreground[index_file]
+
+        origin_crop_boundbox = []
+        if len(indexes_foreground) > 0 and random_state.random() < self._prob_foreground:
+            # window containing a random foreground voxel, at a random position inside the window
+            index_voxel = indexes_foreground[random_state.integers(len(indexes_foreground))]
+            coords_voxel = np.unravel_index(index_voxel, self._size_volume_image)
+            for i in range(self._ndims):
+                origin_1d = coords_voxel[i] - random_state.integers(self._size_image[i])
+                origin_crop_boundbox.append(origin_1d)
+        else:
+            boundbox_roi = self._list_boundbox_roi[index_file]
+            for i in range(self._ndims):
+                searching_space_1d = max(boundbox_roi[i][1] - boundbox_roi[i][0] - self._size_image[i], 0)
+                origin_1d = boundbox_roi[i][0] + random_state.integers(searching_space_1d + 1)
+                origin_crop_boundbox.append(origin_1d)
+
+        crop_boundbox = []
+        for i in range(self._ndims):
+            # fit the window inside the volume
+            limit_left = int(np.clip(origin_crop_boundbox[i], 0,
+                                     max(self._size_volume_image[i] - self._size_image[i], 0)))
+            limit_right = limit_left + self._size_image[i]
+            crop_boundbox.append((limit_left, limit_right))
+
+        if self._ndims == 3:
+            return (crop_boundbox[0], crop_boundbox[1], crop_boundbox[2])
+        else:
+            return (crop_boundbox[0], crop_boundbox[1])
+
+    def get_text_description(self) -> str:
+        message = 'Foreground-aware random-window generation of image patches:\n'
+        message += '- size image: \'%s\', size volume: \'%s\', num random patches: \'%s\'...\n' \
+                   % (str(self._size_image), str(self._size_volume_image), self._num_images)
+        message += '- probability of windows with foreground: \'%s\'...\n' % (self._prob_foreground)
+        return message
+
+
 class FixedCentralWindowImages(RandomWindowImages):
 
     def __init__(self,
@@ -97,10 +205,10 @@ class FixedCentralWindowImages(RandomWindowImages):
     def _update_gendata(self, **kwargs) -> None:
         self._crop_boundbox = self._get_central_crop_boundbox_image()
 
-    def _get_crop_boundbox_image(self, seed: int) -> Union[BoundBox3DType, BoundBox2DType]:
+    def _get_crop_boundbox_image(self, seed: SeedType) -> Union[BoundBox3DType, BoundBox2DType]:
         return self._get_central_crop_boundbox_image()
 
-    def _get_central_crop_boundbox_image(self, seed: int = None) -> Union[BoundBox3DType, BoundBox2DType]:
+    def _get_central_crop_boundbox_image(self, seed: SeedType = None) -> Union[BoundBox3DType, BoundBox2DType]:
         crop_boundbox = BoundingBoxes.calc_boundbox_centered_image_fitimg(self._size_image,
                                                                           self._size_volume_image)
         if self._ndims == 3:
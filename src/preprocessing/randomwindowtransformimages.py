@@ -0,0 +1,186 @@
+
+from typing import Tuple, List
+import numpy as np
+import scipy.ndimage as ndi
+
+from common.exceptionmanager import catch_error_exception
+from common.functionutil import ImagesUtil
+from preprocessing.imagegenerator import ImageGenerator
+from preprocessing.elasticdeformimages import ElasticDeformGridwiseImagesImproved
+from preprocessing.randomwindowimages import RandomWindowImages
+from preprocessing.transformrigidimages import TransformRigidImages, TransformRigidImages3D
+
+_epsilon = 1e-6
+
+
+class RandomWindowTransformRigidImages(ImageGenerator):
+    # fused random-window cropping and rigid transformation: the grid of the output patch is mapped through the
+    # transform straight into the full volume, and only the neighbourhood needed is resampled, in one pass.
+    # Compared to cropping first and transforming the patch, there is no fill of the corners with reflected data
+    _size_margin_interp = 2
+    # fill modes for which the prefilter does not need padding of the input (as done inside 'affine_transform')
+    _list_fill_modes_prefilter_region = ['reflect', 'mirror', 'grid-mirror']
+
+    def __init__(self,
+                 random_window_generator: RandomWindowImages,
+                 transform_generator: TransformRigidImages3D
+                 ) -> None:
+        self._random_window_generator = random_window_generator
+        self._transform_generator = transform_generator
+
+        size_image = random_window_generator.get_size_image()
+        if len(size_image) != 3:
+            message = 'RandomWindowTransformRigidImages:__init__: wrong \'ndims\': %s' % (len(size_image))
+            catch_error_exception(message)
+
+        super(RandomWindowTransformRigidImages, self).__init__(size_image, random_window_generator.get_num_images())
+
+        self._initialize_gendata()
+
+    def update_image_data(self, in_shape_image: Tuple[int, ...]) -> None:
+        self._random_window_generator.update_image_data(in_shape_image)
+        self._transform_generator.update_image_data(in_shape_image)
+
+    def update_labels_data(self, list_in_labels: List[np.ndarray]) -> None:
+        self._random_window_generator.update_labels_data(list_in_labels)
+
+    def _initialize_gendata(self) -> None:
+        self._transform_matrix_volume = None
+        self._count_trans_in_images = 0
+
+    def _update_gendata(self, **kwargs) -> None:
+        # same random streams as for these generators in 'CombinedImagesGenerator'
+        seed = kwargs['seed'] if 'seed' in kwargs.keys() else None
+        self._random_window_generator._update_gendata(**dict(kwargs, seed=self.update_seed_with_index(seed, 0)))
+        self._transform_generator._update_gendata(**dict(kwargs, seed=self.update_seed_with_index(seed, 1)))
+
+        # transform from the output patch to the volume: 1st the rigid transform in the patch, 2nd shift to the
+        # origin of the random window
+        origin_crop_boundbox = [limits[0] for limits in self._random_window_generator._crop_boundbox]
+        self._transform_matrix_volume = self._transform_generator.get_transform_matrix_with_flips().copy()
+        self._transform_matrix_volume[:3, 3] += origin_crop_boundbox
+        self._count_trans_in_images = 0
+
+    def _get_image(self, in_image: np.ndarray) -> np.ndarray:
+        is_type_input_image = (self._count_trans_in_images == 0)
+        self._count_trans_in_images += 1
+
+        if ImagesUtil.is_without_channels(self._size_image, in_image.shape):
+            in_image = np.expand_dims(in_image, axis=-1)
+            is_reshape_input_image = True
+        else:
+            is_reshape_input_image = False
+
+        out_image = self._get_transformed_window_image(in_image, is_type_input_image)
+
+        if is_type_input_image:
+            transform_params = self._transform_generator._transform_params
+            if transform_params.get('channel_shift_intensity') is not None:
+                out_image = self._transform_generator._apply_channel_shift(out_image,
+                                                                           transform_params['channel_shift_intensity'],
+                                                                           channel_axis=3)
+            out_image = self._transform_generator._standardize(out_image)
+
+        if is_reshape_input_image:
+            out_image = np.squeeze(out_image, axis=-1)
+        return out_image
+
+    def _get_transformed_window_image(self, in_image: np.ndarray, is_type_input_image: bool) -> np.ndarray:
+        fill_mode = self._transform_generator._fill_mode
+        cval = self._transform_generator._cval
+        if is_type_input_image:
+            order_interp = self._transform_generator._order_interp_image
+        else:
+            order_interp = self._transform_generator._order_interp_mask
+
+        # bounding box in the volume of the output patch mapped through the transform, with a margin for the
+        # support of the interpolation (and the spline prefilter)
+        affine_matrix = self._transform_matrix_volume[:3, :3]
+        offset = self._transform_matrix_volume[:3, 3]
+        corners_patch = np.array(np.meshgrid(*[[0, size - 1] for size in self._size_image], indexing='ij'))
+        corners_volume = np.dot(affine_matrix, corners_patch.reshape(3, -1)) + offset[:, np.newaxis]
+        size_margin = self._size_margin_interp * (order_interp + 1)
+        begin_region = np.floor(np.min(corners_volume, axis=1) + _epsilon).astype(int) - size_margin
+        end_region = np.ceil(np.max(corners_volume, axis=1) - _epsilon).astype(int) + size_margin + 1
+        begin_region = np.clip(begin_region, 0, in_image.shape[:3])
+        end_region = np.maximum(np.clip(end_region, 0, in_image.shape[:3]), begin_region + 1)
+        in_region_image = in_image[begin_region[0]:end_region[0],
+                                   begin_region[1]:end_region[1],
+                                   begin_region[2]:end_region[2]]
+        transform_matrix_region = self._transform_matrix_volume.copy()
+        transform_matrix_region[:3, 3] -= begin_region
+
+        lattice_transform = TransformRigidImages._get_lattice_transform(transform_matrix_region)
+        if lattice_transform is not None:
+            # exact operation in the voxel grid: slice the volume, no interpolation
+            out_image = TransformRigidImages._apply_lattice_transform(in_region_image, lattice_transform,
+                                                                      channel_axis=3, fill_mode=fill_mode, cval=cval,
+                                                                      size_output=self._size_image)
+            if out_image is not None:
+                return out_image
+
+        out_image = np.empty(self._size_image + in_image.shape[3:], dtype=in_image.dtype)
+        for i_channel in range(in_image.shape[3]):
+            in_region_channel = in_region_image[..., i_channel]
+            if order_interp > 1 and fill_mode in self._list_fill_modes_prefilter_region:
+                # compute the spline coefficients (only in the region) in single precision, faster than the
+                # prefilter inside 'affine_transform' (in double precision)
+                in_region_channel = ndi.spline_filter(in_region_channel, order=order_interp, output=np.float32,
+                                                      mode=fill_mode)
+                is_prefilter = False
+            else:
+                is_prefilter = True
+            ndi.affine_transform(in_region_channel, affine_matrix, transform_matrix_region[:3, 3],
+                                 output_shape=self._size_image, output=out_image[..., i_channel],
+                                 order=order_interp, mode=fill_mode, cval=cval, prefilter=is_prefilter)
+        return out_image
+
+    def get_text_description(self) -> str:
+        message = 'Random-window patches with rigid transformations, fused: resampled directly from the volume...\n'
+        message += self._random_window_generator.get_text_description()
+        message += self._transform_generator.get_text_description()
+        return message
+
+
+class RandomWindowElasticDeformImages(ImageGenerator):
+    # fused random-window cropping and elastic deformation: the deformed grid of the output patch is placed at the
+    # origin of the random window and sampled from the full volume. Only the voxels in the patch are interpolated,
+    # and near the patch borders the deformation takes real voxels from around the window
+
+    def __init__(self,
+                 random_window_generator: RandomWindowImages,
+                 elastic_deform_generator: ElasticDeformGridwiseImagesImproved
+                 ) -> None:
+        self._random_window_generator = random_window_generator
+        self._elastic_deform_generator = elastic_deform_generator
+
+        super(RandomWindowElasticDeformImages, self).__init__(random_window_generator.get_size_image(),
+                                                              random_window_generator.get_num_images())
+
+    def update_image_data(self, in_shape_image: Tuple[int, ...]) -> None:
+        self._random_window_generator.update_image_data(in_shape_image)
+        self._elastic_deform_generator.update_image_data(in_shape_image)
+
+    def update_labels_data(self, list_in_labels: List[np.ndarray]) -> None:
+        self._random_window_generator.update_labels_data(list_in_labels)
+
+    def _initialize_gendata(self) -> None:
+        self._random_window_generator._initialize_gendata()
+        self._elastic_deform_generator._initialize_gendata()
+
+    def _update_gendata(self, **kwargs) -> None:
+        # same random streams as for these generators in 'CombinedImagesGenerator'
+        seed = kwargs['seed'] if 'seed' in kwargs.keys() else None
+        self._random_window_generator._update_gendata(**dict(kwargs, seed=self.update_seed_with_index(seed, 0)))
+        origin_crop_boundbox = tuple(limits[0] for limits in self._random_window_generator._crop_boundbox)
+        self._elastic_deform_generator._update_gendata(**dict(kwargs, seed=self.update_seed_with_index(seed, 1),
+                                                              origin_window=origin_crop_boundbox))
+
+    def _get_image(self, in_image: np.ndarray) -> np.ndarray:
+        return self._elastic_deform_generator._get_image(in_image)
+
+    def get_text_description(self) -> str:
+        message = 'Random-window patches with elastic deformations, fused: sampled directly from the volume...\n'
+        message += self._random_window_generator.get_text_description()
+        message += self._elastic_deform_generator.get_text_description()
+        return message
@@ -21,8 +21,9 @@ class SlidingWindowImages(ImageGenerator):
         self._prop_overlap_images = prop_overlap_images
         self._size_volume_image = size_volume_image
 
-        self._num_images_dirs = self._get_num_images_dirs()
-        self._num_images = np.prod(self._num_images_dirs)
+        # geometry of the sliding-window (num images and limits of the windows in each dir), cached per volume size
+        self._dict_cache_geometry = {}
+        self._update_geometry_sliding_window()
 
         if self._ndims == 2:
             self._func_get_indexes_local = self.get_indexes_local_2dim
@@ -81,8 +82,17 @@ class SlidingWindowImages(ImageGenerator):
         return (index_z, index_x, index_y)
 
     def update_image_data(self, in_shape_image: Tuple[int, ...]) -> None:
-        self._size_volume_image = in_shape_image[0:self._ndims]
-        self._num_images_dirs = self._get_num_images_dirs()
+        self._size_volume_image = tuple(in_shape_image[0:self._ndims])
+        self._update_geometry_sliding_window()
+
+    def _update_geometry_sliding_window(self) -> None:
+        size_volume_image = tuple(self._size_volume_image)
+        if size_volume_image not in self._dict_cache_geometry:
+            num_images_dirs = self._get_num_images_dirs()
+            limits_window_image = self.get_limits_sliding_window_image(num_images_dirs)
+            self._dict_cache_geometry[size_volume_image] = (num_images_dirs, limits_window_image)
+
+        (self._num_images_dirs, self._limits_window_image) = self._dict_cache_geometry[size_volume_image]
         self._num_images = np.prod(self._num_images_dirs)
 
     def _initialize_gendata(self) -> None:
@@ -103,10 +113,7 @@ class SlidingWindowImages(ImageGenerator):
         indexes_local = self._func_get_indexes_local(index, self._num_images_dirs)
         crop_boundbox = []
         for i in range(self._ndims):
-            (limit_left, limit_right) = self.get_limits_image_1d(indexes_local[i], self._size_image[i],
-                                                                 self._prop_overlap_images[i],
-                                                                 self._size_volume_image[i])
-            crop_boundbox.append((limit_left, limit_right))
+            crop_boundbox.append(self._limits_window_image[i][indexes_local[i]])
 
         if self._ndims == 3:
             return (crop_boundbox[0], crop_boundbox[1], crop_boundbox[2])
@@ -126,13 +133,16 @@ class SlidingWindowImages(ImageGenerator):
         else:
             return (num_images_dirs[0], num_images_dirs[1])
 
-    def get_limits_sliding_window_image(self) -> List[List[Tuple[int, int]]]:
+    def get_limits_sliding_window_image(self, num_images_dirs: Union[Tuple[int, int, int], Tuple[int, int]] = None
+                                        ) -> List[List[Tuple[int, int]]]:
+        if num_images_dirs is None:
+            num_images_dirs = self._num_images_dirs
         limits_window_image = []
         for i in range(self._ndims):
             limits_image_1dir = \
                 [self.get_limits_image_1d(index, self._size_image[i],
                                           self._prop_overlap_images[i],
-                                          self._size_volume_image[i]) for index in range(self._num_images_dirs[i])]
+                                          self._size_volume_image[i]) for index in range(num_images_dirs[i])]
             limits_window_image.append(limits_image_1dir)
 
         return limits_window_image
@@ -143,7 +153,7 @@ class SlidingWindowImages(ImageGenerator):
                    % (str(self._size_image), str(self._prop_overlap_images), str(self._size_volume_image))
         message += '- num images total: \'%s\', and num images in each direction: \'%s\'...\n' \
                    % (self._num_images, str(self._num_images_dirs))
-        limits_window_image = self.get_limits_sliding_window_image()
+        limits_window_image = self._limits_window_image
         for i in range(self._ndims):
             message += '- limits bound-boxes in dir \'%s\': \'%s\'...\n' % (i, str(limits_window_image[i]))
 
@@ -5,9 +5,12 @@ import scipy.ndimage as ndi
 
 from common.exceptionmanager import catch_error_exception
 from common.functionutil import ImagesUtil
-from preprocessing.imagegenerator import ImageGenerator
+from preprocessing.imagegenerator import ImageGenerator, SeedType
 
 _epsilon = 1e-6
+# equivalent modes in 'np.pad' to the fill modes in 'ndi.affine_transform' (for the transforms without interpolation)
+_DICT_FILL_MODES_NUMPY_PAD = {'nearest': 'edge', 'reflect': 'symmetric', 'mirror': 'reflect', 'constant': 'constant',
+                              'grid-constant': 'constant', 'grid-mirror': 'symmetric', 'grid-wrap': 'wrap'}
 
 
 class TransformRigidImages(ImageGenerator):
@@ -53,6 +56,17 @@ class TransformRigidImages(ImageGenerator):
         self._is_inverse_transform = is_inverse_transform
         self._initialize_gendata()
 
+    def _calc_random_angle(self, random_state: np.random.Generator, rotation_range: float,
+                           size_plane: Tuple[int, int]) -> float:
+        if not rotation_range:
+            return 0
+        elif self._is_lattice_transforms:
+            # only multiples of 90 deg (or of 180 deg if the plane is not square, to keep the size of the image)
+            step_angle = 1 if (size_plane[0] == size_plane[1]) else 2
+            return np.pi / 2 * step_angle * random_state.integers(4 // step_angle)
+        else:
+            return np.deg2rad(random_state.uniform(-rotation_range, rotation_range))
+
     def update_image_data(self, in_shape_image: Tuple[int, ...]) -> None:
         # self._num_images = in_shape_image[0]
         pass
@@ -110,10 +124,10 @@ class TransformRigidImages(ImageGenerator):
     def _calc_inverse_transformed_image(self, in_array: np.ndarray, is_type_input_image: bool = False) -> np.ndarray:
         raise NotImplementedError
 
-    def _calc_gendata_random_transform(self, seed: int = None) -> Tuple[np.ndarray, Dict[str, Any]]:
+    def _calc_gendata_random_transform(self, seed: SeedType = None) -> Tuple[np.ndarray, Dict[str, Any]]:
         raise NotImplementedError
 
-    def _calc_gendata_inverse_random_transform(self, seed: int = None) -> Tuple[np.ndarray, Dict[str, Any]]:
+    def _calc_gendata_inverse_random_transform(self, seed: SeedType = None) -> Tuple[np.ndarray, Dict[str, Any]]:
         raise NotImplementedError
 
     def _standardize(self, in_image: np.ndarray) -> np.ndarray:
@@ -193,12 +207,75 @@ class TransformRigidImages(ImageGenerator):
 
         return in_image
 
+    @staticmethod
+    def _get_lattice_transform(transform_matrix: np.ndarray) -> Union[Tuple[np.ndarray, np.ndarray, np.ndarray], None]:
+        # check whether the transform is an exact operation in the voxel grid: axes permutation + flips (the matrix
+        # has one entry +-1 per row and column) and integer shift. If so, return (axes_output, signs, offsets)
+        ndims = transform_matrix.shape[0] - 1
+        affine_matrix = transform_matrix[:ndims, :ndims]
+        offset = transform_matrix[:ndims, ndims]
+        round_matrix = np.round(affine_matrix)
+        round_offset = np.round(offset)
+        if np.any(np.abs(affine_matrix - round_matrix) > _epsilon) or np.any(np.abs(offset - round_offset) > _epsilon):
+            return None
+        if np.any(np.sum(np.abs(round_matrix), axis=0) != 1) or np.any(np.sum(np.abs(round_matrix), axis=1) != 1):
+            return None
+        axes_output = np.argmax(np.abs(round_matrix), axis=1)
+        signs = round_matrix[np.arange(ndims), axes_output].astype(int)
+        return (axes_output, signs, round_offset.astype(int))
+
+    @staticmethod
+    def _apply_lattice_transform(in_image: np.ndarray, lattice_transform: Tuple[np.ndarray, np.ndarray, np.ndarray],
+                                 channel_axis: int = 0, fill_mode: str = 'nearest', cval: float = 0.0,
+                                 size_output: Tuple[int, ...] = None
+                                 ) -> Union[np.ndarray, None]:
+        # apply the transform with strided slicing (and padding, if out of bounds), without interpolation.
+        # The same as 'affine_transform': the input coordinate along axis 'j' is 'signs[j] * out[axes_output[j]]
+        # + offsets[j]', and the output has the same shape as the input (if not given 'size_output')
+        (axes_output, signs, offsets) = lattice_transform
+        if fill_mode not in _DICT_FILL_MODES_NUMPY_PAD.keys():
+            return None
+
+        in_image = np.moveaxis(in_image, channel_axis, -1)
+        ndims = len(axes_output)
+        list_slices = []
+        list_pad_widths = []
+        for j in range(ndims):
+            size_out = size_output[axes_output[j]] if size_output else in_image.shape[axes_output[j]]
+            begin_in = offsets[j] if signs[j] > 0 else offsets[j] - (size_out - 1)
+            end_in = begin_in + size_out - 1
+            pad_width = (max(0, -begin_in), max(0, end_in - (in_image.shape[j] - 1)))
+            begin_in += pad_width[0]
+            end_in += pad_width[0]
+            if signs[j] > 0:
+                list_slices.append(slice(begin_in, end_in + 1))
+            else:
+                list_slices.append(slice(end_in, begin_in - 1 if begin_in > 0 else None, -1))
+            list_pad_widths.append(pad_width)
+        # endfor
+
+        if any(pad_width != (0, 0) for pad_width in list_pad_widths):
+            list_pad_widths.append((0, 0))
+            mode_pad = _DICT_FILL_MODES_NUMPY_PAD[fill_mode]
+            if mode_pad == 'constant':
+                in_image = np.pad(in_image, list_pad_widths, mode=mode_pad, constant_values=cval)
+            else:
+                in_image = np.pad(in_image, list_pad_widths, mode=mode_pad)
+
+        out_image = in_image[tuple(list_slices)]
+        # reorder the axes: the input axis 'j' goes to the output axis 'axes_output[j]'
+        out_image = np.transpose(out_image, list(np.argsort(axes_output)) + [ndims])
+        # copy, so that the output does not share memory with the input volume
+        out_image = np.ascontiguousarray(np.moveaxis(out_image, -1, channel_axis))
+        return out_image
+
     @staticmethod
     def _flip_axis(in_image: np.ndarray, axis: int) -> np.ndarray:
         in_image = np.asarray(in_image).swapaxes(axis, 0)
         in_image = in_image[::-1, ...]
         in_image = in_image.swapaxes(0, axis)
-        return in_image
+        # copy, not a view with negative strides
+        return np.ascontiguousarray(in_image)
 
     @staticmethod
     def _apply_channel_shift(in_image: np.ndarray, intensity: int, channel_axis: int = 0) -> np.ndarray:
@@ -242,7 +319,8 @@ class TransformRigidImages2D(TransformRigidImages):
                  horizontal_flip: bool = False,
                  vertical_flip: bool = False,
                  rescale_factor: float = None,
-                 preprocessing_function: Callable[[np.ndarray], np.ndarray] = None
+                 preprocessing_function: Callable[[np.ndarray], np.ndarray] = None,
+                 is_lattice_transforms: bool = False
                  ) -> None:
         self._rotation_range = rotation_range
         self._width_shift_range = width_shift_range
@@ -268,6 +346,13 @@ class TransformRigidImages2D(TransformRigidImages):
                 message = '\'brightness_range\' should be a tuple of two floats. Received %s' % (str(brightness_range))
                 catch_error_exception(message)
 
+        # sample only transforms that are exact operations in the voxel grid, without interpolation: flips,
+        # rotations of multiples of 90 deg and integer shifts (no zoom and shear)
+        self._is_lattice_transforms = is_lattice_transforms
+        if is_lattice_transforms:
+            self._zoom_range = (1, 1)
+            self._shear_range = 0.0
+
         super(TransformRigidImages2D, self).__init__(size_image,
                                                      is_normalize_data=is_normalize_data,
                                                      type_normalize_data=type_normalize_data,
@@ -320,51 +405,50 @@ class TransformRigidImages2D(TransformRigidImages):
                                              fill_mode=self._fill_mode, cval=self._cval)
         return in_image
 
-    def _calc_gendata_random_transform(self, seed: int = None) -> Tuple[np.ndarray, Dict[str, Any]]:
+    def _calc_gendata_random_transform(self, seed: SeedType = None) -> Tuple[np.ndarray, Dict[str, Any]]:
         # compute composition of homographies
-        if seed is not None:
-            np.random.seed(seed)
+        random_state = self.get_random_state(seed)
 
         # ****************************************************
-        if self._rotation_range:
-            theta = np.deg2rad(np.random.uniform(-self._rotation_range, self._rotation_range))
-        else:
-            theta = 0
+        theta = self._calc_random_angle(random_state, self._rotation_range, (self._size_image[0], self._size_image[1]))
 
         if self._height_shift_range:
-            tx = np.random.uniform(-self._height_shift_range, self._height_shift_range)
+            tx = random_state.uniform(-self._height_shift_range, self._height_shift_range)
             if np.max(self._height_shift_range) < 1:
                 tx *= self._size_image[self._img_row_axis]
         else:
             tx = 0
 
         if self._width_shift_range:
-            ty = np.random.uniform(-self._width_shift_range, self._width_shift_range)
+            ty = random_state.uniform(-self._width_shift_range, self._width_shift_range)
             if np.max(self._width_shift_range) < 1:
                 ty *= self._size_image[self._img_col_axis]
         else:
             ty = 0
 
+        if self._is_lattice_transforms:
+            (tx, ty) = (np.round(tx), np.round(ty))
+
         if self._shear_range:
-            shear = np.deg2rad(np.random.uniform(-self._shear_range, self._shear_range))
+            shear = np.deg2rad(random_state.uniform(-self._shear_range, self._shear_range))
         else:
             shear = 0
 
         if self._zoom_range[0] == 1 and self._zoom_range[1] == 1:
             zx, zy = 1, 1
         else:
-            zx, zy = np.random.uniform(self._zoom_range[0], self._zoom_range[1], 2)
+            zx, zy = random_state.uniform(self._zoom_range[0], self._zoom_range[1], 2)
 
-        flip_horizontal = (np.random.random() < 0.5) * self._horizontal_flip
-        flip_vertical = (np.random.random() < 0.5) * self._vertical_flip
+        flip_horizontal = (random_state.random() < 0.5) * self._horizontal_flip
+        flip_vertical = (random_state.random() < 0.5) * self._vertical_flip
 
         channel_shift_intensity = None
         if self._channel_shift_range != 0:
-            channel_shift_intensity = np.random.uniform(-self._channel_shift_range, self._channel_shift_range)
+            channel_shift_intensity = random_state.uniform(-self._channel_shift_range, self._channel_shift_range)
 
         brightness = None
         if self._brightness_range is not None:
-            brightness = np.random.uniform(self._brightness_range[0], self._brightness_range[1])
+            brightness = random_state.uniform(self._brightness_range[0], self._brightness_range[1])
 
         transform_parameters = {'flip_horizontal': flip_horizontal,
                                 'flip_vertical': flip_vertical,
@@ -401,55 +485,55 @@ class TransformRigidImages2D(TransformRigidImages):
 
         if transform_matrix is not None:
             h, w = self._size_image[self._img_row_axis], self._size_image[self._img_col_axis]
-            transform_matrix = self._transform_matrix_offset_center(transform_matrix, h, w)
+            transform_matrix = self._transform_matrix_offset_center(transform_matrix, h, w,
+                                                                    is_center_voxels=self._is_lattice_transforms)
         # ****************************************************
 
         return (transform_matrix, transform_parameters)
 
-    def _calc_gendata_inverse_random_transform(self, seed: int = None) -> Tuple[np.ndarray, Dict[str, Any]]:
+    def _calc_gendata_inverse_random_transform(self, seed: SeedType = None) -> Tuple[np.ndarray, Dict[str, Any]]:
         # compute composition of inverse homographies
-        if seed is not None:
-            np.random.seed(seed)
+        random_state = self.get_random_state(seed)
 
         # ****************************************************
-        if self._rotation_range:
-            theta = np.deg2rad(np.random.uniform(-self._rotation_range, self._rotation_range))
-        else:
-            theta = 0
+        theta = self._calc_random_angle(random_state, self._rotation_range, (self._size_image[0], self._size_image[1]))
 
         if self._height_shift_range:
-            tx = np.random.uniform(-self._height_shift_range, self._height_shift_range)
+            tx = random_state.uniform(-self._height_shift_range, self._height_shift_range)
             if self._height_shift_range < 1:
                 tx *= self._size_image[self._img_row_axis]
         else:
             tx = 0
         if self._width_shift_range:
-            ty = np.random.uniform(-self._width_shift_range, self._width_shift_range)
+            ty = random_state.uniform(-self._width_shift_range, self._width_shift_range)
             if self._width_shift_range < 1:
                 ty *= self._size_image[self._img_col_axis]
         else:
             ty = 0
 
+        if self._is_lattice_transforms:
+            (tx, ty) = (np.round(tx), np.round(ty))
+
         if self._shear_range:
-            shear = np.deg2rad(np.random.uniform(-self._shear_range, self._shear_range))
+            shear = np.deg2rad(random_state.uniform(-self._shear_range, self._shear_range))
         else:
             shear = 0
 
         if self._zoom_range[0] == 1 and self._zoom_range[1] == 1:
             zx, zy = 1, 1
         else:
-            zx, zy = np.random.uniform(self._zoom_range[0], self._zoom_range[1], 2)
+            zx, zy = random_state.uniform(self._zoom_range[0], self._zoom_range[1], 2)
 
-        flip_horizontal = (np.random.random() < 0.5) * self._horizontal_flip
-        flip_vertical = (np.random.random() < 0.5) * self._vertical_flip
+        flip_horizontal = (random_state.random() < 0.5) * self._horizontal_flip
+        flip_vertical = (random_state.random() < 0.5) * self._vertical_flip
 
         channel_shift_intensity = None
         if self._channel_shift_range != 0:
-            channel_shift_intensity = np.random.uniform(-self._channel_shift_range, self._channel_shift_range)
+            channel_shift_intensity = random_state.uniform(-self._channel_shift_range, self._channel_shift_range)
 
         brightness = None
         if self._brightness_range is not None:
-            brightness = np.random.uniform(self._brightness_range[0], self._brightness_range[1])
+            brightness = random_state.uniform(self._brightness_range[0], self._brightness_range[1])
 
         transform_parameters = {'flip_horizontal': flip_horizontal,
                                 'flip_vertical': flip_vertical,
@@ -486,15 +570,21 @@ class TransformRigidImages2D(TransformRigidImages):
 
         if transform_matrix is not None:
             h, w = self._size_image[self._img_row_axis], self._size_image[self._img_col_axis]
-            transform_matrix = self._transform_matrix_offset_center(transform_matrix, h, w)
+            transform_matrix = self._transform_matrix_offset_center(transform_matrix, h, w,
+                                                                    is_center_voxels=self._is_lattice_transforms)
         # ****************************************************
 
         return (transform_matrix, transform_parameters)
 
     @staticmethod
-    def _transform_matrix_offset_center(matrix: np.ndarray, x: int, y: int) -> np.ndarray:
-        o_x = float(x) / 2 + 0.5
-        o_y = float(y) / 2 + 0.5
+    def _transform_matrix_offset_center(matrix: np.ndarray, x: int, y: int, is_center_voxels: bool = False
+                                        ) -> np.ndarray:
+        if is_center_voxels:
+            # center of the grid of voxels: rotations of 90 deg map the grid to itself
+            (o_x, o_y) = ((x - 1) / 2.0, (y - 1) / 2.0)
+        else:
+            o_x = float(x) / 2 + 0.5
+            o_y = float(y) / 2 + 0.5
         offset_matrix = np.array([[1, 0, o_x], [0, 1, o_y], [0, 0, 1]])
         reset_matrix = np.array([[1, 0, -o_x], [0, 1, -o_y], [0, 0, 1]])
         transform_matrix = np.dot(np.dot(offset_matrix, matrix), reset_matrix)
@@ -503,6 +593,14 @@ class TransformRigidImages2D(TransformRigidImages):
     @staticmethod
     def _apply_transform(in_image: np.ndarray, transform_matrix: np.ndarray,
                          channel_axis: int = 0, fill_mode: str = 'nearest', cval: float = 0.0) -> np.ndarray:
+        lattice_transform = TransformRigidImages._get_lattice_transform(transform_matrix)
+        if lattice_transform is not None:
+            out_image = TransformRigidImages._apply_lattice_transform(in_image, lattice_transform,
+                                                                      channel_axis=channel_axis,
+                                                                      fill_mode=fill_mode, cval=cval)
+            if out_image is not None:
+                return out_image
+
         in_image = np.rollaxis(in_image, channel_axis, 0)
         final_affine_matrix = transform_matrix[:2, :2]
         final_offset = transform_matrix[:2, 2]
@@ -522,6 +620,8 @@ class TransformRigidImages2D(TransformRigidImages):
         message += 'zoom (min, max) range: \'(%s, %s)\'...\n' % (self._zoom_range[0], self._zoom_range[1])
         message += 'shear (plane_XY) range: \'%s\'...\n' % (self._shear_range)
         message += 'fill mode, when applied transformation: \'%s\'...\n' % (self._fill_mode)
+        if self._is_lattice_transforms:
+            message += 'only transforms without interpolation (flips, rotations of 90 deg, integer shifts)...\n'
         return message
 
 
@@ -530,6 +630,8 @@ class TransformRigidImages3D(TransformRigidImages):
     _img_row_axis = 1
     _img_col_axis = 2
     _img_channel_axis = 3
+    _order_interp_image = 0
+    _order_interp_mask = 0
 
     def __init__(self,
                  size_image: Tuple[int, int, int],
@@ -554,7 +656,9 @@ class TransformRigidImages3D(TransformRigidImages):
                  vertical_flip: bool = False,
                  axialdir_flip: bool = False,
                  rescale_factor: float = None,
-                 preprocessing_function: Callable[[np.ndarray], np.ndarray] = None
+                 preprocessing_function: Callable[[np.ndarray], np.ndarray] = None,
+                 is_lattice_transforms: bool = False,
+                 order_interp_image: int = _order_interp_image
                  ) -> None:
         self._rotation_xy_range = rotation_xy_range
         self._rotation_xz_range = rotation_xz_range
@@ -572,6 +676,8 @@ class TransformRigidImages3D(TransformRigidImages):
         self._horizontal_flip = horizontal_flip
         self._vertical_flip = vertical_flip
         self._axialdir_flip = axialdir_flip
+        # order of the spline interpolation of the images (the labels are interpolated with nearest neighbour)
+        self._order_interp_image = order_interp_image
 
         if np.isscalar(zoom_range):
             self._zoom_range = (1 - zoom_range, 1 + zoom_range)
@@ -586,6 +692,13 @@ class TransformRigidImages3D(TransformRigidImages):
                 message = '\'brightness_range\' should be a tuple of two floats. Received %s' % (str(brightness_range))
                 catch_error_exception(message)
 
+        # sample only transforms that are exact operations in the voxel grid, without interpolation: flips,
+        # rotations of multiples of 90 deg and integer shifts (no zoom and shear)
+        self._is_lattice_transforms = is_lattice_transforms
+        if is_lattice_transforms:
+            self._zoom_range = (1, 1)
+            (self._shear_xy_range, self._shear_xz_range, self._shear_yz_range) = (0.0, 0.0, 0.0)
+
         super(TransformRigidImages3D, self).__init__(size_image,
                                                      is_normalize_data=is_normalize_data,
                                                      type_normalize_data=type_normalize_data,
@@ -593,124 +706,148 @@ class TransformRigidImages3D(TransformRigidImages):
                                                      rescale_factor=rescale_factor,
                                                      preprocessing_function=preprocessing_function)
 
+        # precompute the matrices that depend only on the (fixed) size of patches: the flips of each axis
+        self._dict_flip_matrices = {}
+        for (name_flip, axis) in [('flip_horizontal', self._img_col_axis),
+                                  ('flip_vertical', self._img_row_axis),
+                                  ('flip_axialdir', self._img_dep_axis)]:
+            flip_matrix = np.eye(4)
+            flip_matrix[axis, axis] = -1
+            flip_matrix[axis, 3] = self._size_image[axis] - 1
+            self._dict_flip_matrices[name_flip] = flip_matrix
+
     def _calc_transformed_image(self, in_image: np.ndarray, is_type_input_image: bool = False) -> np.ndarray:
-        # Apply: 1st: rigid transformations
-        #        2nd: channel shift intensity / flipping
+        # Apply: 1st: rigid transformations and flipping, composed in one matrix, with one resampling
+        #        2nd: channel shift intensity
         if self._transform_matrix is not None:
-            in_image = self._apply_transform(in_image, self._transform_matrix,
+            transform_matrix = self.get_transform_matrix_with_flips()
+            order_interp = self._order_interp_image if is_type_input_image else self._order_interp_mask
+            in_image = self._apply_transform(in_image, transform_matrix,
                                              channel_axis=self._img_channel_axis,
-                                             fill_mode=self._fill_mode, cval=self._cval)
+                                             fill_mode=self._fill_mode, cval=self._cval, order=order_interp)
+        else:
+            # only flipping, no need to resample
+            if self._transform_params.get('flip_horizontal', False):
+                in_image = self._flip_axis(in_image, axis=self._img_col_axis)
+
+            if self._transform_params.get('flip_vertical', False):
+                in_image = self._flip_axis(in_image, axis=self._img_row_axis)
+
+            if self._transform_params.get('flip_axialdir', False):
+                in_image = self._flip_axis(in_image, axis=self._img_dep_axis)
 
         if is_type_input_image and (self._transform_params.get('channel_shift_intensity') is not None):
             in_image = self._apply_channel_shift(in_image, self._transform_params['channel_shift_intensity'],
                                                  channel_axis=self._img_channel_axis)
 
-        if self._transform_params.get('flip_horizontal', False):
-            in_image = self._flip_axis(in_image, axis=self._img_col_axis)
-
-        if self._transform_params.get('flip_vertical', False):
-            in_image = self._flip_axis(in_image, axis=self._img_row_axis)
-
-        if self._transform_params.get('flip_axialdir', False):
-            in_image = self._flip_axis(in_image, axis=self._img_dep_axis)
-
         if is_type_input_image and (self._transform_params.get('brightness') is not None):
             in_image = self._apply_brightness_shift(in_image, self._transform_params['brightness'])
 
         return in_image
 
+    def get_transform_matrix_with_flips(self) -> np.ndarray:
+        # rigid transformations and flipping, composed in one matrix
+        transform_matrix = self._transform_matrix if self._transform_matrix is not None else np.eye(4)
+        for name_flip in ['flip_horizontal', 'flip_vertical', 'flip_axialdir']:
+            if self._transform_params.get(name_flip, False):
+                transform_matrix = np.dot(transform_matrix, self._dict_flip_matrices[name_flip])
+        return transform_matrix
+
     def _calc_inverse_transformed_image(self, in_image: np.ndarray, is_type_input_image: bool = False) -> np.ndarray:
-        # Apply: 1st: channel shift intensity / flipping
-        #        2nd: rigid transformations
+        # Apply: 1st: channel shift intensity
+        #        2nd: flipping and rigid transformations, composed in one matrix, with one resampling
         if is_type_input_image and (self._transform_params.get('brightness') is not None):
             in_image = self._apply_brightness_shift(in_image, self._transform_params['brightness'])
 
-        if self._transform_params.get('flip_axialdir', False):
-            in_image = self._flip_axis(in_image, axis=self._img_dep_axis)
-
-        if self._transform_params.get('flip_vertical', False):
-            in_image = self._flip_axis(in_image, axis=self._img_row_axis)
-
-        if self._transform_params.get('flip_horizontal', False):
-            in_image = self._flip_axis(in_image, axis=self._img_col_axis)
-
         if is_type_input_image and (self._transform_params.get('channel_shift_intensity') is not None):
             in_image = self._apply_channel_shift(in_image, self._transform_params['channel_shift_intensity'],
                                                  channel_axis=self._img_channel_axis)
 
         if self._transform_matrix is not None:
-            in_image = self._apply_transform(in_image, self._transform_matrix,
+            transform_matrix = self._transform_matrix
+            for name_flip in ['flip_axialdir', 'flip_vertical', 'flip_horizontal']:
+                if self._transform_params.get(name_flip, False):
+                    transform_matrix = np.dot(self._dict_flip_matrices[name_flip], transform_matrix)
+
+            order_interp = self._order_interp_image if is_type_input_image else self._order_interp_mask
+            in_image = self._apply_transform(in_image, transform_matrix,
                                              channel_axis=self._img_channel_axis,
-                                             fill_mode=self._fill_mode, cval=self._cval)
+                                             fill_mode=self._fill_mode, cval=self._cval, order=order_interp)
+        else:
+            if self._transform_params.get('flip_axialdir', False):
+                in_image = self._flip_axis(in_image, axis=self._img_dep_axis)
+
+            if self._transform_params.get('flip_vertical', False):
+                in_image = self._flip_axis(in_image, axis=self._img_row_axis)
+
+            if self._transform_params.get('flip_horizontal', False):
+                in_image = self._flip_axis(in_image, axis=self._img_col_axis)
+
         return in_image
 
-    def _calc_gendata_random_transform(self, seed: int = None) -> Tuple[np.ndarray, Dict[str, Any]]:
+    def _calc_gendata_random_transform(self, seed: SeedType = None) -> Tuple[np.ndarray, Dict[str, Any]]:
         # compute composition of homographies
-        if seed is not None:
-            np.random.seed(seed)
+        random_state = self.get_random_state(seed)
 
         # ****************************************************
-        if self._rotation_xy_range:
-            angle_xy = np.deg2rad(np.random.uniform(-self._rotation_xy_range, self._rotation_xy_range))
-        else:
-            angle_xy = 0
-        if self._rotation_xz_range:
-            angle_xz = np.deg2rad(np.random.uniform(-self._rotation_xz_range, self._rotation_xz_range))
-        else:
-            angle_xz = 0
-        if self._rotation_yz_range:
-            angle_yz = np.deg2rad(np.random.uniform(-self._rotation_yz_range, self._rotation_yz_range))
-        else:
-            angle_yz = 0
+        angle_xy = self._calc_random_angle(random_state, self._rotation_xy_range,
+                                           (self._size_image[1], self._size_image[2]))
+        angle_xz = self._calc_random_angle(random_state, self._rotation_xz_range,
+                                           (self._size_image[0], self._size_image[1]))
+        angle_yz = self._calc_random_angle(random_state, self._rotation_yz_range,
+                                           (self._size_image[0], self._size_image[2]))
 
         if self._height_shift_range:
-            tx = np.random.uniform(-self._height_shift_range, self._height_shift_range)
+            tx = random_state.uniform(-self._height_shift_range, self._height_shift_range)
             if self._height_shift_range < 1:
                 tx *= self._size_image[self._img_row_axis]
         else:
             tx = 0
         if self._width_shift_range:
-            ty = np.random.uniform(-self._width_shift_range, self._width_shift_range)
+            ty = random_state.uniform(-self._width_shift_range, self._width_shift_range)
             if self._width_shift_range < 1:
                 ty *= self._size_image[self._img_col_axis]
         else:
             ty = 0
         if self._depth_shift_range:
-            tz = np.random.uniform(-self._depth_shift_range, self._depth_shift_range)
+            tz = random_state.uniform(-self._depth_shift_range, self._depth_shift_range)
             if self._depth_shift_range < 1:
                 tz *= self._size_image[self._img_dep_axis]
         else:
             tz = 0
 
+        if self._is_lattice_transforms:
+            (tx, ty, tz) = (np.round(tx), np.round(ty), np.round(tz))
+
         if self._shear_xy_range:
-            shear_xy = np.deg2rad(np.random.uniform(-self._shear_xy_range, self._shear_xy_range))
+            shear_xy = np.deg2rad(random_state.uniform(-self._shear_xy_range, self._shear_xy_range))
         else:
             shear_xy = 0
         if self._shear_xz_range:
-            shear_xz = np.deg2rad(np.random.uniform(-self._shear_xz_range, self._shear_xz_range))
+            shear_xz = np.deg2rad(random_state.uniform(-self._shear_xz_range, self._shear_xz_range))
         else:
             shear_xz = 0
         if self._shear_yz_range:
-            shear_yz = np.deg2rad(np.random.uniform(-self._shear_yz_range, self._shear_yz_range))
+            shear_yz = np.deg2rad(random_state.uniform(-self._shear_yz_range, self._shear_yz_range))
         else:
             shear_yz = 0
 
         if self._zoom_range[0] == 1 and self._zoom_range[1] == 1:
             (zx, zy, zz) = (1, 1, 1)
         else:
-            (zx, zy, zz) = np.random.uniform(self._zoom_range[0], self._zoom_range[1], 3)
+            (zx, zy, zz) = random_state.uniform(self._zoom_range[0], self._zoom_range[1], 3)
 
-        flip_horizontal = (np.random.random() < 0.5) * self._horizontal_flip
-        flip_vertical = (np.random.random() < 0.5) * self._vertical_flip
-        flip_axialdir = (np.random.random() < 0.5) * self._axialdir_flip
+        flip_horizontal = (random_state.random() < 0.5) * self._horizontal_flip
+        flip_vertical = (random_state.random() < 0.5) * self._vertical_flip
+        flip_axialdir = (random_state.random() < 0.5) * self._axialdir_flip
 
         channel_shift_intensity = None
         if self._channel_shift_range != 0:
-            channel_shift_intensity = np.random.uniform(-self._channel_shift_range, self._channel_shift_range)
+            channel_shift_intensity = random_state.uniform(-self._channel_shift_range, self._channel_shift_range)
 
         brightness = None
         if self._brightness_range is not None:
-            brightness = np.random.uniform(self._brightness_range[0], self._brightness_range[1])
+            brightness = random_state.uniform(self._brightness_range[0], self._brightness_range[1])
 
         transform_parameters = {'flip_horizontal': flip_horizontal,
                                 'flip_vertical': flip_vertical,
@@ -780,78 +917,75 @@ class TransformRigidImages3D(TransformRigidImages):
             (d, h, w) = (self._size_image[self._img_dep_axis],
                          self._size_image[self._img_row_axis],
                          self._size_image[self._img_col_axis])
-            transform_matrix = self._transform_matrix_offset_center(transform_matrix, d, h, w)
+            transform_matrix = self._transform_matrix_offset_center(transform_matrix, d, h, w,
+                                                                    is_center_voxels=self._is_lattice_transforms)
         # ****************************************************
 
         return (transform_matrix, transform_parameters)
 
-    def _calc_gendata_inverse_random_transform(self, seed: int = None) -> Tuple[np.ndarray, Dict[str, Any]]:
+    def _calc_gendata_inverse_random_transform(self, seed: SeedType = None) -> Tuple[np.ndarray, Dict[str, Any]]:
         # compute composition of inverse homographies
-        if seed is not None:
-            np.random.seed(seed)
+        random_state = self.get_random_state(seed)
 
         # ****************************************************
-        if self._rotation_xy_range:
-            angle_xy = np.deg2rad(np.random.uniform(-self._rotation_xy_range, self._rotation_xy_range))
-        else:
-            angle_xy = 0
-        if self._rotation_xz_range:
-            angle_xz = np.deg2rad(np.random.uniform(-self._rotation_xz_range, self._rotation_xz_range))
-        else:
-            angle_xz = 0
-        if self._rotation_yz_range:
-            angle_yz = np.deg2rad(np.random.uniform(-self._rotation_yz_range, self._rotation_yz_range))
-        else:
-            angle_yz = 0
+        angle_xy = self._calc_random_angle(random_state, self._rotation_xy_range,
+                                           (self._size_image[1], self._size_image[2]))
+        angle_xz = self._calc_random_angle(random_state, self._rotation_xz_range,
+                                           (self._size_image[0], self._size_image[1]))
+        angle_yz = self._calc_random_angle(random_state, self._rotation_yz_range,
+                                           (self._size_image[0], self._size_image[2]))
 
         if self._height_shift_range:
-            tx = np.random.uniform(-self._height_shift_range, self._height_shift_range)
+            tx = random_state.uniform(-self._height_shift_range, self._height_shift_range)
             if self._height_shift_range < 1:
                 tx *= self._size_image[self._img_row_axis]
         else:
             tx = 0
         if self._width_shift_range:
-            ty = np.random.uniform(-self._width_shift_range, self._width_shift_range)
+            ty = random_state.uniform(-self._width_shift_range, self._width_shift_range)
             if self._width_shift_range < 1:
                 ty *= self._size_image[self._img_col_axis]
         else:
             ty = 0
         if self._depth_shift_range:
-            tz = np.random.uniform(-self._depth_shift_range, self._depth_shift_range)
+            tz = random_state.uniform(-self._depth_shift_range, self._depth_shift_range)
             if self._depth_shift_range < 1:
                 tz *= self._size_image[self._img_dep_axis]
         else:
             tz = 0
 
+        if self._is_lattice_transforms:
+            (tx, ty, tz) = (np.round(tx), np.round(ty), np.round(tz))
+
         if self._shear_xy_range:
-            shear_xy = np.deg2rad(np.random.uniform(-self._shear_xy_range, self._shear_xy_range))
+            shear_xy = np.deg2rad(random_state.uniform(-self._shear_xy_range, self._shear_xy_range))
         else:
             shear_xy = 0
         if self._shear_xz_range:
-            shear_xz = np.deg2rad(np.random.uniform(-self._shear_xz_range, self._shear_xz_range))
+            shear_xz = np.deg2rad(random_state.uniform(-self._shear_xz_range, self._shear_xz_range))
         else:
             shear_xz = 0
         if self._shear_yz_range:
-            shear_yz = np.deg2rad(np.random.uniform(-self._shear_yz_range, self._shear_yz_range))
+            shear_yz = np.deg2rad(random_state.uniform(-self._shear_yz_range, self._shear_yz_range))
         else:
             shear_yz = 0
 
         if self._zoom_range[0] == 1 and self._zoom_range[1] == 1:
             (zx, zy, zz) = (1, 1, 1)
         else:
-            (zx, zy, zz) = np.random.uniform(self._zoom_range[0], self._zoom_range[1], 3)
+            (zx, zy, zz) = random_state.uniform(self._zoom_range[0], self._zoom_range[1], 3)
 
-        flip_horizontal = (np.random.random() < 0.5) * self._horizontal_flip
-        flip_vertical = (np.random.random() < 0.5) * self._vertical_flip
-        flip_axialdir = (np.random.random() < 0.5) * self._axialdir_flip
+        flip_horizontal = (random_state.random() < 0.5) * self._horizontal_flip
+        flip_vertical = (random_state.random() < 0.5) * self._vertical_flip
+        flip_axialdir = (random_state.random() < 0.5) * self._axialdir_flip
 
         channel_shift_intensity = None
         if self._channel_shift_range != 0:
-            channel_shift_intensity = np.random.uniform(-self._channel_shift_range, self._channel_shift_range)
+            channel_shift_intensity = random_state.uniform(-self._channel_shift_range, self._channel_shift_range)
 
         brightness = None
         if self._brightness_range is not None:
-            brightness = np.random.uniform(self._brightness_range[0], self._brightness_range[1])
+            brightness = random_state.uniform(self._brightness_range[0], self._brightness_range[1])
 
         transform_parameters = {'flip_horizontal': flip_horizontal,
                                 'flip_vertical': flip_vertical,
@@ -921,16 +1055,22 @@ class TransformRigidImages3D(TransformRigidImages):
             (d, h, w) = (self._size_image[self._img_dep_axis],
                          self._size_image[self._img_row_axis],
                          self._size_image[self._img_col_axis])
-            transform_matrix = self._transform_matrix_offset_center(transform_matrix, d, h, w)
+            transform_matrix = self._transform_matrix_offset_center(transform_matrix, d, h, w,
+                                                                    is_center_voxels=self._is_lattice_transforms)
         # ****************************************************
 
         return (transform_matrix, transform_parameters)
 
     @staticmethod
-    def _transform_matrix_offset_center(matrix: np.ndarray, x: int, y: int, z: int) -> np.ndarray:
-        o_x = float(x) / 2 + 0.5
-        o_y = float(y) / 2 + 0.5
-        o_z = float(z) / 2 + 0.5
+    def _transform_matrix_offset_center(matrix: np.ndarray, x: int, y: int, z: int, is_center_voxels: bool = False
+                                        ) -> np.ndarray:
+        if is_center_voxels:
+            # center of the grid of voxels: rotations of 90 deg map the grid to itself
+            (o_x, o_y, o_z) = ((x - 1) / 2.0, (y - 1) / 2.0, (z - 1) / 2.0)
+        else:
+            o_x = float(x) / 2 + 0.5
+            o_y = float(y) / 2 + 0.5
+            o_z = float(z) / 2 + 0.5
         offset_matrix = np.array([[1, 0, 0, o_x], [0, 1, 0, o_y], [0, 0, 1, o_z], [0, 0, 0, 1]])
         reset_matrix = np.array([[1, 0, 0, -o_x], [0, 1, 0, -o_y], [0, 0, 1, -o_z], [0, 0, 0, 1]])
         transform_matrix = np.dot(np.dot(offset_matrix, matrix), reset_matrix)
@@ -938,15 +1078,26 @@ class TransformRigidImages3D(TransformRigidImages):
 
     @staticmethod
     def _apply_transform(in_image: np.ndarray, transform_matrix: np.ndarray,
-                         channel_axis: int = 0, fill_mode: str = 'nearest', cval: float = 0.0) -> np.ndarray:
-        in_image = np.rollaxis(in_image, channel_axis, 0)
+                         channel_axis: int = 0, fill_mode: str = 'nearest', cval: float = 0.0,
+                         order: int = 0) -> np.ndarray:
+        lattice_transform = TransformRigidImages._get_lattice_transform(transform_matrix)
+        if lattice_transform is not None:
+            # exact operation in the voxel grid (flips, rotations of 90 deg, integer shifts): no interpolation
+            out_image = TransformRigidImages._apply_lattice_transform(in_image, lattice_transform,
+                                                                      channel_axis=channel_axis,
+                                                                      fill_mode=fill_mode, cval=cval)
+            if out_image is not None:
+                return out_image
+
         final_affine_matrix = transform_matrix[:3, :3]
         final_offset = transform_matrix[:3, 3]
-        channel_images = [ndi.interpolation.affine_transform(x_channel, final_affine_matrix, final_offset, order=0,
-                                                             mode=fill_mode, cval=cval) for x_channel in in_image]
-        in_image = np.stack(channel_images, axis=0)
-        in_image = np.rollaxis(in_image, 0, channel_axis + 1)
-        return in_image
+        # resample each channel once, directly in the output array
+        in_image = np.moveaxis(in_image, channel_axis, 0)
+        out_image = np.empty(in_image.shape, dtype=in_image.dtype)
+        for (in_channel, out_channel) in zip(in_image, out_image):
+            ndi.affine_transform(in_channel, final_affine_matrix, final_offset, output=out_channel, order=order,
+                                 mode=fill_mode, cval=cval)
+        return np.moveaxis(out_image, 0, channel_axis)
 
     def get_text_description(self) -> str:
         message = 'Rigid 3D transformations of images, with parameters...\n'
@@ -960,4 +1111,7 @@ class TransformRigidImages3D(TransformRigidImages):
         message += '- shear (plane_XY, plane_XZ, plane_YZ) range: \'(%s, %s, %s)\'...\n' \
                    % (self._shear_xy_range, self._shear_xz_range, self._shear_yz_range)
         message += '- fill mode, when applied transformation: \'%s\'...\n' % (self._fill_mode)
+        message += '- order interpolation of images: \'%s\'...\n' % (self._order_interp_image)
+        if self._is_lattice_transforms:
+            message += '- only transforms without interpolation (flips, rotations of 90 deg, integer shifts)...\n'
         return message
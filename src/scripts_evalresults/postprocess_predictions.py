@@ -10,7 +10,7 @@ from common.functionutil import join_path_names, is_exist_file, basename, basena
     read_dictionary_configparams
 from common.exceptionmanager import catch_error_exception, catch_warning_exception
 from common.workdirmanager import TrainDirManager
-from dataloaders.imagefilereader import ImageFileReader
+from dataloaders.imagefilereader import ImageFileReader, ImageFileWriterAsync
 from imageoperators.boundingboxes import BoundingBoxes
 from imageoperators.imageoperator import ExtendImage, CropAndExtendImage
 from imageoperators.maskoperator import MaskOperator
@@ -66,106 +66,115 @@ def main(args):
         # to advance the iterator inside the 'for' loop, to process the several cropping patches for the same image
         list_input_predictions_files = iter(list_input_predictions_files)
 
-    for i, in_prediction_file in enumerate(list_input_predictions_files):
-        print("\nInput: \'%s\'..." % (basename(in_prediction_file)))
+    # write output files in background, while processing the next files
+    image_file_writer = ImageFileWriterAsync()
 
-        inout_prediction = ImageFileReader.get_image(in_prediction_file)
-        print("Input dims : \'%s\'..." % (str(inout_prediction.shape)))
+    try:
+        for i, in_prediction_file in enumerate(list_input_predictions_files):
+            print("\nInput: \'%s\'..." % (basename(in_prediction_file)))
 
-        in_reference_key = indict_reference_keys[basename_filenoext(in_prediction_file)]
-        in_reference_file = join_path_names(in_reference_files_path, in_reference_key)
+            inout_prediction = ImageFileReader.get_image(in_prediction_file)
+            print("Input dims : \'%s\'..." % (str(inout_prediction.shape)))
 
-        print("Assigned to Reference file: \'%s\'..." % (basename(in_reference_file)))
-        in_metadata_file = ImageFileReader.get_image_metadata_info(in_reference_file)
+            in_reference_key = indict_reference_keys[basename_filenoext(in_prediction_file)]
+            in_reference_file = join_path_names(in_reference_files_path, in_reference_key)
 
-        # ******************************
+            print("Assigned to Reference file: \'%s\'..." % (basename(in_reference_file)))
+            in_metadata_file = ImageFileReader.get_image_metadata_info(in_reference_file)
 
-        if args.is_crop_images:
-            if args.is_two_boundboxes_lungs:
-                print("Input data to Network were cropped -> Reconstruct all prediction patches from same volume...")
+            # ******************************
 
-                inlist_crop_boundboxes = indict_crop_boundboxes[basename_filenoext(in_reference_key)]
-                num_crop_boundboxes = len(inlist_crop_boundboxes)
-                size_output_fullpred = ImageFileReader.get_image_size(in_reference_file)
-                print("Input data were cropped to \'%s\' bounding-boxes: \'%s\' and \'%s\'..."
-                      % (num_crop_boundboxes, str(inlist_crop_boundboxes[0]), str(inlist_crop_boundboxes[1])))
+            if args.is_crop_images:
+                if args.is_two_boundboxes_lungs:
+                    print("Input data to Network were cropped -> Reconstruct all prediction patches from same "
+                          "volume...")
 
-                print("Reconstruct full-size prediction of size: \'%s\'" % (str(size_output_fullpred)))
-                image_reconstructor_crop_patches.initialize_recons_data(size_output_fullpred)
-                image_reconstructor_crop_patches.initialize_recons_array(inout_prediction)
+                    inlist_crop_boundboxes = indict_crop_boundboxes[basename_filenoext(in_reference_key)]
+                    num_crop_boundboxes = len(inlist_crop_boundboxes)
+                    size_output_fullpred = ImageFileReader.get_image_size(in_reference_file)
+                    print("Input data were cropped to \'%s\' bounding-boxes: \'%s\' and \'%s\'..."
+                          % (num_crop_boundboxes, str(inlist_crop_boundboxes[0]), str(inlist_crop_boundboxes[1])))
 
-                print("First Patch: Set-add in reconstructed prediction with bounding-box: \'%s\'..."
-                      % (str(inlist_crop_boundboxes[0])))
-                image_reconstructor_crop_patches.include_image_patch_with_checks(inout_prediction,
-                                                                                 inlist_crop_boundboxes[0])
+                    print("Reconstruct full-size prediction of size: \'%s\'" % (str(size_output_fullpred)))
+                    image_reconstructor_crop_patches.initialize_recons_data(size_output_fullpred)
+                    image_reconstructor_crop_patches.initialize_recons_array(inout_prediction)
 
-                for icrop in range(1, num_crop_boundboxes):
-                    # loop over next prediction patches in the list
-                    in_prediction_file = next(list_input_predictions_files)
-                    inout_prediction = ImageFileReader.get_image(in_prediction_file)
-                    print("Next Input Patch: \'%s\'..." % (basename(in_prediction_file)))
-                    print("Input dims : \'%s\'..." % (str(inout_prediction.shape)))
-
-                    print("Next Patch: Set-add in reconstructed prediction with bounding-box: \'%s\'..."
-                          % (str(inlist_crop_boundboxes[icrop])))
+                    print("First Patch: Set-add in reconstructed prediction with bounding-box: \'%s\'..."
+                          % (str(inlist_crop_boundboxes[0])))
                     image_reconstructor_crop_patches.include_image_patch_with_checks(inout_prediction,
-                                                                                     inlist_crop_boundboxes[icrop])
-                # endfor
+                                                                                     inlist_crop_boundboxes[0])
 
-                image_reconstructor_crop_patches.finalize_recons_array()
-                inout_prediction = image_reconstructor_crop_patches.get_reconstructed_image()
+                    for icrop in range(1, num_crop_boundboxes):
+                        # loop over next prediction patches in the list
+                        in_prediction_file = next(list_input_predictions_files)
+                        inout_prediction = ImageFileReader.get_image(in_prediction_file)
+                        print("Next Input Patch: \'%s\'..." % (basename(in_prediction_file)))
+                        print("Input dims : \'%s\'..." % (str(inout_prediction.shape)))
 
-            else:
-                print("Input data to Network were cropped -> Extend prediction to full-size image...")
+                        print("Next Patch: Set-add in reconstructed prediction with bounding-box: \'%s\'..."
+                              % (str(inlist_crop_boundboxes[icrop])))
+                        image_reconstructor_crop_patches.include_image_patch_with_checks(inout_prediction,
+                                                                                         inlist_crop_boundboxes[icrop])
+                    # endfor
 
-                in_crop_boundbox = indict_crop_boundboxes[basename_filenoext(in_reference_key)]
-                size_output_fullpred = ImageFileReader.get_image_size(in_reference_file)
-                print("Input data were cropped to bounding-box: \'%s\'..." % (str(in_crop_boundbox)))
+                    image_reconstructor_crop_patches.finalize_recons_array()
+                    inout_prediction = image_reconstructor_crop_patches.get_reconstructed_image()
 
-                size_crop_boundbox = BoundingBoxes.get_size_boundbox(in_crop_boundbox)
+                else:
+                    print("Input data to Network were cropped -> Extend prediction to full-size image...")
 
-                if not BoundingBoxes.is_boundbox_inside_image_size(in_crop_boundbox, size_output_fullpred):
-                    print("Crop bounding-box is not contained in the size of output full-size array: \'%s\' > \'%s\'. "
-                          "Extend images after cropping..." % (str(size_crop_boundbox), str(size_output_fullpred)))
+                    in_crop_boundbox = indict_crop_boundboxes[basename_filenoext(in_reference_key)]
+                    size_output_fullpred = ImageFileReader.get_image_size(in_reference_file)
+                    print("Input data were cropped to bounding-box: \'%s\'..." % (str(in_crop_boundbox)))
 
-                    (in_crop_boundbox, in_extend_boundbox) = \
-                        BoundingBoxes.calc_boundboxes_crop_extend_image_reverse(in_crop_boundbox, size_output_fullpred)
+                    size_crop_boundbox = BoundingBoxes.get_size_boundbox(in_crop_boundbox)
 
-                    print("Crop input prediction to bounding-box: \'%s\', and then Extend with bounding-box: \'%s\'..."
-                          % (str(in_crop_boundbox), str(in_extend_boundbox)))
-                    inout_prediction = CropAndExtendImage.compute(inout_prediction, in_crop_boundbox,
-                                                                  in_extend_boundbox, size_output_fullpred)
-                else:
-                    print("Extend input prediction with bounding-box: \'%s\'..." % str(in_crop_boundbox))
-                    inout_prediction = ExtendImage.compute(inout_prediction, in_crop_boundbox, size_output_fullpred)
+                    if not BoundingBoxes.is_boundbox_inside_image_size(in_crop_boundbox, size_output_fullpred):
+                        print("Crop bounding-box is not contained in the size of output full-size array: "
+                              "\'%s\' > \'%s\'. Extend images after cropping..."
+                              % (str(size_crop_boundbox), str(size_output_fullpred)))
+
+                        (in_crop_boundbox, in_extend_boundbox) = \
+                            BoundingBoxes.calc_boundboxes_crop_extend_image_reverse(in_crop_boundbox,
+                                                                                    size_output_fullpred)
+
+                        print("Crop input prediction to bounding-box: \'%s\', and then Extend with bounding-box: "
+                              "\'%s\'..." % (str(in_crop_boundbox), str(in_extend_boundbox)))
+                        inout_prediction = CropAndExtendImage.compute(inout_prediction, in_crop_boundbox,
+                                                                      in_extend_boundbox, size_output_fullpred)
+                    else:
+                        print("Extend input prediction with bounding-box: \'%s\'..." % str(in_crop_boundbox))
+                        inout_prediction = ExtendImage.compute(inout_prediction, in_crop_boundbox, size_output_fullpred)
 
-        # ******************************
+            # ******************************
 
-        if args.is_rescale_images:
-            message = 'Rescaling at Postprocessing time not implemented yet'
-            catch_warning_exception(message)
+            if args.is_rescale_images:
+                message = 'Rescaling at Postprocessing time not implemented yet'
+                catch_warning_exception(message)
 
-        # ******************************
+            # ******************************
 
-        if args.is_mask_region_interest:
-            print("Input data to Network were masked to ROI (lungs) -> Reverse mask in predictions...")
-            in_roimask_file = find_file_inlist_with_pattern(basename(in_reference_file), list_input_roimasks_files,
-                                                            pattern_search=pattern_search_infiles)
-            print("ROI mask (lungs) file: \'%s\'..." % (basename(in_roimask_file)))
+            if args.is_mask_region_interest:
+                print("Input data to Network were masked to ROI (lungs) -> Reverse mask in predictions...")
+                in_roimask_file = find_file_inlist_with_pattern(basename(in_reference_file), list_input_roimasks_files,
+                                                                pattern_search=pattern_search_infiles)
+                print("ROI mask (lungs) file: \'%s\'..." % (basename(in_roimask_file)))
 
-            in_roimask = ImageFileReader.get_image(in_roimask_file)
-            inout_prediction = MaskOperator.mask_image(inout_prediction, in_roimask,
-                                                       is_image_mask=args.is_binary_predictions)
+                in_roimask = ImageFileReader.get_image(in_roimask_file)
+                inout_prediction = MaskOperator.mask_image(inout_prediction, in_roimask,
+                                                           is_image_mask=args.is_binary_predictions)
 
-        # ******************************
+            # ******************************
 
-        # Output processed predictions
-        output_prediction_file = join_path_names(output_posteriors_path,
-                                                 name_output_posteriors_files(in_reference_file))
-        print("Output: \'%s\', of dims \'%s\'..." % (basename(output_prediction_file), inout_prediction.shape))
+            # Output processed predictions
+            output_prediction_file = join_path_names(output_posteriors_path,
+                                                     name_output_posteriors_files(in_reference_file))
+            print("Output: \'%s\', of dims \'%s\'..." % (basename(output_prediction_file), inout_prediction.shape))
 
-        ImageFileReader.write_image(output_prediction_file, inout_prediction, metadata=in_metadata_file)
-    # endfor
+            image_file_writer.write_image(output_prediction_file, inout_prediction, metadata=in_metadata_file)
+        # endfor
+    finally:
+        image_file_writer.close()
 
 
 if __name__ == "__main__":
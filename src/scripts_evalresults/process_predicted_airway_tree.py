@@ -6,7 +6,7 @@ from common.constant import BASEDIR, POST_THRESHOLD_VALUE, IS_ATTACH_COARSE_AIRW
 from common.functionutil import join_path_names, basename, list_files_dir, get_regex_pattern_filename, \
     find_file_inlist_with_pattern, str2bool, str2float, read_dictionary
 from common.workdirmanager import TrainDirManager
-from dataloaders.imagefilereader import ImageFileReader
+from dataloaders.imagefilereader import ImageFileReader, ImageFileWriterAsync
 from imageoperators.imageoperator import ThresholdImage
 from imageoperators.maskoperator import MaskOperator
 
@@ -34,38 +34,44 @@ def main(args):
 
     # *****************************************************
 
-    for i, in_posterior_file in enumerate(list_input_posteriors_files):
-        print("\nInput: \'%s\'..." % (basename(in_posterior_file)))
+    # write output files in background, while processing the next files
+    image_file_writer = ImageFileWriterAsync()
 
-        in_posterior = ImageFileReader.get_image(in_posterior_file)
-        print("Input dims : \'%s\'..." % (str(in_posterior.shape)))
+    try:
+        for i, in_posterior_file in enumerate(list_input_posteriors_files):
+            print("\nInput: \'%s\'..." % (basename(in_posterior_file)))
 
-        in_metadata_file = ImageFileReader.get_image_metadata_info(in_posterior_file)
+            in_posterior = ImageFileReader.get_image(in_posterior_file)
+            print("Input dims : \'%s\'..." % (str(in_posterior.shape)))
 
-        print("Compute Binary Masks thresholded to \'%s\'..." % (args.post_threshold_value))
+            in_metadata_file = ImageFileReader.get_image_metadata_info(in_posterior_file)
 
-        out_binary_mask = ThresholdImage.compute(in_posterior, args.post_threshold_value)
+            print("Compute Binary Masks thresholded to \'%s\'..." % (args.post_threshold_value))
 
-        if args.is_attach_coarse_airways:
-            print("Attach Trachea and Main Bronchi mask to complete the computed Binary Masks...")
-            in_coarse_airways_file = find_file_inlist_with_pattern(basename(in_posterior_file),
-                                                                   list_input_coarse_airways_files,
-                                                                   pattern_search=pattern_search_infiles)
-            print("Coarse Airways mask file: \'%s\'..." % (basename(in_coarse_airways_file)))
+            out_binary_mask = ThresholdImage.compute(in_posterior, args.post_threshold_value)
 
-            in_coarse_airways = ImageFileReader.get_image(in_coarse_airways_file)
+            if args.is_attach_coarse_airways:
+                print("Attach Trachea and Main Bronchi mask to complete the computed Binary Masks...")
+                in_coarse_airways_file = find_file_inlist_with_pattern(basename(in_posterior_file),
+                                                                       list_input_coarse_airways_files,
+                                                                       pattern_search=pattern_search_infiles)
+                print("Coarse Airways mask file: \'%s\'..." % (basename(in_coarse_airways_file)))
 
-            out_binary_mask = MaskOperator.merge_two_masks(out_binary_mask, in_coarse_airways)
-            # isNot_intersect_masks=True)
+                in_coarse_airways = ImageFileReader.get_image(in_coarse_airways_file)
 
-        # Output predicted binary masks
-        output_binary_mask_file = \
-            join_path_names(output_binary_masks_path,
-                            name_output_binary_masks_files(in_posterior_file, args.post_threshold_value))
-        print("Output: \'%s\', of dims \'%s\'..." % (basename(output_binary_mask_file), str(out_binary_mask.shape)))
+                out_binary_mask = MaskOperator.merge_two_masks(out_binary_mask, in_coarse_airways)
+                # isNot_intersect_masks=True)
 
-        ImageFileReader.write_image(output_binary_mask_file, out_binary_mask, metadata=in_metadata_file)
-    # endfor
+            # Output predicted binary masks
+            output_binary_mask_file = \
+                join_path_names(output_binary_masks_path,
+                                name_output_binary_masks_files(in_posterior_file, args.post_threshold_value))
+            print("Output: \'%s\', of dims \'%s\'..." % (basename(output_binary_mask_file), str(out_binary_mask.shape)))
+
+            image_file_writer.write_image(output_binary_mask_file, out_binary_mask, metadata=in_metadata_file)
+        # endfor
+    finally:
+        image_file_writer.close()
 
 
 if __name__ == "__main__":
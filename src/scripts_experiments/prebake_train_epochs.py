@@ -0,0 +1,129 @@
+
+import argparse
+
+from common.constant import BASEDIR, PROB_FOREGROUND_WINDOW, TYPE_TRANSFORM_BATCH_IMAGES
+from common.functionutil import list_files_dir, is_exist_file, str2bool, str2int, str2float, str2tuple_bool, \
+    str2tuple_int, str2tuple_float, read_dictionary_configparams
+from common.exceptionmanager import catch_error_exception
+from common.workdirmanager import TrainDirManager
+from dataloaders.dataloader_manager import get_train_imagedataloader_2images
+from dataloaders.imagedatashards import ImageDataShards
+from dataloaders.prebakedepochs import PrebakedEpochsBuffer
+from models.model_manager import get_model_trainer
+
+
+def main(args):
+
+    # SETTINGS
+    name_input_images_files = 'images_proc*.nii.gz'
+    name_input_labels_files = 'labels_proc*.nii.gz'
+    # --------
+
+    # the training data is generated with the same parameters as in the config file of the training
+    if not is_exist_file(args.in_config_file):
+        message = "Config params file not found: \'%s\'..." % (args.in_config_file)
+        catch_error_exception(message)
+    input_args_file = read_dictionary_configparams(args.in_config_file)
+    print("Generate training data with parameters from file: \'%s\'" % (args.in_config_file))
+
+    size_in_images = str2tuple_int(input_args_file['size_in_images'])
+    is_valid_convolutions = str2bool(input_args_file['is_valid_convolutions'])
+    num_epochs = args.num_epochs if args.num_epochs else str2int(input_args_file['num_epochs'])
+    manual_seed_train = str2int(input_args_file['manual_seed_train']) \
+        if input_args_file['manual_seed_train'] != 'None' else None
+    trans_rigid_params = {'rotation_range': str2tuple_float(input_args_file['trans_rigid_rotation_range']),
+                          'shift_range': str2tuple_float(input_args_file['trans_rigid_shift_range']),
+                          'flip_dirs': str2tuple_bool(input_args_file['trans_rigid_flip_dirs']),
+                          'zoom_range': str2float(input_args_file['trans_rigid_zoom_range']),
+                          'fill_mode': str(input_args_file['trans_rigid_fill_mode'])}
+    if 'trans_rigid_order_interp_image' in input_args_file.keys():
+        trans_rigid_params['order_interp_image'] = str2int(input_args_file['trans_rigid_order_interp_image'])
+    if 'prob_foreground_window' in input_args_file.keys():
+        prob_foreground_window = str2float(input_args_file['prob_foreground_window'])
+    else:
+        prob_foreground_window = PROB_FOREGROUND_WINDOW
+    is_transform_images = str2bool(input_args_file['is_transform_images'])
+    type_transform_images = str(input_args_file['type_transform_images'])
+    if type_transform_images == TYPE_TRANSFORM_BATCH_IMAGES:
+        # rigid transformations done in the trainer, to the batches in the device of the model
+        is_transform_images = False
+    is_memmap_traindata = str2bool(input_args_file['is_memmap_traindata']) \
+        if 'is_memmap_traindata' in input_args_file.keys() else False
+    is_chunked_traindata = str2bool(input_args_file['is_chunked_traindata']) \
+        if 'is_chunked_traindata' in input_args_file.keys() else False
+
+    workdir_manager = TrainDirManager(args.basedir)
+    training_data_path = workdir_manager.get_pathdir_exist(str(input_args_file['training_datadir']))
+    prebaked_epochs_path = workdir_manager.get_pathdir_new(args.prebaked_epochs_dir)
+    max_train_images = str2int(input_args_file['max_train_images'])
+    if ImageDataShards.is_shards_dir(training_data_path):
+        func_list_files_dir = ImageDataShards.list_files_shards
+    else:
+        func_list_files_dir = list_files_dir
+    list_train_images_files = func_list_files_dir(training_data_path, name_input_images_files)[0:max_train_images]
+    list_train_labels_files = func_list_files_dir(training_data_path, name_input_labels_files)[0:max_train_images]
+
+    if is_valid_convolutions:
+        # need the network to get the size of the output labels
+        model_trainer = get_model_trainer()
+        model_trainer.create_network(type_network=str(input_args_file['type_network']),
+                                     size_image_in=size_in_images,
+                                     num_featmaps_in=str2int(input_args_file['net_num_featmaps']),
+                                     num_channels_in=1,
+                                     num_classes_out=1,
+                                     is_use_valid_convols=is_valid_convolutions)
+        size_output_image_model = model_trainer.get_size_output_image_model()
+    else:
+        size_output_image_model = size_in_images
+
+    print("\nLoading Training data...")
+    training_data_loader = \
+        get_train_imagedataloader_2images(list_train_images_files,
+                                          list_train_labels_files,
+                                          size_images=size_in_images,
+                                          is_generate_patches=str2bool(input_args_file['is_generate_patches']),
+                                          type_generate_patches=str(input_args_file['type_generate_patches']),
+                                          prop_overlap_slide_images=str2tuple_float(
+                                              input_args_file['prop_overlap_slide_window']),
+                                          num_random_images=str2int(input_args_file['num_random_patches_epoch']),
+                                          is_transform_images=is_transform_images,
+                                          type_transform_images=type_transform_images,
+                                          trans_rigid_params=trans_rigid_params,
+                                          is_nnet_validconvs=is_valid_convolutions,
+                                          size_output_images=size_output_image_model,
+                                          batch_size=str2int(input_args_file['batch_size']),
+                                          is_shuffle=str2bool(input_args_file['is_shuffle_traindata']),
+                                          manual_seed=manual_seed_train,
+                                          is_memmap_data=is_memmap_traindata,
+                                          is_chunked_data=is_chunked_traindata,
+                                          num_workers_load=args.num_workers_load_traindata,
+                                          num_workers_train=0,
+                                          prob_foreground_window=prob_foreground_window)
+    # the generator of samples (in the torch data loader, it is the dataset)
+    batchdata_generator = getattr(training_data_loader, '_batchdata_generator', training_data_loader)
+
+    print("\nPrebake epochs \'%s\' to \'%s\' in \'%s\', with \'%s\' slots and \'%s\' processes..."
+          % (args.initial_epoch + 1, num_epochs, prebaked_epochs_path, args.num_slots, args.num_processes))
+    PrebakedEpochsBuffer.write_epochs(prebaked_epochs_path, batchdata_generator,
+                                      num_epochs=num_epochs,
+                                      initial_epoch=args.initial_epoch,
+                                      num_slots=args.num_slots,
+                                      num_processes=args.num_processes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--basedir', type=str, default=BASEDIR)
+    parser.add_argument('--in_config_file', type=str, required=True)
+    parser.add_argument('--prebaked_epochs_dir', type=str, default='PrebakedEpochs/')
+    parser.add_argument('--num_epochs', type=str2int, default=None)
+    parser.add_argument('--initial_epoch', type=str2int, default=0)
+    parser.add_argument('--num_slots', type=str2int, default=2)
+    parser.add_argument('--num_processes', type=str2int, default=1)
+    parser.add_argument('--num_workers_load_traindata', type=str2int, default=1)
+    args = parser.parse_args()
+
+    print("Print input arguments...")
+    for key, value in vars(args).items():
+        print("\'%s\' = %s" % (key, value))
+    main(args)
@@ -13,7 +13,7 @@ from common.functionutil import join_path_names, is_exist_file, basename, basena
 from common.exceptionmanager import catch_error_exception, catch_warning_exception
 from common.workdirmanager import TrainDirManager
 from dataloaders.dataloader_manager import get_train_imagedataloader_1image
-from dataloaders.imagefilereader import ImageFileReader
+from dataloaders.imagefilereader import ImageFileReader, ImageFileWriterAsync
 from models.model_manager import get_model_trainer, get_network_checker
 from postprocessing.postprocessing_manager import get_image_reconstructor
 
@@ -101,79 +101,87 @@ def main(args):
 
     outdict_reference_keys = OrderedDict()
 
-    for ifile, in_image_file in enumerate(list_test_images_files):
-        print("\nInput: \'%s\'..." % (basename(in_image_file)))
-
-        print("Loading data...")
-        image_data_loader = \
-            get_train_imagedataloader_1image([in_image_file],
-                                             size_images=args.size_in_images,
-                                             is_generate_patches=args.is_reconstruct_patches,
-                                             type_generate_patches='slide_window',
-                                             prop_overlap_slide_images=args.prop_overlap_slide_window,
-                                             num_random_images=0,
-                                             is_transform_images=False,
-                                             type_transform_images='',
-                                             trans_rigid_params=None,
-                                             batch_size=1,
-                                             is_shuffle=False,
-                                             manual_seed=None)
-        print("Loaded \'%s\' files. Total patches generated: \'%s\'..." % (1, len(image_data_loader)))
-
-        # ******************************
-
-        if args.is_save_featmaps_layer:
-            print("Evaluate Model feature maps...")
-            out_prediction_patches = network_checker.get_feature_maps(image_data_loader, args.name_layer_save_featmaps)
-        else:
-            print("Evaluate Model...")
-            out_prediction_patches = model_trainer.predict(image_data_loader)
-
-        # ******************************
-
-        if args.is_reconstruct_patches:
-            print("\nReconstruct full size Prediction from sliding-window image patches...")
-            shape_reconstructed_image = ImageFileReader.get_image_size(in_image_file)
-
-            image_reconstructor.initialize_recons_data(shape_reconstructed_image)
-            image_reconstructor.initialize_recons_array(out_prediction_patches[0])
-
-            out_prediction_reconstructed = image_reconstructor.compute_full(out_prediction_patches)
-        else:
-            out_prediction_reconstructed = np.squeeze(out_prediction_patches, axis=(0, -1))
-
-        # ******************************
-
-        # Output predictions
-        in_reference_key = indict_reference_keys[basename_filenoext(in_image_file)]
-        in_caseproc_name = func_extract_caseprocname(in_image_file)
-
-        if args.is_save_featmaps_layer:
-            num_featmaps = out_prediction_reconstructed.shape[-1]
-            print("Output model Feature maps (\'%s\' in total)..." % (num_featmaps))
-
-            for ifeat in range(num_featmaps):
+    # write output files in background, while computing the predictions for the next files
+    image_file_writer = ImageFileWriterAsync()
+
+    try:
+        for ifile, in_image_file in enumerate(list_test_images_files):
+            print("\nInput: \'%s\'..." % (basename(in_image_file)))
+
+            print("Loading data...")
+            image_data_loader = \
+                get_train_imagedataloader_1image([in_image_file],
+                                                 size_images=args.size_in_images,
+                                                 is_generate_patches=args.is_reconstruct_patches,
+                                                 type_generate_patches='slide_window',
+                                                 prop_overlap_slide_images=args.prop_overlap_slide_window,
+                                                 num_random_images=0,
+                                                 is_transform_images=False,
+                                                 type_transform_images='',
+                                                 trans_rigid_params=None,
+                                                 batch_size=1,
+                                                 is_shuffle=False,
+                                                 manual_seed=None)
+            print("Loaded \'%s\' files. Total patches generated: \'%s\'..." % (1, len(image_data_loader)))
+
+            # ******************************
+
+            if args.is_save_featmaps_layer:
+                print("Evaluate Model feature maps...")
+                out_prediction_patches = network_checker.get_feature_maps(image_data_loader,
+                                                                          args.name_layer_save_featmaps)
+            else:
+                print("Evaluate Model...")
+                out_prediction_patches = model_trainer.predict(image_data_loader)
+
+            # ******************************
+
+            if args.is_reconstruct_patches:
+                print("\nReconstruct full size Prediction from sliding-window image patches...")
+                shape_reconstructed_image = ImageFileReader.get_image_size(in_image_file)
+
+                image_reconstructor.initialize_recons_data(shape_reconstructed_image)
+                image_reconstructor.initialize_recons_array(out_prediction_patches[0])
+
+                out_prediction_reconstructed = image_reconstructor.compute_full(out_prediction_patches)
+            else:
+                out_prediction_reconstructed = np.squeeze(out_prediction_patches, axis=(0, -1))
+
+            # ******************************
+
+            # Output predictions
+            in_reference_key = indict_reference_keys[basename_filenoext(in_image_file)]
+            in_caseproc_name = func_extract_caseprocname(in_image_file)
+
+            if args.is_save_featmaps_layer:
+                num_featmaps = out_prediction_reconstructed.shape[-1]
+                print("Output model Feature maps (\'%s\' in total)..." % (num_featmaps))
+
+                for ifeat in range(num_featmaps):
+                    output_prediction_file = \
+                        join_path_names(output_predictions_path,
+                                        name_output_prediction_files % (in_caseproc_name,
+                                                                        args.name_layer_save_featmaps,
+                                                                        ifeat + 1))
+                    print("Output: \'%s\', of dims \'%s\'..." % (basename(output_prediction_file),
+                                                                 out_prediction_reconstructed[..., ifeat].shape))
+
+                    image_file_writer.write_image(output_prediction_file, out_prediction_reconstructed[..., ifeat])
+
+                    outdict_reference_keys[basename_filenoext(output_prediction_file)] = basename(in_reference_key)
+                # endfor
+            else:
                 output_prediction_file = join_path_names(output_predictions_path,
-                                                         name_output_prediction_files % (in_caseproc_name,
-                                                                                         args.name_layer_save_featmaps,
-                                                                                         ifeat + 1))
+                                                         name_output_prediction_files % (in_caseproc_name))
                 print("Output: \'%s\', of dims \'%s\'..." % (basename(output_prediction_file),
-                                                             out_prediction_reconstructed[..., ifeat].shape))
+                                                             out_prediction_reconstructed.shape))
 
-                ImageFileReader.write_image(output_prediction_file, out_prediction_reconstructed[..., ifeat])
+                image_file_writer.write_image(output_prediction_file, out_prediction_reconstructed)
 
                 outdict_reference_keys[basename_filenoext(output_prediction_file)] = basename(in_reference_key)
-            # endfor
-        else:
-            output_prediction_file = join_path_names(output_predictions_path,
-                                                     name_output_prediction_files % (in_caseproc_name))
-            print("Output: \'%s\', of dims \'%s\'..." % (basename(output_prediction_file),
-                                                         out_prediction_reconstructed.shape))
-
-            ImageFileReader.write_image(output_prediction_file, out_prediction_reconstructed)
-
-            outdict_reference_keys[basename_filenoext(output_prediction_file)] = basename(in_reference_key)
-    # endfor
+        # endfor
+    finally:
+        image_file_writer.close()
 
     # Save reference keys for predictions
     save_dictionary(out_reference_keys_file, outdict_reference_keys)
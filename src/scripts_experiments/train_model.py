@@ -10,22 +10,28 @@ from common.constant import BASEDIR, NAME_MODELSRUN_RELPATH, SIZE_IN_IMAGES, NAM
     IS_MASK_REGION_INTEREST, IS_GENERATE_PATCHES, TYPE_GENERATE_PATCHES, PROP_OVERLAP_SLIDE_WINDOW, \
     NUM_RANDOM_PATCHES_EPOCH, IS_TRANSFORM_IMAGES, TYPE_TRANSFORM_IMAGES, TRANS_RIGID_ROTATION_RANGE, \
     TRANS_RIGID_SHIFT_RANGE, TRANS_RIGID_FLIP_DIRS, TRANS_RIGID_ZOOM_RANGE, TRANS_RIGID_FILL_MODE, \
-    FREQ_SAVE_CHECK_MODELS, FREQ_VALIDATE_MODELS, IS_USE_VALIDATION_DATA, IS_SHUFFLE_TRAINDATA, MANUAL_SEED_TRAIN, \
+    TRANS_RIGID_ORDER_INTERP_IMAGE, FREQ_SAVE_CHECK_MODELS, FREQ_VALIDATE_MODELS, IS_USE_VALIDATION_DATA, \
+    IS_SHUFFLE_TRAINDATA, MANUAL_SEED_TRAIN, \
     NAME_REFERENCE_KEYS_PROCIMAGE_FILE, NAME_LOSSHISTORY_FILE, NAME_CONFIG_PARAMS_FILE, NAME_TRAINDATA_LOGFILE, \
-    NAME_VALIDDATA_LOGFILE, TYPE_DNNLIB_USED
+    NAME_VALIDDATA_LOGFILE, TYPE_DNNLIB_USED, IS_MEMMAP_TRAINDATA, IS_CHUNKED_TRAINDATA, \
+    NUM_WORKERS_LOAD_TRAINDATA, NUM_WORKERS_TRAINDATA, PROB_FOREGROUND_WINDOW, TYPE_TRANSFORM_BATCH_IMAGES, \
+    NUM_FILES_WORKING_SET_TRAINDATA, MAX_SIZE_WORKING_SET_TRAINDATA_GB, IS_CACHE_VALIDATION_DATA, \
+    NAME_VALIDPATCHESCACHE_RELPATH
 from common.functionutil import join_path_names, is_exist_file, update_filename, basename, basename_filenoext, \
     list_files_dir, get_substring_filename, str2bool, str2int, str2float, str2list_str, str2tuple_bool, str2tuple_int,\
     str2tuple_float, read_dictionary, read_dictionary_configparams, save_dictionary_configparams
 from common.exceptionmanager import catch_error_exception
 from common.workdirmanager import TrainDirManager
-from dataloaders.dataloader_manager import get_train_imagedataloader_2images
+from dataloaders.dataloader_manager import get_train_imagedataloader_2images, get_train_prebaked_dataloader, \
+    get_valid_cached_dataloader_2images
+from dataloaders.imagedatashards import ImageDataShards
 from models.model_manager import get_model_trainer
 if TYPE_DNNLIB_USED == 'Pytorch':
     from models.pytorch.modeltrainer import NAME_SAVEDMODEL_LAST
 elif TYPE_DNNLIB_USED == 'Keras':
     from models.keras.modeltrainer import NAME_SAVEDMODEL_LAST
 
-LIST_AVAIL_GENERATE_PATCHES_TRAINING = ['slide_window', 'random_window']
+LIST_AVAIL_GENERATE_PATCHES_TRAINING = ['slide_window', 'random_window', 'foreground_window']
 
 
 def write_train_valid_data_logfile(out_filename: str,
@@ -44,6 +50,14 @@ def write_train_valid_data_logfile(out_filename: str,
             fout.write('%s -> (%s)\n' % (basename(in_file), dict_reference_keys[basename_filenoext(in_file)]))
 
 
+def list_data_files_dir(dirname: str, filename_pattern: str) -> List[str]:
+    if ImageDataShards.is_shards_dir(dirname):
+        # data packed in shard files: list the files packed
+        return ImageDataShards.list_files_shards(dirname, filename_pattern)
+    else:
+        return list_files_dir(dirname, filename_pattern)
+
+
 def get_restart_epoch_from_loss_history_file(loss_filename: str) -> int:
     data_file = np.genfromtxt(loss_filename, dtype=str, delimiter=' ')
     last_epoch_file = int(data_file[-1, 0])     # retrieve the last epoch stored
@@ -67,8 +81,8 @@ def main(args):
     workdir_manager = TrainDirManager(args.basedir)
     training_data_path = workdir_manager.get_pathdir_exist(args.training_datadir)
     in_reference_keys_file = workdir_manager.get_datafile_exist(args.name_reference_keys_file)
-    list_train_images_files = list_files_dir(training_data_path, name_input_images_files)[0:args.max_train_images]
-    list_train_labels_files = list_files_dir(training_data_path, name_input_labels_files)[0:args.max_train_images]
+    list_train_images_files = list_data_files_dir(training_data_path, name_input_images_files)[0:args.max_train_images]
+    list_train_labels_files = list_data_files_dir(training_data_path, name_input_labels_files)[0:args.max_train_images]
     indict_reference_keys = read_dictionary(in_reference_keys_file)
 
     if args.is_restart:
@@ -78,8 +92,10 @@ def main(args):
 
     if args.is_use_validation_data:
         validation_data_path = workdir_manager.get_pathdir_exist(args.validation_datadir)
-        list_valid_images_files = list_files_dir(validation_data_path, name_input_images_files)[0:args.max_valid_images]
-        list_valid_labels_files = list_files_dir(validation_data_path, name_input_labels_files)[0:args.max_valid_images]
+        list_valid_images_files = list_data_files_dir(validation_data_path,
+                                                      name_input_images_files)[0:args.max_valid_images]
+        list_valid_labels_files = list_data_files_dir(validation_data_path,
+                                                      name_input_labels_files)[0:args.max_valid_images]
     else:
         list_valid_images_files = None
         list_valid_labels_files = None
@@ -157,6 +173,15 @@ def main(args):
                                    is_restart_model=args.is_restart)
     # model_trainer.summary_model()
 
+    if args.is_transform_images and (args.type_transform_images == TYPE_TRANSFORM_BATCH_IMAGES):
+        # rigid transformations done to the batches in the device of the model, not in the data loader
+        model_trainer.create_transform_batch_data(args.size_in_images,
+                                                  trans_rigid_params=args.dict_trans_rigid_parameters,
+                                                  seed=args.manual_seed_train)
+        is_transform_images_loader = False
+    else:
+        is_transform_images_loader = args.is_transform_images
+
     # *****************************************************
 
     # LOADING DATA
@@ -170,22 +195,35 @@ def main(args):
               % (str(args.size_in_images), str(size_output_image_model)))
 
     print("\nLoading Training data...")
-    training_data_loader = \
-        get_train_imagedataloader_2images(list_train_images_files,
-                                          list_train_labels_files,
-                                          size_images=args.size_in_images,
-                                          is_generate_patches=args.is_generate_patches,
-                                          type_generate_patches=args.type_generate_patches,
-                                          prop_overlap_slide_images=args.prop_overlap_slide_window,
-                                          num_random_images=args.num_random_patches_epoch,
-                                          is_transform_images=args.is_transform_images,
-                                          type_transform_images=args.type_transform_images,
-                                          trans_rigid_params=args.dict_trans_rigid_parameters,
-                                          is_nnet_validconvs=args.is_valid_convolutions,
-                                          size_output_images=size_output_image_model,
-                                          batch_size=args.batch_size,
-                                          is_shuffle=args.is_shuffle_traindata,
-                                          manual_seed=args.manual_seed_train)
+    if args.prebaked_epochs_dir:
+        # training data generated ahead of training, by the script 'prebake_train_epochs.py' running meanwhile
+        prebaked_epochs_path = workdir_manager.get_pathdir_exist(args.prebaked_epochs_dir)
+        training_data_loader = get_train_prebaked_dataloader(prebaked_epochs_path,
+                                                             batch_size=args.batch_size)
+    else:
+        training_data_loader = \
+            get_train_imagedataloader_2images(list_train_images_files,
+                                              list_train_labels_files,
+                                              size_images=args.size_in_images,
+                                              is_generate_patches=args.is_generate_patches,
+                                              type_generate_patches=args.type_generate_patches,
+                                              prop_overlap_slide_images=args.prop_overlap_slide_window,
+                                              num_random_images=args.num_random_patches_epoch,
+                                              is_transform_images=is_transform_images_loader,
+                                              type_transform_images=args.type_transform_images,
+                                              trans_rigid_params=args.dict_trans_rigid_parameters,
+                                              is_nnet_validconvs=args.is_valid_convolutions,
+                                              size_output_images=size_output_image_model,
+                                              batch_size=args.batch_size,
+                                              is_shuffle=args.is_shuffle_traindata,
+                                              manual_seed=args.manual_seed_train,
+                                              is_memmap_data=args.is_memmap_traindata,
+                                              is_chunked_data=args.is_chunked_traindata,
+                                              num_workers_load=args.num_workers_load_traindata,
+                                              num_workers_train=args.num_workers_traindata,
+                                              prob_foreground_window=args.prob_foreground_window,
+                                              num_files_working_set=args.num_files_working_set_traindata,
+                                              max_size_working_set_gb=args.max_size_working_set_traindata_gb)
     print("Loaded \'%s\' files. Total batches generated: \'%s\'..."
           % (len(list_train_images_files), len(training_data_loader)))
 
@@ -196,22 +234,46 @@ def main(args):
         else:
             type_generate_patches_validation = ''
 
-        validation_data_loader = \
-            get_train_imagedataloader_2images(list_valid_images_files,
-                                              list_valid_labels_files,
-                                              size_images=args.size_in_images,
-                                              is_generate_patches=args.is_generate_patches,
-                                              type_generate_patches=type_generate_patches_validation,
-                                              prop_overlap_slide_images=args.prop_overlap_slide_window,
-                                              num_random_images=0,
-                                              is_transform_images=False,
-                                              type_transform_images='',
-                                              trans_rigid_params=None,
-                                              is_nnet_validconvs=args.is_valid_convolutions,
-                                              size_output_images=size_output_image_model,
-                                              batch_size=args.batch_size,
-                                              is_shuffle=args.is_shuffle_traindata,
-                                              manual_seed=args.manual_seed_train)
+        if args.is_cache_validation_data:
+            # the same patches in every validation: generated once, and read in order from disk
+            validpatches_cache_path = join_path_names(models_path, NAME_VALIDPATCHESCACHE_RELPATH)
+            validation_data_loader = \
+                get_valid_cached_dataloader_2images(validpatches_cache_path,
+                                                    list_valid_images_files,
+                                                    list_valid_labels_files,
+                                                    size_images=args.size_in_images,
+                                                    is_generate_patches=args.is_generate_patches,
+                                                    type_generate_patches=type_generate_patches_validation,
+                                                    prop_overlap_slide_images=args.prop_overlap_slide_window,
+                                                    num_random_images=0,
+                                                    is_nnet_validconvs=args.is_valid_convolutions,
+                                                    size_output_images=size_output_image_model,
+                                                    batch_size=args.batch_size,
+                                                    manual_seed=args.manual_seed_train,
+                                                    is_memmap_data=args.is_memmap_traindata,
+                                                    is_chunked_data=args.is_chunked_traindata,
+                                                    num_workers_load=args.num_workers_load_traindata)
+        else:
+            validation_data_loader = \
+                get_train_imagedataloader_2images(list_valid_images_files,
+                                                  list_valid_labels_files,
+                                                  size_images=args.size_in_images,
+                                                  is_generate_patches=args.is_generate_patches,
+                                                  type_generate_patches=type_generate_patches_validation,
+                                                  prop_overlap_slide_images=args.prop_overlap_slide_window,
+                                                  num_random_images=0,
+                                                  is_transform_images=False,
+                                                  type_transform_images='',
+                                                  trans_rigid_params=None,
+                                                  is_nnet_validconvs=args.is_valid_convolutions,
+                                                  size_output_images=size_output_image_model,
+                                                  batch_size=args.batch_size,
+                                                  is_shuffle=args.is_shuffle_traindata,
+                                                  manual_seed=args.manual_seed_train,
+                                                  is_memmap_data=args.is_memmap_traindata,
+                                                  is_chunked_data=args.is_chunked_traindata,
+                                                  num_workers_load=args.num_workers_load_traindata,
+                                                  num_workers_train=args.num_workers_traindata)
         print("Loaded \'%s\' files. Total batches generated: \'%s\'..."
               % (len(list_valid_images_files), len(validation_data_loader)))
     else:
@@ -270,6 +332,7 @@ if __name__ == "__main__":
     parser.add_argument('--type_generate_patches', type=str, default=TYPE_GENERATE_PATCHES)
     parser.add_argument('--prop_overlap_slide_window', type=str2tuple_float, default=PROP_OVERLAP_SLIDE_WINDOW)
     parser.add_argument('--num_random_patches_epoch', type=str2int, default=NUM_RANDOM_PATCHES_EPOCH)
+    parser.add_argument('--prob_foreground_window', type=str2float, default=PROB_FOREGROUND_WINDOW)
     parser.add_argument('--is_transform_images', type=str2bool, default=IS_TRANSFORM_IMAGES)
     parser.add_argument('--type_transform_images', type=str, default=TYPE_TRANSFORM_IMAGES)
     parser.add_argument('--trans_rigid_rotation_range', type=str2tuple_float, default=TRANS_RIGID_ROTATION_RANGE)
@@ -277,11 +340,21 @@ if __name__ == "__main__":
     parser.add_argument('--trans_rigid_flip_dirs', type=str2tuple_bool, default=TRANS_RIGID_FLIP_DIRS)
     parser.add_argument('--trans_rigid_zoom_range', type=str2float, default=TRANS_RIGID_ZOOM_RANGE)
     parser.add_argument('--trans_rigid_fill_mode', type=str, default=TRANS_RIGID_FILL_MODE)
+    parser.add_argument('--trans_rigid_order_interp_image', type=str2int, default=TRANS_RIGID_ORDER_INTERP_IMAGE)
     parser.add_argument('--freq_save_check_models', type=str2int, default=FREQ_SAVE_CHECK_MODELS)
     parser.add_argument('--freq_validate_models', type=str2int, default=FREQ_VALIDATE_MODELS)
     parser.add_argument('--is_use_validation_data', type=str2bool, default=IS_USE_VALIDATION_DATA)
+    parser.add_argument('--is_cache_validation_data', type=str2bool, default=IS_CACHE_VALIDATION_DATA)
     parser.add_argument('--is_shuffle_traindata', type=str2bool, default=IS_SHUFFLE_TRAINDATA)
     parser.add_argument('--manual_seed_train', type=str2int, default=MANUAL_SEED_TRAIN)
+    parser.add_argument('--is_memmap_traindata', type=str2bool, default=IS_MEMMAP_TRAINDATA)
+    parser.add_argument('--is_chunked_traindata', type=str2bool, default=IS_CHUNKED_TRAINDATA)
+    parser.add_argument('--num_workers_load_traindata', type=str2int, default=NUM_WORKERS_LOAD_TRAINDATA)
+    parser.add_argument('--num_workers_traindata', type=str2int, default=NUM_WORKERS_TRAINDATA)
+    parser.add_argument('--num_files_working_set_traindata', type=str2int, default=NUM_FILES_WORKING_SET_TRAINDATA)
+    parser.add_argument('--max_size_working_set_traindata_gb', type=str2float,
+                        default=MAX_SIZE_WORKING_SET_TRAINDATA_GB)
+    parser.add_argument('--prebaked_epochs_dir', type=str, default=None)
     parser.add_argument('--name_reference_keys_file', type=str, default=NAME_REFERENCE_KEYS_PROCIMAGE_FILE)
     parser.add_argument('--is_restart', type=str2bool, default=False)
     parser.add_argument('--restart_file', type=str, default=NAME_SAVEDMODEL_LAST)
@@ -323,6 +396,8 @@ if __name__ == "__main__":
             args.type_generate_patches = str(input_args_file['type_generate_patches'])
             args.prop_overlap_slide_window = str2tuple_float(input_args_file['prop_overlap_slide_window'])
             args.num_random_patches_epoch = str2int(input_args_file['num_random_patches_epoch'])
+            if 'prob_foreground_window' in input_args_file.keys():
+                args.prob_foreground_window = str2float(input_args_file['prob_foreground_window'])
             args.is_transform_images = str2bool(input_args_file['is_transform_images'])
             args.type_transform_images = str(input_args_file['type_transform_images'])
             # args.trans_rigid_rotation_range = str2tuple_float(input_args_file['trans_rigid_rotation_range'])
@@ -341,11 +416,16 @@ if __name__ == "__main__":
                   % (args.type_generate_patches, LIST_AVAIL_GENERATE_PATCHES_TRAINING)
         catch_error_exception(message)
 
+    if args.type_transform_images == TYPE_TRANSFORM_BATCH_IMAGES and TYPE_DNNLIB_USED != 'Pytorch':
+        message = 'Type Transform Images \'%s\' only available with Pytorch' % (args.type_transform_images)
+        catch_error_exception(message)
+
     args.dict_trans_rigid_parameters = {'rotation_range': args.trans_rigid_rotation_range,
                                         'shift_range': args.trans_rigid_shift_range,
                                         'flip_dirs': args.trans_rigid_flip_dirs,
                                         'zoom_range': args.trans_rigid_zoom_range,
-                                        'fill_mode': args.trans_rigid_fill_mode}
+                                        'fill_mode': args.trans_rigid_fill_mode,
+                                        'order_interp_image': args.trans_rigid_order_interp_image}
 
     print("Print input arguments...")
     for key, value in sorted(vars(args).items()):
@@ -0,0 +1,54 @@
+
+import argparse
+
+from common.constant import BASEDIR, NAME_TRAININGDATA_RELPATH, NAME_REFERENCE_KEYS_PROCIMAGE_FILE
+from common.functionutil import list_files_dir, read_dictionary, str2float
+from common.exceptionmanager import catch_error_exception
+from common.workdirmanager import TrainDirManager
+from dataloaders.imagedatashards import ImageDataShards
+
+
+def main(args):
+
+    # SETTINGS
+    list_name_input_files = ['images_proc*.nii.gz', 'labels_proc*.nii.gz', 'cenlines_proc*.nii.gz']
+    # --------
+
+    if not args.output_datadir:
+        args.output_datadir = args.input_datadir.rstrip('/') + 'Shards/'
+
+    workdir_manager = TrainDirManager(args.basedir)
+    input_data_path = workdir_manager.get_pathdir_exist(args.input_datadir)
+    output_shards_path = workdir_manager.get_pathdir_new(args.output_datadir)
+    in_reference_keys_file = workdir_manager.get_datafile_exist(args.name_reference_keys_file)
+    indict_reference_keys = read_dictionary(in_reference_keys_file)
+
+    if ImageDataShards.is_shards_dir(output_shards_path):
+        message = 'Output dir \'%s\' already contains data shards' % (output_shards_path)
+        catch_error_exception(message)
+
+    list_input_files = []
+    for name_input_files in list_name_input_files:
+        list_input_files += list_files_dir(input_data_path, name_input_files, is_check=False)
+
+    print("Pack \'%s\' files from \'%s\' in shards in \'%s\'..."
+          % (len(list_input_files), input_data_path, output_shards_path))
+
+    max_size_shard = int(args.max_size_shard_gb * 1024**3)
+    ImageDataShards.write_shards(output_shards_path, list_input_files, indict_reference_keys,
+                                 max_size_shard=max_size_shard)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--basedir', type=str, default=BASEDIR)
+    parser.add_argument('--input_datadir', type=str, default=NAME_TRAININGDATA_RELPATH)
+    parser.add_argument('--output_datadir', type=str, default=None)
+    parser.add_argument('--max_size_shard_gb', type=str2float, default=4.0)
+    parser.add_argument('--name_reference_keys_file', type=str, default=NAME_REFERENCE_KEYS_PROCIMAGE_FILE)
+    args = parser.parse_args()
+
+    print("Print input arguments...")
+    for key, value in vars(args).items():
+        print("\'%s\' = %s" % (key, value))
+    main(args)
@@ -10,7 +10,7 @@ from common.constant import DATADIR, IS_BINARY_TRAIN_MASKS, IS_NORMALIZE_DATA, I
     NAME_REFERENCE_FILES_RELPATH, NAME_REFERENCE_KEYS_PROCIMAGE_FILE, NAME_CROP_BOUNDBOXES_FILE, \
     NAME_RESCALE_FACTORS_FILE, IS_TWO_BOUNDBOXES_LUNGS
 from common.functionutil import join_path_names, basename, basename_filenoext, list_files_dir, str2bool, \
-    read_dictionary, save_dictionary, save_dictionary_csv
+    read_dictionary, save_dictionary, save_dictionary_csv, ImagesUtil
 from common.exceptionmanager import catch_error_exception, catch_warning_exception
 from common.workdirmanager import GeneralDirManager
 from dataloaders.imagefilereader import ImageFileReader
@@ -310,6 +310,11 @@ def main(args):
 
         # ******************************
 
+        # store the data in the smallest integer dtype possible, without loss (e.g. int8 labels, int16 CT)
+        list_inout_data = [ImagesUtil.get_image_compact_dtype(in_data) for in_data in list_inout_data]
+
+        # ******************************
+
         # Output processed images
         if args.is_crop_images and args.is_two_boundboxes_lungs:
             first_elem_dict_crop_boundboxes = list(indict_crop_boundboxes.values())[0]
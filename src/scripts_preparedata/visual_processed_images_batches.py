@@ -5,7 +5,8 @@ import argparse
 from common.constant import DATADIR, SIZE_IN_IMAGES, NAME_PROC_IMAGES_RELPATH, NAME_PROC_LABELS_RELPATH, \
     IS_GENERATE_PATCHES, TYPE_GENERATE_PATCHES, PROP_OVERLAP_SLIDE_WINDOW, NUM_RANDOM_PATCHES_EPOCH, \
     IS_TRANSFORM_IMAGES, TYPE_TRANSFORM_IMAGES, TRANS_RIGID_ROTATION_RANGE, TRANS_RIGID_SHIFT_RANGE, \
-    TRANS_RIGID_FLIP_DIRS, TRANS_RIGID_ZOOM_RANGE, TRANS_RIGID_FILL_MODE, NAME_REFERENCE_KEYS_PROCIMAGE_FILE
+    TRANS_RIGID_FLIP_DIRS, TRANS_RIGID_ZOOM_RANGE, TRANS_RIGID_FILL_MODE, TRANS_RIGID_ORDER_INTERP_IMAGE, \
+    NAME_REFERENCE_KEYS_PROCIMAGE_FILE
 from common.functionutil import join_path_names, basename, list_files_dir, str2bool, str2int, str2float, \
     str2tuple_bool, str2tuple_int, str2tuple_float
 from common.exceptionmanager import catch_error_exception
@@ -92,6 +93,7 @@ if __name__ == "__main__":
     parser.add_argument('--trans_rigid_flip_dirs', type=str2tuple_bool, default=TRANS_RIGID_FLIP_DIRS)
     parser.add_argument('--trans_rigid_zoom_range', type=str2float, default=TRANS_RIGID_ZOOM_RANGE)
     parser.add_argument('--trans_rigid_fill_mode', type=str, default=TRANS_RIGID_FILL_MODE)
+    parser.add_argument('--trans_rigid_order_interp_image', type=str2int, default=TRANS_RIGID_ORDER_INTERP_IMAGE)
     parser.add_argument('--name_input_reference_keys_file', type=str, default=NAME_REFERENCE_KEYS_PROCIMAGE_FILE)
     args = parser.parse_args()
 
@@ -99,7 +101,8 @@ if __name__ == "__main__":
                                         'shift_range': args.trans_rigid_shift_range,
                                         'flip_dirs': args.trans_rigid_flip_dirs,
                                         'zoom_range': args.trans_rigid_zoom_range,
-                                        'fill_mode': args.trans_rigid_fill_mode}
+                                        'fill_mode': args.trans_rigid_fill_mode,
+                                        'order_interp_image': args.trans_rigid_order_interp_image}
 
     print("Print input arguments...")
     for key, value in vars(args).items():
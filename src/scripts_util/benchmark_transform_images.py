@@ -0,0 +1,71 @@
+
+import numpy as np
+import argparse
+import time
+
+from common.constant import SIZE_IN_IMAGES, TYPE_GENERATE_PATCHES, TYPE_TRANSFORM_IMAGES, \
+    TRANS_RIGID_ROTATION_RANGE, TRANS_RIGID_SHIFT_RANGE, TRANS_RIGID_FLIP_DIRS, TRANS_RIGID_ZOOM_RANGE, \
+    TRANS_RIGID_FILL_MODE, TRANS_RIGID_ORDER_INTERP_IMAGE
+from common.functionutil import str2bool, str2int, str2float, str2tuple_int, str2tuple_bool, str2tuple_float
+from preprocessing.preprocessing_manager import get_image_generator
+
+
+def main(args):
+
+    # synthetic volume (image and labels) as input, to measure the throughput of the generators alone
+    random_state = np.random.default_rng(0)
+    in_image = random_state.normal(size=args.size_volume).astype(np.float32)
+    in_label = (in_image > 1.0).astype(np.uint8)
+
+    image_generator = get_image_generator(args.size_in_images,
+                                          is_generate_patches=args.is_generate_patches,
+                                          type_generate_patches=args.type_generate_patches,
+                                          prop_overlap_slide_images=(0.0, 0.0, 0.0),
+                                          num_random_images=args.num_patches,
+                                          is_transform_images=args.is_transform_images,
+                                          type_transform_images=args.type_transform_images,
+                                          trans_rotation_range=args.trans_rigid_rotation_range,
+                                          trans_shift_range=args.trans_rigid_shift_range,
+                                          trans_flip_dirs=args.trans_rigid_flip_dirs,
+                                          trans_zoom_range=args.trans_rigid_zoom_range,
+                                          trans_fill_mode=args.trans_rigid_fill_mode,
+                                          trans_order_interp_image=args.trans_rigid_order_interp_image,
+                                          size_volume_images=args.size_volume)
+    print(image_generator.get_text_description())
+    image_generator.update_image_data(in_image.shape)
+
+    print("Generate \'%s\' patches (image and labels) from volume of size \'%s\'..."
+          % (args.num_patches, str(args.size_volume)))
+
+    start_time = time.time()
+    for index in range(args.num_patches):
+        (_, _) = image_generator.get_2images(in_image, in_label, index=index, seed=(args.seed, index))
+    # endfor
+    elapsed_time = time.time() - start_time
+
+    print("Time elapsed: \'%0.3f\' secs. Throughput: \'%0.3f\' patches/s..."
+          % (elapsed_time, args.num_patches / elapsed_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size_in_images', type=str2tuple_int, default=SIZE_IN_IMAGES)
+    parser.add_argument('--size_volume', type=str2tuple_int, default=(320, 320, 320))
+    parser.add_argument('--num_patches', type=str2int, default=20)
+    parser.add_argument('--seed', type=str2int, default=2017)
+    parser.add_argument('--is_generate_patches', type=str2bool, default=True)
+    parser.add_argument('--type_generate_patches', type=str, default=TYPE_GENERATE_PATCHES)
+    parser.add_argument('--is_transform_images', type=str2bool, default=True)
+    parser.add_argument('--type_transform_images', type=str, default=TYPE_TRANSFORM_IMAGES)
+    parser.add_argument('--trans_rigid_rotation_range', type=str2tuple_float, default=TRANS_RIGID_ROTATION_RANGE)
+    parser.add_argument('--trans_rigid_shift_range', type=str2tuple_float, default=TRANS_RIGID_SHIFT_RANGE)
+    parser.add_argument('--trans_rigid_flip_dirs', type=str2tuple_bool, default=TRANS_RIGID_FLIP_DIRS)
+    parser.add_argument('--trans_rigid_zoom_range', type=str2float, default=TRANS_RIGID_ZOOM_RANGE)
+    parser.add_argument('--trans_rigid_fill_mode', type=str, default=TRANS_RIGID_FILL_MODE)
+    parser.add_argument('--trans_rigid_order_interp_image', type=str2int, default=TRANS_RIGID_ORDER_INTERP_IMAGE)
+    args = parser.parse_args()
+
+    print("Print input arguments...")
+    for key, value in vars(args).items():
+        print("\'%s\' = %s" % (key, value))
+    main(args)